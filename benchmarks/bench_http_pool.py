@@ -0,0 +1,60 @@
+"""
+Бенчмарк спільного httpx-пулу (public_get) проти нового AsyncClient на кожен запит.
+Сервер — локальний aiohttp на 127.0.0.1 (без TLS, тож реальний виграш від keep-alive ще більший).
+Ліміт запитів (RATE_PUBLIC) знято, щоб міряти лише транспорт.
+
+    python benchmarks/bench_http_pool.py [кількість запитів]
+"""
+import asyncio
+import os
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH-TOKEN-BENCH-TOKEN-BENCH-TOKEN-BE")
+os.environ.setdefault("API_KEY", "bench")
+os.environ.setdefault("API_SECRET", "bench")
+os.environ["RATE_PUBLIC"] = "100000/100000"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import main  # noqa: E402
+
+PATH = "/api/v4/public/ticker"
+
+
+async def _ticker(request):
+    return web.json_response({"BTC_USDT": {"last_price": "100"}})
+
+
+async def bench(n: int):
+    app = web.Application()
+    app.router.add_get(PATH, _ticker)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    host, port = runner.addresses[0][:2]
+    main.BASE_URL = f"http://{host}:{port}"
+    try:
+        t = time.perf_counter()
+        for _ in range(n):
+            async with httpx.AsyncClient(timeout=30) as client:   # як було: клієнт на кожен виклик
+                await client.get(main.BASE_URL + PATH)
+        per_call = (time.perf_counter() - t) / n
+
+        await main.public_get(PATH)                                # прогрів пулу
+        t = time.perf_counter()
+        for _ in range(n):
+            await main.public_get(PATH)
+        pooled = (time.perf_counter() - t) / n
+    finally:
+        await main.close_http_client()
+        await runner.cleanup()
+    print(f"{n} послідовних GET {PATH}")
+    print(f"  клієнт на кожен запит: {per_call * 1000:7.2f} мс/запит")
+    print(f"  спільний пул:          {pooled * 1000:7.2f} мс/запит  (x{per_call / pooled:.1f})")
+
+
+if __name__ == "__main__":
+    asyncio.run(bench(int(sys.argv[1]) if len(sys.argv) > 1 else 300))
@@ -0,0 +1,97 @@
+"""
+Мікробенчмарк квантування сітки: MarketRules (кроки скомпільовані один раз, Decimal.quantize)
+проти старого шляху — dict правил на кожен виклик, крок через Decimal(10) ** prec і Decimal(str(float)) // step.
+Міряємо побудову рівнів сітки (ціна + кількість + форматування), як у grid/ping-pong.
+
+    python benchmarks/bench_precision.py [ринків] [рівнів]
+"""
+import os
+import sys
+import time
+from decimal import Decimal
+
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH-TOKEN-BENCH-TOKEN-BENCH-TOKEN-BE")
+os.environ.setdefault("API_KEY", "bench")
+os.environ.setdefault("API_SECRET", "bench")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+STEP_PCT = 0.003
+SPEND = 25.0
+
+
+# ---------------- старий шлях (до MarketRules) ----------------
+def _old_rules(raw: dict, market: str) -> dict:
+    r = raw.get(market.upper(), {})
+    return {
+        "amount_precision": r.get("amount_precision", 6),
+        "price_precision": r.get("price_precision", 6),
+        "min_amount": r.get("min_amount"),
+        "min_total": r.get("min_total"),
+    }
+
+
+def _old_step(prec: int) -> Decimal:
+    return Decimal(1) / (Decimal(10) ** int(prec))
+
+
+def _old_quantize(raw: dict, market: str, key: str, x: float) -> Decimal:
+    step = _old_step(_old_rules(raw, market)[key])
+    return (Decimal(str(x)) // step) * step
+
+
+def old_levels(raw: dict, markets: list, levels: int) -> int:
+    n = 0
+    for m in markets:
+        r0 = 100.0
+        for i in range(1, levels + 1):
+            p = _old_quantize(raw, m, "price_precision", r0 * (1 - STEP_PCT * i))
+            a = _old_quantize(raw, m, "amount_precision", SPEND / float(p))
+            format(p, "f"), format(a, "f")
+            n += 1
+    return n
+
+
+# ---------------- MarketRules ----------------
+def new_levels(markets: list, levels: int) -> int:
+    n = 0
+    for m in markets:
+        r0 = main._dec(100)
+        st = main._dec(STEP_PCT)
+        spend = main._dec(SPEND)
+        for i in range(1, levels + 1):
+            r = main.get_rules(m)
+            p = r.q_price(r0 * (1 - st * i))
+            a = r.q_amount(spend / p)
+            format(p, "f"), format(a, "f")
+            n += 1
+    return n
+
+
+def bench(n_markets: int, levels: int, repeat: int = 5):
+    markets = [f"C{i}_USDT" for i in range(n_markets)]
+    raw = {m: {"amount_precision": 4, "price_precision": 2,
+               "min_amount": "0.001", "min_total": "5"} for m in markets}
+    main.market_rules.clear()
+    for m in markets:
+        main.market_rules[m] = main.MarketRules.compile(4, 2, Decimal("0.001"), Decimal("5"))
+
+    def best(fn, *args):
+        out = []
+        for _ in range(repeat):
+            t = time.perf_counter()
+            cnt = fn(*args)
+            out.append((time.perf_counter() - t) / cnt)
+        return min(out)
+
+    old = best(old_levels, raw, markets, levels)
+    new = best(new_levels, markets, levels)
+    print(f"{n_markets} ринків × {levels} рівнів, найкраще з {repeat}")
+    print(f"  dict + Decimal(str(float)) // step: {old * 1e6:7.2f} мкс/рівень  ({1 / old:,.0f} рівнів/с)")
+    print(f"  MarketRules.quantize:               {new * 1e6:7.2f} мкс/рівень  ({1 / new:,.0f} рівнів/с, x{old / new:.1f})")
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    bench(*(args + [100, 50][len(args):]))
@@ -2,13 +2,21 @@
 import asyncio
 import base64
 import hashlib
+import heapq
 import hmac
+import itertools
 import json
 import logging
+import math
 import os
+import tempfile
 import time
+from abc import ABC, abstractmethod
 from typing import Dict, Any, Optional
+from array import array
+from bisect import bisect_left, bisect_right
 
+import aiohttp
 import httpx
 from aiogram import Bot, Dispatcher, types
 from aiogram.client.default import DefaultBotProperties
@@ -34,31 +42,78 @@ dp = Dispatcher()
 # WhiteBIT base (важливо: без /api/v4 у BASE_URL)
 BASE_URL = "https://whitebit.com"
 MARKETS_FILE = "markets.json"
-markets: Dict[str, Dict[str, Any]] = {}
+markets: Dict[str, "MarketConfig"] = {}
 
-# Кеш правил ринків (price/amount precision, min тощо)
-market_rules: Dict[str, Dict[str, Any]] = {}
+# Кеш правил ринків (price/amount precision, min тощо) — скомпільовані MarketRules
+market_rules: Dict[str, "MarketRules"] = {}
 
 # ---------------- SAFETY / RISK LAYER ----------------
 from dataclasses import dataclass, field
-from collections import deque
+from collections import OrderedDict, deque
 
 @dataclass
 class SafetyConfig:
     enabled: bool = True                  # /safemode on|off
     dump_window_sec: int = 180            # скільки секунд дивимося на обвал
-    dump_pct: Decimal = Decimal("1.2")    # якщо ціна впала >1.2% за вікно — пауза входів
+    dump_pct: Decimal = Decimal("1.2")    # якщо ціна впала >1.2% від максимуму вікна — пауза входів
+    dump_pause_sec: int = 120             # тривалість паузи після дампу
     max_spread_pct: Decimal = Decimal("0.6")  # якщо спред >0.6% — не входимо
     pair_max_dd_pct: Decimal = Decimal("1.2") # автостоп по парі (від середньої ціни входів)
     daily_loss_pct: Decimal = Decimal("3.0")  # автостоп за день від equity (прибл.)
     auto_profit_fix_enabled: bool = True  # /autopf on|off
-    min_pnl_lock_pct: Decimal = Decimal("0.8")# при n% руху в плюс — підтягуємо ТР
+    min_pnl_lock_pct: Decimal = Decimal("0.8")# при n% руху в плюс — підтягуємо ТР; стільки ж прибутку фіксує підлога
     trail_tp_gap_pct: Decimal = Decimal("0.4")# відстань, на яку відтягуємо TP від поточної
 
+class RollingWindow:
+    """
+    Часове ковзне вікно цін з max/min за O(1) амортизовано (монотонні деки).
+    Кожна ціна один раз додається і максимум один раз виштовхується з кожного деку.
+    """
+    __slots__ = ("window", "_max", "_min", "last", "last_ts")
+
+    def __init__(self, window: float):
+        self.window = float(window)
+        self._max: deque = deque()   # (ts, price), ціни спадають
+        self._min: deque = deque()   # (ts, price), ціни зростають
+        self.last = 0.0
+        self.last_ts = 0.0
+
+    def push(self, ts: float, price: float):
+        if ts < self.last_ts:
+            return  # запізніла ціна зламала б монотонність деків
+        mx, mn = self._max, self._min
+        while mx and mx[-1][1] <= price:
+            mx.pop()
+        mx.append((ts, price))
+        while mn and mn[-1][1] >= price:
+            mn.pop()
+        mn.append((ts, price))
+        self.last = price
+        self.last_ts = ts
+        self._evict(ts)
+
+    def _evict(self, now: float):
+        edge = now - self.window
+        mx, mn = self._max, self._min
+        while mx and mx[0][0] < edge:
+            mx.popleft()
+        while mn and mn[0][0] < edge:
+            mn.popleft()
+
+    def high(self, now: Optional[float] = None) -> Optional[float]:
+        if now is not None:
+            self._evict(now)
+        return self._max[0][1] if self._max else None
+
+    def low(self, now: Optional[float] = None) -> Optional[float]:
+        if now is not None:
+            self._evict(now)
+        return self._min[0][1] if self._min else None
+
 @dataclass
 class SafetyState:
-    # ціни по часу для детекції дампу / тренду
-    last_prices: deque = field(default_factory=lambda: deque(maxlen=60))
+    # ціни по часу для детекції дампу (вікно dump_window_sec)
+    window: RollingWindow
     last_ts: float = 0.0
     day_equity_start: Decimal = Decimal("0")
     paused_until: float = 0.0             # timestamp; якщо > now => пауза
@@ -73,39 +128,42 @@ class SafetyManager:
 
     def _st(self, pair: str) -> SafetyState:
         if pair not in self.by_pair:
-            self.by_pair[pair] = SafetyState()
+            self.by_pair[pair] = SafetyState(window=RollingWindow(self.cfg.dump_window_sec))
         return self.by_pair[pair]
 
-    def note_price(self, pair: str, price: Decimal, now: float):
+    def note_price(self, pair: str, price, now: float):
+        """Кожен тік ціни: оновлює вікно і, якщо ціна впала від максимуму вікна на dump_pct, ставить паузу входів."""
         st = self._st(pair)
-        st.last_prices.append((now, price))
+        w = st.window
+        if now < w.last_ts:
+            return  # старша за вже враховану (напр. бекфіл після живого тіку)
+        w.push(now, float(price))
         st.last_ts = now
-
-    def block_entry_reason(self, pair: str, price: Decimal, spread_pct: Decimal, now: float) -> str | None:
+        if not self.cfg.enabled:
+            return
+        hi = w.high()
+        if hi and w.last <= hi * (1 - float(self.cfg.dump_pct) / 100):
+            if now >= st.paused_until:
+                logging.warning(f"[SAFETY] {pair}: дамп >{self.cfg.dump_pct}% за {self.cfg.dump_window_sec}s "
+                                f"(max {hi} -> {w.last}), пауза входів {self.cfg.dump_pause_sec}s")
+            # поки дамп триває — пауза продовжується
+            st.paused_until = now + self.cfg.dump_pause_sec
+
+    def block_entry_reason(self, pair: str, now: Optional[float] = None,
+                           spread_pct: Optional[Decimal] = None) -> str | None:
         if not self.cfg.enabled:
             return None
+        now = time.time() if now is None else now
         st = self._st(pair)
 
-        # Пауза активна?
-        if st.paused_until and now < st.paused_until:
-            return f"PAUSE ({int(st.paused_until - now)}s)"
+        # Пауза після дампу активна?
+        if now < st.paused_until:
+            return f"DUMP>{self.cfg.dump_pct}% PAUSE ({int(st.paused_until - now)}s)"
 
-        # Широкий спред — ризик «пилорами»
-        if spread_pct >= self.cfg.max_spread_pct:
+        # Широкий спред — ризик «пилорами» (лише якщо джерело ціни знає спред)
+        if spread_pct is not None and spread_pct >= self.cfg.max_spread_pct:
             return f"SPREAD>{self.cfg.max_spread_pct}%"
 
-        # Детектор дампу за останні dump_window_sec
-        start_price = None
-        for ts, p in st.last_prices:
-            if now - ts <= self.cfg.dump_window_sec:
-                start_price = start_price or p
-        if start_price:
-            drop_pct = ( (start_price - price) / start_price ) * Decimal("100")
-            if drop_pct >= self.cfg.dump_pct:
-                # ставимо коротку паузу на 2 хв
-                st.paused_until = now + 120
-                return f"DUMP>{self.cfg.dump_pct}%"
-
         return None
 
     def update_position(self, pair: str, avg_entry_price: Decimal, qty: Decimal):
@@ -123,7 +181,11 @@ class SafetyManager:
         return dd_pct >= self.cfg.pair_max_dd_pct
 
     def should_lock_profit(self, pair: str, last_price: Decimal) -> Decimal | None:
-        """Повертає бажаний TP-рівень (ціна), якщо треба підтягнути TP вище поточного."""
+        """
+        Повертає бажаний TP-рівень (ціна), якщо треба підтягнути TP вище поточного:
+        після руху в плюс на min_pnl_lock_pct TP тримається на trail_tp_gap_pct над ціною
+        (лімітний sell нижче ринку виконався б одразу). Чи вище це за поточний TP — вирішує виклик.
+        """
         if not self.cfg.auto_profit_fix_enabled:
             return None
         st = self._st(pair)
@@ -132,96 +194,489 @@ class SafetyManager:
         move_pct = ((last_price - st.avg_entry_price) / st.avg_entry_price) * Decimal("100")
         if move_pct >= self.cfg.min_pnl_lock_pct:
             gap = (last_price * self.cfg.trail_tp_gap_pct) / Decimal("100")
-            return last_price - gap
+            return last_price + gap
         return None
 
+    def profit_floor(self, pair: str, last_price: Decimal) -> Decimal | None:
+        """
+        Підлога фіксації прибутку (ціна виходу): щойно ціна піднялась над entry·(1+min_pnl_lock_pct)
+        більше ніж на trail_tp_gap_pct — не нижче entry·(1+min_pnl_lock_pct) і на gap під ціною.
+        Лише піднімається: чи вище це за поточну підлогу — вирішує виклик.
+        """
+        if not self.cfg.auto_profit_fix_enabled:
+            return None
+        st = self._st(pair)
+        if st.position_qty <= 0 or st.avg_entry_price <= 0:
+            return None
+        lock = st.avg_entry_price * (1 + self.cfg.min_pnl_lock_pct / Decimal("100"))
+        gap = self.cfg.trail_tp_gap_pct / Decimal("100")
+        if last_price < lock * (1 + gap):
+            return None
+        return max(lock, last_price * (1 - gap))
+
 # створимо глобальний safety
 safety = SafetyManager(SafetyConfig())
 
+# ---------------- TREND ENGINE ----------------
+# Інкрементальні індикатори для auto-режиму: EMA, лінійна регресія log-ціни за часом (нахил),
+# realized volatility. Кільцеві буфери array('d') + ковзні суми: O(1) на тік, без алокацій контейнерів.
+TREND_CAPACITY = int(os.getenv("TREND_CAPACITY", "1024"))  # макс. семплів у вікні на ринок (частіші тіки проріджуються)
+TREND_CONFIRM = int(os.getenv("TREND_CONFIRM", "3"))        # скільки тіків поспіль новий режим має підтверджуватись
+TREND_VOL_K = float(os.getenv("TREND_VOL_K", "1.0"))       # рух за вікно має перевищувати K × realized vol
+
+class TrendState:
+    __slots__ = ("window", "cap", "step", "ts", "y", "r2", "head", "n", "t0",
+                 "sx", "sy", "sxx", "sxy", "sr2", "ema", "price", "last_ts", "pushes",
+                 "regime", "pending", "streak", "switched")
+
+    def __init__(self, window: float, cap: int = TREND_CAPACITY):
+        self.window = float(window)
+        self.cap = cap
+        # мінімальний крок між семплами: cap семплів завжди покривають вікно, хоч 1 тік/хв, хоч 50 тіків/с
+        self.step = 2.0 * self.window / cap
+        self.ts = array("d", bytes(8 * cap))
+        self.y = array("d", bytes(8 * cap))    # ln(price)
+        self.r2 = array("d", bytes(8 * cap))   # квадрат лог-доходності від попереднього тіку
+        self.head = 0
+        self.n = 0
+        self.t0 = 0.0                          # початок осі x (щоб x не ріс необмежено)
+        self.sx = self.sy = self.sxx = self.sxy = self.sr2 = 0.0
+        self.ema = 0.0
+        self.price = 0.0
+        self.last_ts = 0.0
+        self.pushes = 0
+        self.regime: Optional[str] = None      # "up" | "down" | None
+        self.pending: Optional[str] = None
+        self.streak = 0
+        self.switched = False
+
+    def _pop(self):
+        h = self.head
+        x = self.ts[h] - self.t0
+        y = self.y[h]
+        self.sx -= x
+        self.sy -= y
+        self.sxx -= x * x
+        self.sxy -= x * y
+        self.head = (h + 1) % self.cap
+        self.n -= 1
+        # доходність нової «голови» посилається на вже викинутий тік — прибираємо її з суми
+        if self.n:
+            self.sr2 -= self.r2[self.head]
+
+    def _drop_last(self):
+        # останній семпл ще «свіжий» (ближче за step до попереднього) — новий тік його замінить
+        i = (self.head + self.n - 1) % self.cap
+        x = self.ts[i] - self.t0
+        y = self.y[i]
+        self.sx -= x
+        self.sy -= y
+        self.sxx -= x * x
+        self.sxy -= x * y
+        self.sr2 -= self.r2[i]
+        self.n -= 1
+
+    def _resum(self):
+        # періодичний перерахунок сум з нуля: гасить накопичену похибку float і зсуває t0
+        self.pushes = 0
+        if not self.n:
+            return
+        self.t0 = self.ts[self.head]
+        sx = sy = sxx = sxy = sr2 = 0.0
+        for k in range(self.n):
+            i = (self.head + k) % self.cap
+            x = self.ts[i] - self.t0
+            y = self.y[i]
+            sx += x
+            sy += y
+            sxx += x * x
+            sxy += x * y
+            if k:
+                sr2 += self.r2[i]
+        self.sx, self.sy, self.sxx, self.sxy, self.sr2 = sx, sy, sxx, sxy, sr2
+
+    def push(self, price: float, ts: float):
+        if price <= 0 or (self.n and ts <= self.last_ts):
+            return
+        y = math.log(price)
+        if self.n:
+            a = 1.0 - math.exp(-(ts - self.last_ts) / (self.window / 4))
+            self.ema += a * (price - self.ema)
+            if self.n > 1 and ts - self.ts[(self.head + self.n - 2) % self.cap] < self.step:
+                self._drop_last()
+            prev_y = self.y[(self.head + self.n - 1) % self.cap]
+            r = y - prev_y
+        else:
+            r = 0.0
+            self.t0 = ts
+            self.ema = price
+        edge = ts - self.window
+        while self.n and (self.n == self.cap or self.ts[self.head] < edge):
+            self._pop()
+        i = (self.head + self.n) % self.cap
+        x = ts - self.t0
+        self.ts[i] = ts
+        self.y[i] = y
+        self.r2[i] = r * r
+        self.sx += x
+        self.sy += y
+        self.sxx += x * x
+        self.sxy += x * y
+        if self.n:
+            self.sr2 += r * r
+        self.n += 1
+        self.price = price
+        self.last_ts = ts
+        self.pushes += 1
+        if self.pushes >= self.cap:
+            self._resum()
+
+    def warm(self) -> bool:
+        # рішення лише коли вікно заповнене хоча б наполовину
+        return self.n >= 3 and (self.last_ts - self.ts[self.head]) >= self.window / 2
+
+    def change_pct(self) -> Optional[float]:
+        """Зміна за охоплений вікном час за нахилом регресії ln(price) ~ t, у %."""
+        n = self.n
+        if n < 3:
+            return None
+        den = n * self.sxx - self.sx * self.sx
+        if den <= 0:
+            return None
+        slope = (n * self.sxy - self.sx * self.sy) / den
+        return math.expm1(slope * (self.last_ts - self.ts[self.head])) * 100.0
+
+    def vol_pct(self) -> float:
+        return math.sqrt(max(self.sr2, 0.0)) * 100.0
+
+    def signal(self, down_thr: float, up_thr: float) -> Optional[str]:
+        if not self.warm():
+            return None
+        chg = self.change_pct()
+        if chg is None or abs(chg) < TREND_VOL_K * self.vol_pct():
+            return None  # рух у межах шуму
+        if chg >= up_thr and self.price >= self.ema:
+            return "up"
+        if chg <= down_thr and self.price <= self.ema:
+            return "down"
+        return None
+
+class TrendEngine:
+    """Стан тренду по ринках; режим перемикається лише після TREND_CONFIRM однакових сигналів поспіль."""
+    def __init__(self):
+        self.by_pair: dict[str, TrendState] = {}
+
+    def _st(self, pair: str, window: float) -> TrendState:
+        st = self.by_pair.get(pair)
+        if st is None or st.window != window:
+            st = self.by_pair[pair] = TrendState(window)
+        return st
+
+    def update(self, pair: str, price: float, ts: float, cfg: Optional["MarketConfig"] = None) -> bool:
+        """True — щойно підтверджено новий режим. cfg — для пари, ще не доданої в markets (бекфіл /market)."""
+        if cfg is None:
+            cfg = markets.get(pair)
+        if cfg is None:
+            return False
+        st = self._st(pair, cfg.trend_window_s)
+        st.push(float(price), ts)
+        sig = st.signal(cfg.auto_down_pct, cfg.auto_up_pct)
+        if sig is None or sig == st.regime:
+            st.pending, st.streak = None, 0
+            return False
+        if sig == st.pending:
+            st.streak += 1
+        else:
+            st.pending, st.streak = sig, 1
+        if st.streak >= TREND_CONFIRM:
+            st.regime, st.pending, st.streak = sig, None, 0
+            st.switched = True
+            return True
+        return False
+
+    def regime(self, pair: str) -> Optional[str]:
+        st = self.by_pair.get(pair)
+        return st.regime if st else None
+
+    def change_pct(self, pair: str) -> Optional[float]:
+        st = self.by_pair.get(pair)
+        return st.change_pct() if st and st.warm() else None
+
+    def pop_switch(self, pair: str) -> Optional[str]:
+        """Новий підтверджений режим (один раз після кожного перемикання)."""
+        st = self.by_pair.get(pair)
+        if st and st.switched:
+            st.switched = False
+            return st.regime
+        return None
+
+trends = TrendEngine()
+
 # ---------------- JSON SAVE/LOAD ----------------
+# save_markets() лише ставить dirty-прапор; persistence_loop зливає зміни не частіше ніж раз на SAVE_INTERVAL
+SAVE_INTERVAL = float(os.getenv("SAVE_INTERVAL", "2"))
+_markets_dirty = False
+_markets_flush_lock = asyncio.Lock()
+
+def _write_file_atomic(path: str, text: str):
+    # temp-файл у тій самій теці + os.replace: після падіння лишається або старий, або новий файл
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", suffix=".json", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+def _dump_markets() -> str:
+    return json.dumps({m: cfg.to_dict() for m, cfg in markets.items()}, indent=2, ensure_ascii=False)
+
 def save_markets():
+    """Позначає markets.json як змінений; запис — у persistence_loop / flush_markets."""
+    global _markets_dirty
+    _markets_dirty = True
+
+def save_markets_now():
+    """Синхронний запис (старт, коли циклу подій ще немає)."""
+    global _markets_dirty
     try:
-        with open(MARKETS_FILE, "w", encoding="utf-8") as f:
-            json.dump(markets, f, indent=2, ensure_ascii=False)
+        _write_file_atomic(MARKETS_FILE, _dump_markets())
+        _markets_dirty = False
     except Exception as e:
         logging.error(f"Помилка збереження markets.json: {e}")
 
-def _normalize_market_cfg(cfg: dict) -> dict:
-    # гарантуємо наявність ключів для різних версій файлу
-    cfg = dict(cfg or {})
-    cfg.setdefault("tp", None)
-    cfg.setdefault("sl", None)
-    cfg.setdefault("orders", [])
-    cfg.setdefault("autotrade", False)
-    cfg.setdefault("buy_usdt", 10)
-    cfg.setdefault("chat_id", None)
-    cfg.setdefault("rebuy_pct", 0.0)
-    cfg.setdefault("last_tp_price", None)
-    # >>> нове: мікро-скальп і режими SL
-    cfg.setdefault("scalp", False)
-    cfg.setdefault("tick_pct", 0.25)
-    cfg.setdefault("levels", 3)
-    cfg.setdefault("maker_only", True)
-    cfg.setdefault("sl_mode", "trigger")   # "trigger" | "trailing"
-    cfg.setdefault("entry_price", None)
-    cfg.setdefault("peak", None)
-    cfg.setdefault("scalp_seeded_at", 0)  # ms, коли востаннє створили сітку
-    cfg.setdefault("auto_dd_pct", 3.0)  # авто-стоп при падінні від entry на N%
-    # --- режим керування профілем: manual | auto
-    cfg.setdefault("mode", "manual")  # за замовчуванням ручний режим
+async def flush_markets():
+    global _markets_dirty
+    async with _markets_flush_lock:
+        if not _markets_dirty:
+            return
+        _markets_dirty = False
+        # серіалізуємо в циклі подій (консистентний знімок), пишемо на диск — у потоці
+        text = _dump_markets()
+        try:
+            await asyncio.to_thread(_write_file_atomic, MARKETS_FILE, text)
+        except Exception as e:
+            _markets_dirty = True
+            logging.error(f"Помилка збереження markets.json: {e}")
+
+async def persistence_loop():
+    while True:
+        await asyncio.sleep(SAVE_INTERVAL)
+        await flush_markets()
+
+# ---------------- MARKET CONFIG MODEL ----------------
+PROFILE_KEYS = ("tp", "sl", "rebuy_pct", "scalp", "tick_pct", "levels")
+DEFAULT_PROFILE_DOWN = {"tp": 0.45, "sl": 2.5, "rebuy_pct": 0.0, "scalp": True, "tick_pct": 0.30, "levels": 3}
+DEFAULT_PROFILE_UP = {"tp": 0.80, "sl": 1.2, "rebuy_pct": 0.5, "scalp": True, "tick_pct": 0.25, "levels": 3}
+
+def _to_bool(v) -> bool:
+    if isinstance(v, str):
+        return v.strip().lower() in ("1", "true", "on", "yes")
+    return bool(v)
+
+def _opt(conv):
+    return lambda v: None if v is None else conv(v)
+
+def _pos_float(v) -> float:
+    f = float(v)
+    if not (f > 0 and math.isfinite(f)):
+        raise ValueError(f"{v!r} має бути > 0")
+    return f
+
+class TrackedOrders:
+    """
+    Відстежувані ордери ринку з індексом orderId -> запис:
+    пошук і видалення за O(1) замість перебудови списку. Запис — dict
+    {"id", "cid"?, "type", "market", "price"?, "amount"?, "level"?, "oco"?, "activation"?}; у markets.json зберігається списком.
+    """
+    __slots__ = ("_by_id",)
+
+    def __init__(self, entries=()):
+        self._by_id: Dict[str, dict] = {}
+        for e in entries:
+            if isinstance(e, dict):
+                self.add(e)
+
+    def add(self, entry: dict):
+        oid = entry.get("id")
+        if oid is None or oid == "":
+            return
+        oid = entry["id"] = str(oid)
+        self._by_id[oid] = entry
+
+    def get(self, oid) -> Optional[dict]:
+        return self._by_id.get(str(oid))
+
+    def pop(self, oid) -> Optional[dict]:
+        return self._by_id.pop(str(oid), None)
+
+    def ids(self):
+        return self._by_id.keys()
+
+    def clear(self):
+        self._by_id.clear()
+
+    def to_list(self) -> list:
+        return list(self._by_id.values())
+
+    def __iter__(self):
+        return iter(list(self._by_id.values()))
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __contains__(self, oid) -> bool:
+        return str(oid) in self._by_id
 
-    # --- авто-тренд: вікно та референс
-    cfg.setdefault("trend_window_s", 300)      # 5 хв для визначення напрямку
-    cfg.setdefault("trend_ref_price", None)
-    cfg.setdefault("trend_ref_ts", 0)
+    def __repr__(self) -> str:
+        return repr(self.to_list())
 
-    # --- пороги перемикання профілю (відносна зміна від ref, у %)
-    cfg.setdefault("auto_down_pct", -1.5)  # якщо ≤ цього — «падіння»
-    cfg.setdefault("auto_up_pct",    1.0)  # якщо ≥ цього — «ріст»
+def _json_num(v):
+    # 6.0 -> 6, щоб markets.json лишався таким, як його пишуть руками
+    if isinstance(v, Decimal):
+        v = float(v)
+    return int(v) if isinstance(v, float) and v.is_integer() else v
 
+@dataclass(slots=True)
+class MarketConfig:
+    """
+    Типізований конфіг ринку. Валідується один раз (load_markets / /market),
+    на гарячому шляху — доступ через атрибути. Серіалізується у ту саму схему markets.json.
+    """
+    tp: Optional[float] = None
+    sl: Optional[float] = None
+    orders: TrackedOrders = field(default_factory=TrackedOrders)
+    autotrade: bool = False
+    buy_usdt: Decimal = Decimal("10")
+    chat_id: Optional[int] = None
+    rebuy_pct: float = 0.0
+    last_tp_price: Optional[float] = None
+    # >>> мікро-скальп і режими SL
+    scalp: bool = False
+    tick_pct: float = 0.25
+    levels: int = 3
+    maker_only: bool = True
+    sl_mode: str = "trigger"               # "trigger" | "trailing"
+    sl_native: bool = False                # SL стоп-ордером на біржі (stop-limit / OCO разом з TP)
+    entry_price: Optional[float] = None
+    peak: Optional[float] = None
+    profit_floor: Optional[float] = None   # фіксація прибутку: ціна ≤ цього => вихід (піднімає trail_tp)
+    scalp_seeded_at: int = 0               # ms, коли востаннє створили сітку
+    grid_anchor: Optional[float] = None    # опорна ціна решітки скальп-сітки: рівні anchor·(1+tick)^k
+    auto_dd_pct: float = 3.0               # авто-стоп при падінні від entry на N%
+    auto_dd: bool = False                  # авто-стоп діє лише після явного /autodd (opt-in)
+    # --- режим керування профілем: manual | auto
+    mode: str = "manual"
+    # --- авто-тренд: вікно індикаторів (TrendEngine)
+    trend_window_s: int = 300              # 5 хв для визначення напрямку
+    # --- пороги перемикання профілю (зміна за вікно за нахилом регресії, у %)
+    auto_down_pct: float = -1.5            # якщо ≤ цього — «падіння»
+    auto_up_pct: float = 1.0               # якщо ≥ цього — «ріст»
     # --- профілі параметрів, які бот підставляє сам
-    # профіль для падіння
-    cfg.setdefault("profile_down", {
-        "tp": 0.45, "sl": 2.5, "rebuy_pct": 0.0,
-        "scalp": True, "tick_pct": 0.30, "levels": 3
-    })
-    # профіль для росту
-    cfg.setdefault("profile_up", {
-        "tp": 0.80, "sl": 1.2, "rebuy_pct": 0.5,
-        "scalp": True, "tick_pct": 0.25, "levels": 3
-    })
+    profile_down: dict = field(default_factory=lambda: dict(DEFAULT_PROFILE_DOWN))
+    profile_up: dict = field(default_factory=lambda: dict(DEFAULT_PROFILE_UP))
     # --- мʼякий SL і «заморозка» холдингів
-    cfg.setdefault("hold_on_sl", False)    # якщо True — при SL НЕ продаємо, а тримаємо монети
-    cfg.setdefault("holdings_lock", False) # внутрішній прапор: монети «заморожені» до ап-тренду
-    return cfg
+    hold_on_sl: bool = False               # якщо True — при SL НЕ продаємо, а тримаємо монети
+    holdings_lock: bool = False            # внутрішній прапор: монети «заморожені» до ап-тренду
+    # невідомі ключі файлу (напр. auto_payout_*) — не чіпаємо, лише зберігаємо назад
+    extra: dict = field(default_factory=dict)
+
+    # застарілі ключі файлу: референс тренду тепер живе в TrendEngine
+    _LEGACY_KEYS = ("trend_ref_price", "trend_ref_ts")
+
+    _CONVERTERS = {
+        "tp": _opt(float), "sl": _opt(float), "autotrade": _to_bool,
+        "buy_usdt": lambda v: Decimal(str(v)), "chat_id": _opt(int), "rebuy_pct": float,
+        "last_tp_price": _opt(float), "scalp": _to_bool, "tick_pct": _pos_float,
+        "levels": lambda v: max(1, int(v)), "maker_only": _to_bool, "sl_mode": lambda v: str(v).lower(),
+        "sl_native": _to_bool, "entry_price": _opt(float), "peak": _opt(float), "profit_floor": _opt(float), "scalp_seeded_at": int,
+        "grid_anchor": _opt(float),
+        "auto_dd_pct": float, "auto_dd": _to_bool, "mode": lambda v: str(v).lower(), "trend_window_s": int,
+        "auto_down_pct": float, "auto_up_pct": float,
+        "hold_on_sl": _to_bool, "holdings_lock": _to_bool,
+    }
+
+    @classmethod
+    def from_dict(cls, raw: dict, market: str = "?") -> "MarketConfig":
+        cfg = cls()
+        for key, value in (raw or {}).items():
+            if key in cls._LEGACY_KEYS:
+                continue
+            if key == "extra" or key not in cls.__dataclass_fields__:
+                cfg.extra[key] = value
+                continue
+            conv = cls._CONVERTERS.get(key)
+            try:
+                if conv is not None:
+                    value = conv(value)
+                elif key == "orders":
+                    value = TrackedOrders(value if isinstance(value, list) else ())
+                elif key.startswith("profile_"):
+                    value = dict(value) if isinstance(value, dict) else getattr(cfg, key)
+            except (TypeError, ValueError, ArithmeticError):
+                logging.warning(f"[CONFIG] {market}.{key}={value!r} некоректне — беру значення за замовчуванням")
+                continue
+            setattr(cfg, key, value)
+        if cfg.sl_mode not in ("trigger", "trailing"):
+            cfg.sl_mode = "trigger"
+        if cfg.mode not in ("manual", "auto"):
+            cfg.mode = "manual"
+        return cfg
+
+    def to_dict(self) -> dict:
+        out = {}
+        for name in self.__dataclass_fields__:
+            if name == "extra":
+                continue
+            out[name] = getattr(self, name)
+        out["buy_usdt"] = _json_num(self.buy_usdt)
+        out["orders"] = self.orders.to_list()
+        out.update(self.extra)
+        return out
+
+    def dd_pct(self) -> float:
+        """Поріг авто-стопу, якщо його увімкнено, інакше 0."""
+        return self.auto_dd_pct if self.auto_dd else 0.0
+
+    def apply_profile(self, prof: dict):
+        for k in PROFILE_KEYS:
+            if k in prof:
+                try:
+                    setattr(self, k, self._CONVERTERS[k](prof[k]))
+                except (TypeError, ValueError, ArithmeticError):
+                    logging.warning(f"[CONFIG] профіль: {k}={prof[k]!r} некоректне — пропускаю")
 
 def load_markets():
     global markets
-    if os.path.exists(MARKETS_FILE):
+    raw: Dict[str, Any] = {}
+    exists = os.path.exists(MARKETS_FILE)
+    if exists:
         try:
             with open(MARKETS_FILE, "r", encoding="utf-8") as f:
-                raw = json.load(f)
-                markets = raw if isinstance(raw, dict) else {}
+                data = json.load(f)
+                raw = data if isinstance(data, dict) else {}
         except Exception as e:
             logging.error(f"Помилка завантаження markets.json: {e}")
-            markets = {}
-    else:
-        markets = {}
-        save_markets()
-
-    # нормалізація існуючих ринків
-    dirty = False
-    for m in list(markets.keys()):
-        if isinstance(markets[m], dict):
-            new_cfg = _normalize_market_cfg(markets[m])
-            if new_cfg != markets[m]:
-                markets[m] = new_cfg
+            raw = {}
+
+    # валідація один раз на старті: далі в памʼяті лише MarketConfig
+    markets = {}
+    dirty = not exists
+    for m, cfg in raw.items():
+        if isinstance(cfg, dict):
+            markets[m] = MarketConfig.from_dict(cfg, m)
+            if markets[m].to_dict() != cfg:
                 dirty = True
         else:
-            del markets[m]
             dirty = True
     if dirty:
-        save_markets()
+        save_markets_now()
 
 # ---------------- TIME/HELPERS ----------------
 def now_ms() -> int:
@@ -245,7 +700,9 @@ def _payload_and_headers(path: str, extra_body: Optional[dict] = None) -> tuple[
       X-TXC-PAYLOAD = base64(body_bytes)
       X-TXC-SIGNATURE = hex(HMAC_SHA512(payload_b64, API_SECRET))
     """
-    body = {"request": path, "nonce": next_nonce()}
+    # nonceWindow: воркери ринків шлють підписані запити паралельно, тож порядок прибуття
+    # не гарантований — біржа приймає nonce-таймстемп у вікні ±5с замість строго зростаючого
+    body = {"request": path, "nonce": next_nonce(), "nonceWindow": True}
     if extra_body:
         body.update(extra_body)
 
@@ -261,20 +718,205 @@ def _payload_and_headers(path: str, extra_body: Optional[dict] = None) -> tuple[
     }
     return body_bytes, headers
 
+# ---------------- HTTP CLIENT (спільний пул зʼєднань) ----------------
+# Один AsyncClient на процес: keep-alive до whitebit.com замість нового TCP+TLS на кожен запит.
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP2_ENABLED = os.getenv("HTTP2", "1").lower() in ("1", "true", "on", "yes")
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+def _http2_available() -> bool:
+    # HTTP/2 в httpx потребує пакет h2 (pip install httpx[http2]) — вмикаємо лише якщо він є
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Повертає спільний клієнт; створює його ліниво, якщо main() ще не відкрив пул
+    (наприклад, хендлер спрацював раніше за старт монітора).
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        http2 = HTTP2_ENABLED and _http2_available()
+        _http_client = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+        logging.info(f"[HTTP] shared client opened (http2={http2}, max_conn={HTTP_MAX_CONNECTIONS})")
+    return _http_client
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+        logging.info("[HTTP] shared client closed")
+    _http_client = None
+
+# ---------------- RATE LIMITER / SCHEDULER ----------------
+# Пріоритети запитів (менше — важливіше): SL завжди йде раніше за посів сітки й опитування
+PRIO_CRITICAL = 0   # SL: скасування ордерів, маркет-продаж
+PRIO_TRADE = 1      # TP, ping-pong, відкуп, ручні ордери
+PRIO_NORMAL = 2     # баланс, активні ордери, тікер, статуси
+PRIO_BULK = 3       # посів скальп-сітки
+
+def _rate_env(name: str, default: str) -> tuple[float, float]:
+    # формат "запитів_за_сек/burst", напр. "10/20"
+    raw = os.getenv(name, default)
+    try:
+        rate, burst = raw.split("/")
+        return float(rate), float(burst)
+    except Exception:
+        logging.warning(f"{name}={raw!r} не розпізнано, беру {default}")
+        rate, burst = default.split("/")
+        return float(rate), float(burst)
+
+class TokenBucket:
+    """
+    Token bucket з пріоритетною чергою очікувачів.
+    Після 429 бакет блокується до Retry-After і зменшує rate (AIMD),
+    а успішні відповіді поступово повертають rate до базового.
+    """
+    MIN_RATE_FACTOR = 0.1   # нижче base_rate * factor не опускаємось
+    BACKOFF_FACTOR = 0.5    # множник rate при 429
+    RECOVER_STEP = 0.05     # частка base_rate, яку повертаємо за кожну успішну відповідь
+
+    def __init__(self, name: str, rate: float, burst: float):
+        self.name = name
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.throttled = 0              # скільки разів отримали 429
+        self._waiters: list = []        # heap: (priority, seq, future)
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, priority: int = PRIO_NORMAL):
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        self._dispatch()
+        await fut
+
+    def _dispatch(self):
+        now = time.monotonic()
+        self._refill(now)
+        while self._waiters:
+            _, _, fut = self._waiters[0]
+            if fut.done():              # очікувача скасували
+                heapq.heappop(self._waiters)
+                continue
+            if now < self.blocked_until:
+                return self._schedule(self.blocked_until - now)
+            if self.tokens < 1:
+                return self._schedule((1 - self.tokens) / self.rate)
+            self.tokens -= 1
+            heapq.heappop(self._waiters)
+            fut.set_result(None)
+
+    def _schedule(self, delay: float):
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(max(delay, 0.001), self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def penalize(self, retry_after: Optional[float]):
+        self.throttled += 1
+        now = time.monotonic()
+        self.rate = max(self.base_rate * self.MIN_RATE_FACTOR, self.rate * self.BACKOFF_FACTOR)
+        pause = retry_after if retry_after is not None else 1.0 / self.rate
+        self.blocked_until = max(self.blocked_until, now + pause)
+        self.tokens = 0.0
+        logging.warning(f"[RATE] {self.name}: 429, пауза {pause:.2f}s, rate -> {self.rate:.2f}/s")
+
+    def reward(self):
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * self.RECOVER_STEP)
+
+class RequestScheduler:
+    """Розкладає запити по класах ендпоінтів: public / trade (читання акаунта) / order (виставлення/скасування)."""
+    def __init__(self):
+        self.buckets = {
+            "public": TokenBucket("public", *_rate_env("RATE_PUBLIC", "10/20")),
+            "trade":  TokenBucket("trade",  *_rate_env("RATE_TRADE", "8/10")),
+            "order":  TokenBucket("order",  *_rate_env("RATE_ORDER", "10/10")),
+        }
+
+    @staticmethod
+    def classify(path: str) -> str:
+        if path.startswith("/api/v4/public/") or path.startswith("/api/v1/public/"):
+            return "public"
+        if path.startswith("/api/v4/order/"):
+            return "order"
+        return "trade"
+
+    def bucket(self, path: str) -> TokenBucket:
+        return self.buckets[self.classify(path)]
+
+def _retry_after(r: httpx.Response) -> Optional[float]:
+    try:
+        v = r.headers.get("Retry-After")
+        return max(0.0, float(v)) if v is not None else None
+    except Exception:
+        return None
+
+scheduler = RequestScheduler()
+
 # ---------------- HTTP (WhiteBIT v4) with retry/backoff ----------------
-async def public_get(path: str) -> dict:
+# singleflight: однакові конкурентні GET (монітор + хендлери) ділять один запит у польоті
+_inflight_public: Dict[str, asyncio.Task] = {}
+singleflight_stats: Dict[str, Dict[str, int]] = {}   # шлях без query -> {"hit": n, "miss": n}
+
+async def public_get(path: str, priority: int = PRIO_NORMAL) -> dict:
+    stats = singleflight_stats.setdefault(path.split("?", 1)[0], {"hit": 0, "miss": 0})
+    task = _inflight_public.get(path)
+    if task is None:
+        stats["miss"] += 1
+        task = asyncio.ensure_future(_public_get_uncoalesced(path, priority))
+        _inflight_public[path] = task
+
+        def _done(t: asyncio.Task, p: str = path):
+            if _inflight_public.get(p) is t:
+                del _inflight_public[p]
+        task.add_done_callback(_done)
+    else:
+        stats["hit"] += 1
+    # shield: скасування одного з очікувачів не обриває запит для решти
+    return await asyncio.shield(task)
+
+async def _public_get_uncoalesced(path: str, priority: int) -> dict:
     url = BASE_URL + path
+    bucket = scheduler.bucket(path)
     for attempt in range(3):
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                r = await client.get(url)
+            await bucket.acquire(priority)
+            r = await get_http_client().get(url)
             if r.status_code == 429:
-                await asyncio.sleep(0.5 + 0.5 * attempt)
+                bucket.penalize(_retry_after(r))
                 continue
             if r.status_code >= 500:
                 logging.warning(f"[public_get] {r.status_code} {url}")
                 await asyncio.sleep(0.3 * (attempt + 1))
                 continue
+            bucket.reward()
             try:
                 return r.json()
             except Exception:
@@ -285,25 +927,28 @@ async def public_get(path: str) -> dict:
             await asyncio.sleep(0.3 * (attempt + 1))
     return {"error": "public_get retries exceeded"}
 
-async def private_post(path: str, extra_body: Optional[dict] = None) -> dict:
-    body_bytes, headers = _payload_and_headers(path, extra_body)
+async def private_post(path: str, extra_body: Optional[dict] = None, priority: int = PRIO_NORMAL) -> dict:
     url = BASE_URL + path
+    bucket = scheduler.bucket(path)
     for attempt in range(3):
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                r = await client.post(url, headers=headers, content=body_bytes)
+            await bucket.acquire(priority)
+            # підписуємо вже після черги: nonce має зростати в порядку фактичної відправки
+            body_bytes, headers = _payload_and_headers(path, extra_body)
+            r = await get_http_client().post(url, headers=headers, content=body_bytes)
             if r.status_code == 429:
-                await asyncio.sleep(0.5 + 0.5 * attempt)
+                bucket.penalize(_retry_after(r))
                 continue
             if r.status_code >= 500:
                 logging.warning(f"[private_post] {r.status_code} {url}")
                 await asyncio.sleep(0.3 * (attempt + 1))
                 continue
+            bucket.reward()
             try:
                 data = r.json()
             except Exception:
                 logging.error(f"Помилка декодування private відповіді ({r.status_code}): {r.text}")
-                return {"error": r.text}
+                return {"error": r.text, "status": r.status_code}
             if isinstance(data, dict) and (data.get("success") is False) and "message" in data:
                 logging.error(f"WhiteBIT error: {data.get('message')}")
             return data
@@ -313,127 +958,222 @@ async def private_post(path: str, extra_body: Optional[dict] = None) -> dict:
     return {"error": "private_post retries exceeded"}
 
 # ---------------- MARKET RULES ----------------
-async def load_market_rules():
-    """
-    Завантажуємо правила ринків і кешуємо:
-      - amount/price precision (різні назви ключів підтримані)
-      - мінімальні обмеження, якщо є
-    Основний ендпоінт: /api/v4/public/markets
-    """
-    global market_rules
-
+# Правила тримаємо в market_rules.json: старт не чекає біржу, оновлення — у фоні раз на RULES_TTL.
+# Парсимо лише ринки з markets (а не всі символи біржі); нову пару /market довантажує на вимогу.
+RULES_FILE = "market_rules.json"
+RULES_TTL = float(os.getenv("RULES_TTL", str(6 * 3600)))
+RULES_RETRY = 30  # пауза перед повтором, якщо біржа не віддала правила
+_rules_fetched_at = 0.0
+_rules_retry_at: Dict[str, float] = {}
+
+def _rules_wanted() -> set:
+    return {m.upper() for m in markets}
+
+def _parse_rules(lst, wanted: Optional[set] = None) -> Dict[str, "MarketRules"]:
     def _to_dec(v):
         try:
             return Decimal(str(v))
         except Exception:
             return None
 
-    def _parse_list(lst):
-        rules = {}
-        for s in lst:
-            if not isinstance(s, dict):
-                continue
-            name = (s.get("name") or s.get("symbol") or s.get("market") or "").upper()
-            if not name:
-                continue
+    rules = {}
+    for s in lst:
+        if not isinstance(s, dict):
+            continue
+        name = (s.get("name") or s.get("symbol") or s.get("market") or "").upper()
+        if not name or (wanted is not None and name not in wanted):
+            continue
 
-            amt_prec = (
-                s.get("amount_precision")
-                or s.get("stock_precision")
-                or s.get("stockPrecision")
-                or s.get("amountPrecision")
-                or s.get("quantity_precision")
-                or s.get("quantityPrecision")
-                or s.get("stockPrec")
-            )
-            price_prec = (
-                s.get("price_precision")
-                or s.get("money_precision")
-                or s.get("moneyPrecision")
-                or s.get("pricePrecision")
-                or s.get("moneyPrec")
-            )
-            try:
-                amt_prec = int(amt_prec) if amt_prec is not None else None
-            except Exception:
-                amt_prec = None
-            try:
-                price_prec = int(price_prec) if price_prec is not None else None
-            except Exception:
-                price_prec = None
+        amt_prec = (
+            s.get("amount_precision")
+            or s.get("stock_precision")
+            or s.get("stockPrecision")
+            or s.get("amountPrecision")
+            or s.get("quantity_precision")
+            or s.get("quantityPrecision")
+            or s.get("stockPrec")
+        )
+        price_prec = (
+            s.get("price_precision")
+            or s.get("money_precision")
+            or s.get("moneyPrecision")
+            or s.get("pricePrecision")
+            or s.get("moneyPrec")
+        )
+        try:
+            amt_prec = int(amt_prec) if amt_prec is not None else None
+        except Exception:
+            amt_prec = None
+        try:
+            price_prec = int(price_prec) if price_prec is not None else None
+        except Exception:
+            price_prec = None
 
-            min_amount = s.get("min_amount") or s.get("minAmount")
-            min_total  = s.get("min_total")  or s.get("minTotal") or s.get("min_value") or s.get("minValue")
+        min_amount = s.get("min_amount") or s.get("minAmount")
+        min_total  = s.get("min_total")  or s.get("minTotal") or s.get("min_value") or s.get("minValue")
 
-            rules[name] = {
-                "amount_precision": amt_prec if amt_prec is not None else 6,
-                "price_precision":  price_prec if price_prec is not None else 6,
-                "min_amount": _to_dec(min_amount),
-                "min_total":  _to_dec(min_total),
-            }
-        return rules
+        rules[name] = MarketRules.compile(
+            amt_prec if amt_prec is not None else 6,
+            price_prec if price_prec is not None else 6,
+            _to_dec(min_amount),
+            _to_dec(min_total),
+        )
+    return rules
 
+async def fetch_market_rules(wanted: Optional[set] = None) -> Optional[Dict[str, "MarketRules"]]:
+    """
+    Тягнемо правила з біржі (лише для wanted, якщо задано):
+      - amount/price precision (різні назви ключів підтримані)
+      - мінімальні обмеження, якщо є
+    Основний ендпоінт: /api/v4/public/markets, запасний — /api/v4/public/symbols.
+    None — якщо біржа не відповіла придатним списком.
+    """
     try:
         data = await public_get("/api/v4/public/markets")
         if isinstance(data, list) and data:
-            market_rules = _parse_list(data)
-            logging.info(f"Loaded market rules from /markets for {len(market_rules)} symbols")
-            return
+            return _parse_rules(data, wanted)
 
         alt = await public_get("/api/v4/public/symbols")
         if isinstance(alt, list) and alt:
-            market_rules = _parse_list(alt)
-            logging.info(f"Loaded market rules from /symbols for {len(market_rules)} symbols")
-            return
+            return _parse_rules(alt, wanted)
 
         logging.warning(f"Rules fetch returned unexpected payloads: /markets={type(data)}, /symbols={type(alt)}")
     except Exception as e:
-        logging.error(f"load_market_rules error: {e}")
+        logging.error(f"fetch_market_rules error: {e}")
+    return None
+
+def load_rules_cache() -> float:
+    """Читає market_rules.json у market_rules. Повертає вік кешу в секундах (inf — кешу немає)."""
+    global _rules_fetched_at
+    if not os.path.exists(RULES_FILE):
+        return float("inf")
+    try:
+        with open(RULES_FILE, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        for name, r in (raw.get("rules") or {}).items():
+            market_rules[name.upper()] = MarketRules.from_dict(r)
+        _rules_fetched_at = float(raw.get("fetched_at") or 0)
+    except Exception as e:
+        logging.error(f"Помилка читання {RULES_FILE}: {e}")
+        return float("inf")
+    age = max(0.0, time.time() - _rules_fetched_at)
+    logging.info(f"Loaded market rules from {RULES_FILE} for {len(market_rules)} symbols (age {age:.0f}s)")
+    return age
+
+async def save_rules_cache():
+    text = json.dumps(
+        {"fetched_at": _rules_fetched_at, "rules": {n: r.to_dict() for n, r in market_rules.items()}},
+        indent=2, ensure_ascii=False,
+    )
+    try:
+        await asyncio.to_thread(_write_file_atomic, RULES_FILE, text)
+    except Exception as e:
+        logging.error(f"Помилка збереження {RULES_FILE}: {e}")
+
+async def refresh_market_rules() -> bool:
+    """Оновлює правила для всіх налаштованих ринків і переписує кеш."""
+    global market_rules, _rules_fetched_at
+    wanted = _rules_wanted()
+    if not wanted:
+        return True
+    fresh = await fetch_market_rules(wanted)
+    if fresh is None:
+        return False
+    # ринки, яких біржа цього разу не віддала, лишаємо з кешу
+    market_rules = {**{n: r for n, r in market_rules.items() if n in wanted}, **fresh}
+    _rules_fetched_at = time.time()
+    await save_rules_cache()
+    logging.info(f"Market rules refreshed for {len(fresh)}/{len(wanted)} markets")
+    return True
+
+async def ensure_market_rules(market: str) -> bool:
+    """Правила ринку є в кеші або довантажені з біржі (для щойно доданої пари)."""
+    name = market.upper()
+    if name in market_rules:
+        return True
+    if time.monotonic() < _rules_retry_at.get(name, 0.0):
+        return False
+    fresh = await fetch_market_rules({name})
+    if not fresh or name not in fresh:
+        _rules_retry_at[name] = time.monotonic() + RULES_RETRY
+        logging.warning(f"[RULES] Немає правил для {name}, повтор через {RULES_RETRY}s")
+        return False
+    _rules_retry_at.pop(name, None)
+    market_rules[name] = fresh[name]
+    await save_rules_cache()
+    return True
+
+async def rules_refresh_loop(age: float):
+    delay = max(0.0, RULES_TTL - age)
+    while True:
+        await asyncio.sleep(delay)
+        delay = RULES_TTL if await refresh_market_rules() else RULES_RETRY
 
 # ---------------- PRECISION HELPERS ----------------
-def get_rules(market: str) -> Dict[str, Any]:
-    m = market.upper()
-    r = market_rules.get(m, {})
-    return {
-        "amount_precision": r.get("amount_precision", 6),
-        "price_precision":  r.get("price_precision", 6),
-        "min_amount":       r.get("min_amount"),
-        "min_total":        r.get("min_total"),
-    }
+def _dec(x) -> Decimal:
+    # швидкий шлях для Decimal; float/int/str — через str(), щоб не тягнути двійкові хвости float
+    return x if type(x) is Decimal else Decimal(str(x))
+
+@dataclass(frozen=True, slots=True)
+class MarketRules:
+    """Скомпільовані правила ринку: кроки й мінімалки пораховані один раз при завантаженні."""
+    amount_precision: int
+    price_precision: int
+    min_amount: Optional[Decimal]
+    min_total: Optional[Decimal]
+    amount_step: Decimal
+    price_step: Decimal
+
+    @classmethod
+    def compile(cls, amount_precision: int, price_precision: int,
+                min_amount: Optional[Decimal] = None, min_total: Optional[Decimal] = None) -> "MarketRules":
+        return cls(
+            amount_precision=int(amount_precision),
+            price_precision=int(price_precision),
+            min_amount=min_amount,
+            min_total=min_total,
+            amount_step=step_from_precision(amount_precision),
+            price_step=step_from_precision(price_precision),
+        )
 
-def step_from_precision(prec: int) -> Decimal:
-    return Decimal(1) / (Decimal(10) ** int(prec))
+    @classmethod
+    def from_dict(cls, d: dict) -> "MarketRules":
+        return cls.compile(d["amount_precision"], d["price_precision"],
+                           _opt(Decimal)(d.get("min_amount")), _opt(Decimal)(d.get("min_total")))
+
+    def to_dict(self) -> dict:
+        return {
+            "amount_precision": self.amount_precision,
+            "price_precision": self.price_precision,
+            "min_amount": None if self.min_amount is None else str(self.min_amount),
+            "min_total": None if self.min_total is None else str(self.min_total),
+        }
 
-def quote_step_from_rules(market: str) -> Decimal:
-    """
-    Крок для суми у QUOTE. На WhiteBIT зазвичай money_precision == price_precision,
-    але виділяємо окремо для ясності і можливих майбутніх змін.
-    """
-    rules = get_rules(market)
-    return step_from_precision(rules["price_precision"])
+    def q_amount(self, x) -> Decimal:
+        return _dec(x).quantize(self.amount_step, rounding=ROUND_DOWN)
 
-def ceil_to_step(x: Decimal, step: Decimal) -> Decimal:
-    """
-    Підняти число x до найближчого кратного step (CEIL).
-    Використовується, коли треба довести amount/total до біржового мінімуму.
-    """
-    x = Decimal(str(x))
-    if step <= 0:
-        return x
-    units = (x / step).to_integral_value(rounding=ROUND_UP)
-    return units * step
+    def q_price(self, x) -> Decimal:
+        return _dec(x).quantize(self.price_step, rounding=ROUND_DOWN)
 
-def quantize_amount(market: str, amount: float) -> Decimal:
-    rules = get_rules(market)
-    step = step_from_precision(rules["amount_precision"])
-    return (Decimal(str(amount)) // step) * step
+    def ceil_amount(self, x) -> Decimal:
+        return _dec(x).quantize(self.amount_step, rounding=ROUND_UP)
 
-def quantize_price(market: str, price: float) -> Decimal:
-    rules = get_rules(market)
-    step = step_from_precision(rules["price_precision"])
-    return (Decimal(str(price)) // step) * step
+    def ceil_quote(self, x) -> Decimal:
+        # На WhiteBIT money_precision == price_precision, тож сума в QUOTE має той самий крок
+        return _dec(x).quantize(self.price_step, rounding=ROUND_UP)
+
+def step_from_precision(prec: int) -> Decimal:
+    return Decimal(1).scaleb(-int(prec))
+
+DEFAULT_RULES = MarketRules.compile(6, 6)
+
+def get_rules(market: str) -> MarketRules:
+    return market_rules.get(market) or market_rules.get(market.upper()) or DEFAULT_RULES
 
-def ensure_minima_for_order(market: str, side: str, price: Optional[float],
+def quantize_price(market: str, price) -> Decimal:
+    return get_rules(market).q_price(price)
+
+def ensure_minima_for_order(market: str, side: str, price: Optional[Decimal],
                             amount_base: Optional[Decimal], amount_quote: Optional[Decimal]):
     """
     Повертає (amount_base, amount_quote) з урахуванням мінімалок:
@@ -445,11 +1185,8 @@ def ensure_minima_for_order(market: str, side: str, price: Optional[float],
     MARKET SELL -> застосовуємо лише min_amount.
     """
     rules = get_rules(market)
-    min_amount = rules.get("min_amount")  # Decimal | None
-    min_total  = rules.get("min_total")   # Decimal | None
-
-    ap = step_from_precision(rules["amount_precision"])
-    pp = step_from_precision(rules["price_precision"])
+    min_amount = rules.min_amount  # Decimal | None
+    min_total  = rules.min_total   # Decimal | None
 
     side_l = (side or "").lower()
 
@@ -457,9 +1194,9 @@ def ensure_minima_for_order(market: str, side: str, price: Optional[float],
     if side_l == "buy" and price is None:
         if amount_quote is not None and min_total:
             if amount_quote < min_total:
-                adj = ceil_to_step(min_total * Decimal("1.001"), pp)
+                adj = rules.ceil_quote(min_total * Decimal("1.001"))
                 if adj <= 0:
-                    adj = pp
+                    adj = rules.price_step
                 amount_quote = adj
         return (amount_base, amount_quote)
 
@@ -467,87 +1204,287 @@ def ensure_minima_for_order(market: str, side: str, price: Optional[float],
     if side_l == "sell" and price is None and amount_base is not None:
         if min_amount and amount_base < min_amount:
             logging.info(f"[MIN AMOUNT] {market}: amount {amount_base} < {min_amount}, піднімаю.")
-            amount_base = ceil_to_step(min_amount, ap)
+            amount_base = rules.ceil_amount(min_amount)
         return (amount_base, amount_quote)
 
     # SELL або LIMIT BUY (price відома): перевіряємо min_amount і min_total (тільки CEIL!)
     if price and amount_base is not None:
-        price_dec = Decimal(str(price))
+        price_dec = _dec(price)
         if min_amount and amount_base < min_amount:
-            amount_base = ceil_to_step(min_amount, ap)
+            amount_base = rules.ceil_amount(min_amount)
 
         if min_total:
             total = price_dec * amount_base
             if total < min_total:
                 need_base = min_total / price_dec
-                need_base = ceil_to_step(need_base, ap)
+                need_base = rules.ceil_amount(need_base)
                 if need_base > amount_base:
                     amount_base = need_base
 
     return (amount_base, amount_quote)
 
+# ---------------- BALANCE LEDGER ----------------
+BALANCE_TTL = float(os.getenv("BALANCE_TTL", "5"))  # сек, скільки довіряємо знімку балансу
+
+class BalanceLedger:
+    """
+    Кеш /trade-account/balance з коротким TTL.
+    Інвалідовується при маркет-ордерах, скасуваннях і детекті заповнень;
+    лімітні ордери оновлюють знімок на місці (available -> freeze), без повторного запиту.
+    Поки живий приватний WS (streaming), знімок не старіє: balanceSpot_update оновлює його на місці.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.data: Dict[str, Dict[str, Any]] = {}
+        self.fetched_at = 0.0           # time.monotonic(); 0 => знімок недійсний
+        self.streaming = False
+        self._lock = asyncio.Lock()
+
+    def fresh(self) -> bool:
+        return self.fetched_at > 0 and (self.streaming or (time.monotonic() - self.fetched_at) < self.ttl)
+
+    def apply_update(self, update: dict):
+        """balanceSpot_update: {"USDT": {"available": "...", "freeze": "..."}, ...}"""
+        for asset, entry in update.items():
+            if isinstance(entry, dict):
+                self.data[str(asset).upper()] = entry
+        capital.sync(update, time.monotonic())
+
+    def invalidate(self):
+        self.fetched_at = 0.0
+
+    async def get(self, force: bool = False, priority: int = PRIO_NORMAL) -> dict:
+        if not force and self.fresh():
+            return self.data
+        async with self._lock:
+            if not force and self.fresh():
+                return self.data
+            started = time.monotonic()
+            data = await private_post("/api/v4/trade-account/balance", priority=priority)
+            if isinstance(data, dict) and data and "error" not in data and data.get("success") is not False:
+                self.data = data
+                self.fetched_at = time.monotonic()
+                capital.sync(data, started, prune=True)
+                return self.data
+            logging.warning(f"[BALANCE] fetch failed: {str(data)[:200]}")
+            return {}
+
+    def available(self, asset: str) -> Decimal:
+        try:
+            return Decimal(str((self.data.get(asset) or {}).get("available", "0")))
+        except Exception:
+            return Decimal("0")
+
+    def total(self, asset: str) -> Decimal:
+        """available + freeze: скільки буде вільно після скасування всіх ордерів на цей актив."""
+        entry = self.data.get(asset) or {}
+        try:
+            return Decimal(str(entry.get("available", "0"))) + Decimal(str(entry.get("freeze", "0")))
+        except Exception:
+            return Decimal("0")
+
+    def note_limit_order(self, market: str, side: str, price: Decimal, amount: Decimal):
+        """Переносимо кошти під новий лімітний ордер з available у freeze (якщо знімок є)."""
+        if not self.fresh():
+            return
+        base, _, quote = market.upper().partition("_")
+        asset, need = (quote, price * amount) if side.lower() == "buy" else (base, amount)
+        entry = self.data.get(asset)
+        if not isinstance(entry, dict):
+            return
+        try:
+            av = Decimal(str(entry.get("available", "0")))
+            fr = Decimal(str(entry.get("freeze", "0")))
+        except Exception:
+            self.invalidate()
+            return
+        take = min(av, need)
+        self.data[asset] = {**entry, "available": str(av - take), "freeze": str(fr + take)}
+
+balances = BalanceLedger(BALANCE_TTL)
+
+# ---------------- CAPITAL LEDGER (резерви USDT) ----------------
+# Усі ринки купують з одного гаманця. Без спільного обліку два воркери бачать «USDT вистачає»
+# в одному знімку, і один ордер біржа відхиляє — зайвий запит і втрачений тік.
+CAPITAL_ASSET = os.getenv("CAPITAL_ASSET", "USDT")
+CAPITAL_SYNC_SEC = float(os.getenv("CAPITAL_SYNC_SEC", "30"))  # звірка з балансом біржі (REST-режим) не рідше
+
+class CapitalLedger:
+    """
+    Локальний облік вільної quote-валюти на всі ринки.
+    cash — available з останнього знімка балансу мінус резерви, взяті після нього.
+    Резерв береться під кожен BUY перед відправкою (перевірка й списання — один синхронний крок, без await),
+    привʼязується до orderId після відповіді і знімається при скасуванні (кошти повертаються) або виконанні.
+    «Чи вистачить?» — free()/reserve() без запиту до біржі; свіжий знімок (REST або balanceSpot_update)
+    переписує cash, тож похибки обліку не накопичуються.
+    """
+    def __init__(self, asset: str):
+        self.asset = asset
+        self.cash: Optional[Decimal] = None      # None — ще не було жодного знімка
+        self.synced_at = 0.0                     # time.monotonic() останньої звірки
+        self.holds: Dict[str, list] = {}         # key -> [market, amount, placed_at | None (запит ще летить)]
+        self._seq = itertools.count(1)
+
+    def tracks(self, market: str) -> bool:
+        return market.upper().partition("_")[2] == self.asset
+
+    def sync(self, snapshot: dict, started: float, prune: bool = False):
+        """
+        Звірка зі знімком балансу, запитаним у момент started.
+        Резерви, що ще летять або поставлені після started, у знімку можуть не відбитися — віднімаємо їх.
+        prune: повний REST-знімок — забуваємо резерви ордерів, яких уже немає серед відкритих.
+        """
+        entry = snapshot.get(self.asset)
+        if not isinstance(entry, dict):
+            return
+        try:
+            av = Decimal(str(entry.get("available", "0")))
+        except Exception:
+            return
+        if prune and open_orders.ok:
+            for key, (market, _, placed_at) in list(self.holds.items()):
+                if placed_at is not None and placed_at < started and key not in open_orders.ids(market):
+                    self.holds.pop(key)
+        self.cash = av - sum((amt for _, amt, placed_at in self.holds.values()
+                              if placed_at is None or placed_at >= started), Decimal(0))
+        self.synced_at = time.monotonic()
+
+    async def ensure(self, priority: int = PRIO_NORMAL):
+        """Знімок потрібен лише на старті і раз на CAPITAL_SYNC_SEC без приватного WS."""
+        if self.cash is None or (not balances.streaming and time.monotonic() - self.synced_at > CAPITAL_SYNC_SEC):
+            await balances.get(priority=priority)  # без force: паралельні воркери ділять один запит
+
+    def free(self) -> Decimal:
+        return max(self.cash or Decimal(0), Decimal(0))
+
+    def reserved(self) -> Decimal:
+        return sum((amt for _, amt, _ in self.holds.values()), Decimal(0))
+
+    def reserve(self, market: str, amount: Decimal) -> Optional[str]:
+        """Тимчасовий резерв під запит, що йде на біржу; None — коштів не вистачає."""
+        if self.cash is None or amount > self.cash:
+            return None
+        self.cash -= amount
+        key = f"pending-{next(self._seq)}"
+        self.holds[key] = [market, amount, None]
+        return key
+
+    def bind(self, key: str, order_id) -> None:
+        """Ордер став на книгу: резерв живе під його orderId до скасування/виконання."""
+        hold = self.holds.pop(key, None)
+        if hold is not None:
+            self.holds[str(order_id)] = [hold[0], hold[1], time.monotonic()]
+
+    def close(self, key, spent: Optional[Decimal] = None) -> None:
+        """
+        Знімає резерв. spent — скільки з нього реально витрачено (виконана частина);
+        решта повертається у вільні. spent=None — виконано повністю.
+        """
+        hold = self.holds.pop(str(key), None)
+        if hold is not None and self.cash is not None:
+            amount = hold[1]
+            self.cash += max(amount - (amount if spent is None else spent), Decimal(0))
+
+    def close_market(self, market: str) -> None:
+        for key in [k for k, h in self.holds.items() if h[0] == market and h[2] is not None]:
+            self.close(key, Decimal(0))
+
+    def rebind(self, old_id, new_id, amount: Decimal) -> None:
+        """amend: ордер переїхав (можливо, з новим id і сумою) — резерв за ним, різниця списується/повертається."""
+        hold = self.holds.pop(str(old_id), None)
+        if hold is None:
+            return
+        if self.cash is not None:
+            self.cash -= amount - hold[1]
+        self.holds[str(new_id)] = [hold[0], amount, time.monotonic()]
+
+capital = CapitalLedger(CAPITAL_ASSET)
+
 # ---------------- WHITEBIT API WRAPPERS ----------------
-async def get_balance() -> dict:
-    data = await private_post("/api/v4/trade-account/balance")
-    logging.info(f"DEBUG balance: {data}")
-    return data if isinstance(data, dict) else {}
+async def get_balance(fresh: bool = False, priority: int = PRIO_NORMAL) -> dict:
+    return await balances.get(force=fresh, priority=priority)
 
-async def place_market_order(market: str, side: str, amount: float) -> dict:
+async def place_market_order(market: str, side: str, amount, priority: int = PRIO_TRADE) -> dict:
     """
     BUY  -> amount = сума у QUOTE (USDT)
     SELL -> amount = кількість у BASE
     Підганяємо під прецизійність біржі + мінімальні ліміти.
     """
     body = {"market": market, "side": side, "type": "market"}
+    rules = get_rules(market)
 
     if side.lower() == "buy":
-        quote_step = quote_step_from_rules(market)
-        q_amount = (Decimal(str(amount)) // quote_step) * quote_step
+        q_amount = rules.q_price(amount)   # крок QUOTE == крок ціни
         if q_amount <= 0:
-            q_amount = quote_step
+            q_amount = rules.price_step
 
         # Перевіряємо мінімальне min_total
         _, q_amount = ensure_minima_for_order(market, "buy", price=None,
                                               amount_base=None, amount_quote=q_amount)
-        body["amount"] = float(q_amount)
+        body["amount"] = format(q_amount, "f")
 
     else:
-        a = quantize_amount(market, amount)
+        a = rules.q_amount(amount)
         if a <= 0:
-            a = step_from_precision(get_rules(market)["amount_precision"])
+            a = rules.amount_step
 
         # Перевіряємо мінімальне min_amount
         a, _ = ensure_minima_for_order(market, "sell", price=None,
                                        amount_base=a, amount_quote=None)
-        body["amount"] = float(a)
+        body["amount"] = format(a, "f")
+
+    hold = None
+    if side.lower() == "buy" and capital.tracks(market):
+        await capital.ensure(priority=priority)
+        hold = capital.reserve(market, q_amount)
+        if hold is None:
+            return _no_funds(q_amount)
 
     logging.info(
         f"[DEBUG] market={market} side={side} amount={body['amount']} "
         f"({'quote' if side.lower()=='buy' else 'base'})"
     )
-    return await private_post("/api/v4/order/market", body)
-
-async def place_limit_order(
-    market: str, side: str, price: float, amount: float,
-    client_order_id: Optional[str] = None, post_only: Optional[bool] = None,
-    stp: Optional[str] = None
-) -> dict:
-    p = quantize_price(market, price)
-    a = quantize_amount(market, amount)
+    res = await private_post("/api/v4/order/market", body, priority=priority)
+    balances.invalidate()  # маркет-ордер змінює баланс на невідому наперед суму
+    if hold is not None:
+        if _api_failed(res) or not _order_id_of(res):
+            capital.close(hold, Decimal(0))
+        else:
+            spent = _dec(res.get("dealMoney") or 0)
+            capital.close(hold, spent if spent > 0 else None)
+    return res
+
+def _no_funds(need: Decimal) -> dict:
+    # відмова без запиту: біржа однаково відхилила б ордер
+    return {"success": False, "message": f"недостатньо {CAPITAL_ASSET}: треба {need}, вільно {capital.free()}"}
+
+async def _reserve_buy(body: dict, priority: int) -> tuple:
+    """Резерв USDT під лімітний BUY. (потрібно резервувати?, ключ резерву | None — не вистачає)."""
+    if body["side"] != "buy" or not capital.tracks(body["market"]):
+        return False, None
+    await capital.ensure(priority=priority)
+    return True, capital.reserve(body["market"], Decimal(body["price"]) * Decimal(body["amount"]))
+
+def _limit_order_body(market: str, side: str, price, amount,
+                      client_order_id: Optional[str] = None, post_only: Optional[bool] = None) -> dict:
+    rules = get_rules(market)
+    p = rules.q_price(price)
+    a = rules.q_amount(amount)
     if a <= 0:
-        a = step_from_precision(get_rules(market)["amount_precision"])
+        a = rules.amount_step
     if p <= 0:
-        p = step_from_precision(get_rules(market)["price_precision"])
+        p = rules.price_step
 
     # CEIL-мінімалки для лімітів
-    a, _ = ensure_minima_for_order(market, side, price=float(p),
+    a, _ = ensure_minima_for_order(market, side, price=p,
                                    amount_base=a, amount_quote=None)
 
+    # Decimal -> рядок без експоненти: біржа приймає числа рядками, без float-артефактів
     body = {
         "market": market,
         "side": side,
-        "amount": float(a),
-        "price": float(p),
+        "amount": format(a, "f"),
+        "price": format(p, "f"),
         "type": "limit",
     }
     if client_order_id:
@@ -555,102 +1492,1250 @@ async def place_limit_order(
     if post_only is not None:
         body["postOnly"] = bool(post_only)
     # STP вимикаємо: на WhiteBIT v4 часто не підтримується і дає 400
-    # if stp:
-    #     body["stp"] = stp
+    return body
+
+def _note_limit_placed(body: dict, res: dict, hold: Optional[str] = None):
+    if isinstance(res, dict) and (res.get("orderId") or res.get("id")):
+        balances.note_limit_order(body["market"], body["side"],
+                                  Decimal(body["price"]), Decimal(body["amount"]))
+        open_orders.upsert({"market": body["market"], **res})
+        open_orders.invalidate()
+        if hold is not None:
+            capital.bind(hold, res.get("orderId") or res.get("id"))
+    elif hold is not None:
+        capital.close(hold, Decimal(0))  # ордер не став — резерв повертається
+
+async def place_limit_order(
+    market: str, side: str, price: Decimal, amount: Decimal,
+    client_order_id: Optional[str] = None, post_only: Optional[bool] = None,
+    stp: Optional[str] = None, priority: int = PRIO_TRADE
+) -> dict:
+    body = _limit_order_body(market, side, price, amount, client_order_id, post_only)
+    needed, hold = await _reserve_buy(body, priority)
+    if needed and hold is None:
+        return _no_funds(Decimal(body["price"]) * Decimal(body["amount"]))
+    res = await private_post("/api/v4/order/new", body, priority=priority)
+    _note_limit_placed(body, res, hold)
+    return res
+
+# ---------------- BULK LIMIT ORDERS ----------------
+BULK_ORDERS_MAX = 20                                  # ліміт WhiteBIT на один /order/bulk
+GRID_PARALLEL = int(os.getenv("GRID_PARALLEL", "4"))  # паралельність фолбеку поштучними ордерами
+
+def _bulk_item_result(item) -> dict:
+    # елемент відповіді /order/bulk: {"result": {...}|null, "error": {...}|null} або одразу ордер
+    if isinstance(item, dict):
+        if item.get("result"):
+            return item["result"]
+        if item.get("orderId") or item.get("id"):
+            return item
+        return {"success": False, "message": item.get("error") or item}
+    return {"success": False, "message": item}
+
+async def place_limit_orders_bulk(specs: list, priority: int = PRIO_TRADE) -> list:
+    """
+    Виставляє пачку лімітних ордерів через /api/v4/order/bulk (по BULK_ORDERS_MAX за запит).
+    specs: [{"market", "side", "price", "amount", "client_order_id"?, "post_only"?}, ...]
+    Повертає відповіді в тому ж порядку, що й specs.
+    Якщо біржа однозначно відхилила bulk — фолбек на паралельні поштучні /order/new (≤ GRID_PARALLEL).
+    Після збою транспорту пачка могла стати: поштучно доставляємо лише ті, чийого clientOrderId немає серед відкритих.
+    BUY, на які не вистачає вільних USDT (capital), на біржу не йдуть — у відповіді одразу помилка.
+    """
+    bodies = [
+        _limit_order_body(sp["market"], sp["side"], sp["price"], sp["amount"],
+                          sp.get("client_order_id"), sp.get("post_only"))
+        for sp in specs
+    ]
+    results: list = [None] * len(bodies)
+    holds: list = [None] * len(bodies)
+    send: list = []
+    for i, body in enumerate(bodies):
+        needed, holds[i] = await _reserve_buy(body, priority)
+        if needed and holds[i] is None:
+            results[i] = _no_funds(Decimal(body["price"]) * Decimal(body["amount"]))
+        else:
+            send.append(i)
+    fallback: list = []
+    unknown: list = []
+    for start in range(0, len(send), BULK_ORDERS_MAX):
+        idx = send[start:start + BULK_ORDERS_MAX]
+        chunk = [bodies[i] for i in idx]
+        data = await private_post("/api/v4/order/bulk", {"orders": chunk, "stopOnFail": False}, priority=priority)
+        if isinstance(data, list) and len(data) == len(chunk):
+            for i, item in zip(idx, data):
+                results[i] = _bulk_item_result(item)
+        elif _endpoint_missing(data) or (isinstance(data, dict) and "error" not in data and _api_failed(data)):
+            # біржа однозначно не прийняла запит (ендпоінта немає або помилка на весь bulk) — ставимо поштучно
+            logging.warning(f"[BULK] /order/bulk відхилено, фолбек поштучно: {str(data)[:200]}")
+            fallback.extend(idx)
+        else:
+            # таймаут/5xx/дивна відповідь: пачка могла стати — спершу звіряємо з відкритими ордерами
+            logging.warning(f"[BULK] невідомий результат /order/bulk, звіряю по clientOrderId: {str(data)[:200]}")
+            unknown.extend(idx)
+
+    if unknown:
+        placed: Dict[str, dict] = {}
+        if await open_orders.refresh(force=True):
+            for m in {bodies[i]["market"] for i in unknown}:
+                for o in open_orders.orders(m):
+                    if o.get("clientOrderId"):
+                        placed[str(o["clientOrderId"])] = o
+        for i in unknown:
+            cid = bodies[i].get("clientOrderId")
+            if cid and cid in placed:
+                results[i] = placed[cid]
+            elif cid and open_orders.ok:
+                fallback.append(i)  # на книзі його немає — bulk не пройшов
+            else:
+                # без clientOrderId або знімка не перевірити — повтор міг би задвоїти ордер
+                results[i] = {"success": False, "message": "bulk: невідомий результат, повтор пропущено"}
+
+    if fallback:
+        sem = asyncio.Semaphore(GRID_PARALLEL)
+
+        async def _one(i: int):
+            async with sem:
+                results[i] = await private_post("/api/v4/order/new", bodies[i], priority=priority)
+
+        await asyncio.gather(*(_one(i) for i in fallback))
+
+    for i in send:
+        _note_limit_placed(bodies[i], results[i], holds[i])
+    return results
+
+# ---------------- STOP-LIMIT / OCO (SL на боці біржі) ----------------
+def _stop_order_body(market: str, side: str, amount, activation, stop_price) -> dict:
+    rules = get_rules(market)
+    a, _ = ensure_minima_for_order(market, side, price=rules.q_price(stop_price),
+                                   amount_base=rules.q_amount(amount), amount_quote=None)
+    return {
+        "market": market,
+        "side": side,
+        "amount": format(a, "f"),
+        "activation_price": format(rules.q_price(activation), "f"),
+    }
+
+async def place_stop_limit_order(market: str, side: str, amount, activation, stop_price,
+                                 client_order_id: Optional[str] = None, priority: int = PRIO_TRADE) -> dict:
+    """Stop-limit: біржа сама виставить ліміт stop_price, коли ціна торкнеться activation."""
+    body = _stop_order_body(market, side, amount, activation, stop_price)
+    body["price"] = format(get_rules(market).q_price(stop_price), "f")
+    if client_order_id:
+        body["clientOrderId"] = str(client_order_id)
+    res = await private_post("/api/v4/order/stop_limit", body, priority=priority)
+    if isinstance(res, dict) and _extract_order_id(res):
+        open_orders.upsert({"market": market, **res})
+        open_orders.invalidate()
+    return res
+
+async def place_oco_order(market: str, side: str, amount, price, activation, stop_price,
+                          client_order_id: Optional[str] = None, priority: int = PRIO_TRADE) -> dict:
+    """
+    OCO: лімітний TP (price) + stop-limit SL (activation -> stop_price) на ту саму кількість;
+    виконання однієї ноги біржа скасовує іншу.
+    """
+    body = _stop_order_body(market, side, amount, activation, stop_price)
+    body["price"] = format(get_rules(market).q_price(price), "f")
+    body["stop_limit_price"] = format(get_rules(market).q_price(stop_price), "f")
+    if client_order_id:
+        body["clientOrderId"] = str(client_order_id)
+    res = await private_post("/api/v4/order/oco", body, priority=priority)
+    if isinstance(res, dict):
+        for leg in (res.get("take_profit"), res.get("stop_loss")):
+            if isinstance(leg, dict) and _order_id_of(leg):
+                open_orders.upsert({"market": market, **leg})
+        open_orders.invalidate()
+    return res
+
+async def cancel_oco_order(market: str, oco_id, priority: int = PRIO_TRADE) -> dict:
+    res = await private_post("/api/v4/order/oco-cancel", {"market": market, "orderId": str(oco_id)},
+                             priority=priority)
+    balances.invalidate()
+    return res
+
+def _normalize_orders_payload(d) -> Optional[list]:
+    if isinstance(d, list):
+        return d
+    if isinstance(d, dict):
+        lst = d.get("orders")
+        if isinstance(lst, list):
+            return lst
+        # інші поширені форми
+        rec = d.get("records")
+        if isinstance(rec, list):
+            return rec
+        for k in ("result", "data"):
+            v = d.get(k)
+            if isinstance(v, list):
+                return v
+            if isinstance(v, dict):
+                vv = v.get("data") or v.get("orders") or v.get("records")
+                if isinstance(vv, list):
+                    return vv
+    return None
+
+def _order_id_of(o: dict) -> Optional[str]:
+    oid = o.get("orderId") or o.get("id")
+    return str(oid) if oid is not None else None
+
+def _api_failed(res) -> bool:
+    # помилки WhiteBIT приходять як {"success": false, ...}, {"code", "message", "errors"} або наш {"error": ...}
+    return (not isinstance(res, dict) or res.get("success") is False or "error" in res or "errors" in res
+            or ("code" in res and "message" in res))
+
+def _endpoint_missing(res) -> bool:
+    # однозначна ознака «такого ендпоінта немає»: не-JSON 404/405. Таймаут/5xx ({"error": "...retries exceeded"})
+    # нічого не каже про долю запиту — на нього фолбек не вмикаємо
+    return isinstance(res, dict) and res.get("status") in (404, 405)
+
+# ---------------- ACTIVE ORDERS INDEX ----------------
+# Один запит /orders без фільтра ринку (з пагінацією) на тік замість запиту на кожен ринок
+ACTIVE_ORDERS_TTL = float(os.getenv("ACTIVE_ORDERS_TTL", "1.5"))
+ACTIVE_ORDERS_PAGE = 100        # максимум, який віддає WhiteBIT за сторінку
+ACTIVE_ORDERS_MAX_PAGES = 20
+
+class ActiveOrdersIndex:
+    """
+    Знімок усіх відкритих ордерів акаунта, проіндексований market -> orderId -> order.
+    ok=False означає, що останнє оновлення не вдалося і на знімок не можна покладатися
+    (інакше всі відстежувані ордери виглядали б «закритими»).
+    Поки живий приватний WS (streaming), індекс ведуть події ordersPending, а REST не потрібен.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.by_market: Dict[str, Dict[str, dict]] = {}
+        self.fetched_at = 0.0           # time.monotonic() на момент ПОЧАТКУ запиту знімка
+        self.stale_before = 0.0         # знімки, початі раніше за цей момент, вважаються застарілими
+        self.streaming = False
+        self.ok = False
+        self._lock = asyncio.Lock()
+
+    def fresh(self) -> bool:
+        if self.streaming:
+            return self.ok
+        return (self.ok and self.fetched_at >= self.stale_before
+                and (time.monotonic() - self.fetched_at) < self.ttl)
+
+    def invalidate(self):
+        # запит, що вже летить, міг не побачити щойно виставлений ордер — не довіряємо йому
+        if not self.streaming:
+            self.stale_before = time.monotonic()
+
+    def upsert(self, order: dict):
+        oid = _order_id_of(order)
+        if oid:
+            self.by_market.setdefault(str(order.get("market") or "").upper(), {})[oid] = order
+
+    async def _fetch_all(self) -> Optional[list]:
+        out: list = []
+        for page in range(ACTIVE_ORDERS_MAX_PAGES):
+            body = {"limit": ACTIVE_ORDERS_PAGE, "offset": page * ACTIVE_ORDERS_PAGE}
+            lst = _normalize_orders_payload(await private_post("/api/v4/orders", body))
+            if lst is None and page == 0:
+                # Фолбек: альтернативний ендпоінт активних ордерів
+                lst = _normalize_orders_payload(await private_post("/api/v4/order/active", body))
+            if lst is None:
+                return None
+            out.extend(lst)
+            if len(lst) < ACTIVE_ORDERS_PAGE:
+                return out
+        logging.warning(f"[ACTIVE] більше {len(out)} відкритих ордерів — обрізано на {ACTIVE_ORDERS_MAX_PAGES} сторінках")
+        return out
+
+    async def _fetch_oco(self) -> Optional[list]:
+        """Ноги OCO живуть в окремому списку /oco-orders; питаємо лише ринки з нативним SL."""
+        out: list = []
+        for market in [m for m, c in markets.items() if c.sl_native]:
+            lst = _normalize_orders_payload(await private_post(
+                "/api/v4/oco-orders", {"market": market, "limit": ACTIVE_ORDERS_PAGE, "offset": 0}))
+            if lst is None:
+                return None
+            for oco in lst:
+                if not isinstance(oco, dict):
+                    continue
+                for leg in (oco.get("take_profit"), oco.get("stop_loss")):
+                    if isinstance(leg, dict) and _order_id_of(leg):
+                        out.append({"market": market, **leg, "oco": str(oco.get("id"))})
+        return out
+
+    async def refresh(self, force: bool = False) -> bool:
+        if not force and self.fresh():
+            return True
+        async with self._lock:
+            if not force and self.fresh():
+                return True
+            started = time.monotonic()
+            lst = await self._fetch_all()
+            oco = await self._fetch_oco() if lst is not None else None
+            if oco is None:
+                lst = None
+            if lst is None:
+                logging.warning("[ACTIVE] не вдалося отримати відкриті ордери")
+                self.ok = False
+                return False
+            idx: Dict[str, Dict[str, dict]] = {}
+            for o in lst + oco:
+                if not isinstance(o, dict):
+                    continue
+                oid = _order_id_of(o)
+                if oid:
+                    idx.setdefault(str(o.get("market") or "").upper(), {})[oid] = o
+            self.by_market = idx
+            self.fetched_at = started
+            self.ok = True
+            return True
+
+    def orders(self, market: str) -> list:
+        return list(self.by_market.get(market, {}).values())
+
+    def ids(self, market: str) -> set:
+        return set(self.by_market.get(market, {}))
+
+    def discard(self, market: str, order_id: str):
+        self.by_market.get(market, {}).pop(str(order_id), None)
+
+open_orders = ActiveOrdersIndex(ACTIVE_ORDERS_TTL)
+
+async def active_orders(market: Optional[str] = None) -> dict:
+    await open_orders.refresh()
+    if market:
+        return {"orders": open_orders.orders(market)}
+    return {"orders": [o for m in open_orders.by_market.values() for o in m.values()]}
+
+async def cancel_order(market: str, order_id: Optional[str] = None, client_order_id: Optional[str] = None,
+                       priority: int = PRIO_TRADE) -> dict:
+    body = {"market": market}
+    if client_order_id:
+        body["clientOrderId"] = str(client_order_id)
+    elif order_id is not None:
+        body["orderId"] = str(order_id)
+    else:
+        return {"success": False, "message": "Потрібно вказати order_id або client_order_id"}
+    known = open_orders.by_market.get(market, {}).get(str(order_id)) or {} if order_id is not None else {}
+    res = await private_post("/api/v4/order/cancel", body, priority=priority)
+    if order_id is not None and isinstance(res, dict) and res.get("success") is not False:
+        open_orders.discard(market, order_id)
+        capital.close(order_id, _dec(res.get("dealMoney") or known.get("dealMoney") or 0))
+    balances.invalidate()  # звільнені кошти (і можливе часткове виконання) побачимо при наступному читанні
+    return res
+
+async def cancel_all_orders(market: str, priority: int = PRIO_TRADE) -> bool:
+    """
+    Знімає всі ордери ринку одним /api/v4/order/cancel/all.
+    Фолбек (ендпоінт відповів помилкою) — паралельні поштучні cancel_order по відомих ордерах (≤ GRID_PARALLEL).
+    True — біржа підтвердила скасування (у фолбеку — кожного ордера).
+    """
+    res = await private_post("/api/v4/order/cancel/all", {"market": market}, priority=priority)
+    # успіх — порожній список (або обʼєкт без ознак помилки)
+    ok = isinstance(res, list) or not _api_failed(res)
+    if not ok:
+        logging.warning(f"[CANCEL-ALL] {market}: {str(res)[:200]} — скасовую поштучно")
+        if not open_orders.ok:
+            await open_orders.refresh(force=True)
+        ids = open_orders.ids(market)
+        cfg = markets.get(market)
+        if cfg is not None:
+            ids |= {str(e["id"]) for e in cfg.orders if e.get("id")}
+        sem = asyncio.Semaphore(GRID_PARALLEL)
+
+        async def _one(oid: str) -> bool:
+            async with sem:
+                r = await cancel_order(market, order_id=oid, priority=priority)
+                return not _api_failed(r)
+
+        ok = all(await asyncio.gather(*(_one(oid) for oid in ids)))
+    open_orders.by_market.pop(market, None)
+    open_orders.invalidate()
+    balances.invalidate()
+    if ok:
+        capital.close_market(market)
+    return ok
+
+# ---------------- AMEND (зміна ціни ордера) ----------------
+ORDER_MODIFY = os.getenv("ORDER_MODIFY", "1") == "1"   # /order/modify; 0 — одразу cancel-replace
+_modify_supported = ORDER_MODIFY
+
+async def amend_order(market: str, side: str, order_id, price, amount=None,
+                      client_order_id: Optional[str] = None, priority: int = PRIO_TRADE) -> dict:
+    """
+    Переставляє лімітний ордер на нову ціну.
+    Основний шлях — один підписаний /api/v4/order/modify: ордер не зникає з книги між двома запитами.
+    Фолбек (ендпоінт недоступний) — cancel-replace: новий ордер ставимо лише після підтвердженого скасування,
+    тож двох ордерів на ту саму кількість не буде. Якщо скасування пройшло, а новий не став —
+    у відповіді {"success": False, "cancelled": True}: ордера на книзі більше немає.
+    client_order_id — для нового ордера при cancel-replace. Повертає відповідь біржі з (можливо новим) orderId.
+    """
+    global _modify_supported
+    rules = get_rules(market)
+    p = rules.q_price(price)
+    known = open_orders.by_market.get(market, {}).get(str(order_id)) or {}
+    if _modify_supported:
+        body = {"market": market, "orderId": str(order_id), "price": format(p, "f")}
+        if amount is not None:
+            body["amount"] = format(rules.q_amount(amount), "f")
+        res = await private_post("/api/v4/order/modify", body, priority=priority)
+        if not _api_failed(res):
+            new_id = _order_id_of(res) or str(order_id)
+            open_orders.discard(market, order_id)
+            open_orders.upsert({**known, "market": market, **res, "orderId": new_id, "price": body["price"]})
+            open_orders.invalidate()
+            if side == "buy":
+                balances.invalidate()  # інша ціна — інша сума у freeze
+                left = _dec(res.get("amount") or amount or known.get("left") or known.get("amount") or 0)
+                capital.rebind(order_id, new_id, p * left)
+            return {**res, "orderId": new_id}
+        if _endpoint_missing(res):
+            # 404 не JSON — ендпоінта немає на цьому акаунті: далі лише cancel-replace
+            logging.warning(f"[AMEND] /order/modify недоступний ({str(res)[:120]}) — перехід на cancel-replace")
+            _modify_supported = False
+        else:
+            # біржа відхилила саму зміну (напр. ордер уже виконано) або збій транспорту, після якого
+            # невідомо, чи зміна пройшла, — не чіпаємо, повторить наступний тік
+            return res
+
+    # ---- cancel-replace
+    left = amount if amount is not None else (known.get("left") or known.get("amount"))
+    if left is None or _dec(left) <= 0:
+        return {"success": False, "message": f"amend {order_id}: невідома кількість для cancel-replace"}
+    res = await cancel_order(market, order_id=str(order_id), priority=priority)
+    if _api_failed(res):
+        return res
+    res = await place_limit_order(market, side, p, _dec(left), client_order_id=client_order_id, priority=priority)
+    if _api_failed(res) or not _order_id_of(res):
+        logging.warning(f"[AMEND] {market}: {order_id} скасовано, але новий ордер не став: {str(res)[:200]}")
+        return {"success": False, "cancelled": True, "message": res}
+    return res
+
+# ---------------- EXECUTED DEALS (курсор історії угод) ----------------
+DEALS_FILE = "deals_cursor.json"
+DEALS_TTL = float(os.getenv("DEALS_TTL", "2"))
+DEALS_PAGE = 100
+DEALS_MAX_PAGES = 5
+DEALS_KEEP = 2000  # скільки ордерів тримаємо в агрегаті (найстаріші витісняються)
+
+def _safe_int(v) -> int:
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return 0
+
+def _deal_fill(amount, money, fee, side: Optional[str], fee_asset: Optional[str], market: str) -> Optional[dict]:
+    """
+    Реальне виконання ордера: середня ціна = money/amount, net — скільки отримано базової монети.
+    dealFee/deal_fee WhiteBIT рахує в money (QUOTE), тож обсяг зменшуємо лише тоді,
+    коли біржа явно вказала комісію в BASE (feeAsset з історії угод).
+    """
+    amount, money, fee = _dec(amount), _dec(money), _dec(fee)
+    if amount <= 0 or money <= 0:
+        return None
+    net = amount
+    if side == "buy" and fee_asset and fee_asset.upper() == base_symbol_from_market(market):
+        net = max(amount - fee, Decimal(0))
+    return {"amount": amount, "money": money, "fee": fee, "price": money / amount, "net": net}
+
+class DealsLedger:
+    """
+    Інкрементальний читач /api/v4/trade-account/executed-history.
+    Курсор — найбільший уже врахований id угоди (зберігається у DEALS_FILE), тож кожен тік
+    тягне лише нові угоди. Угоди агрегуються по orderId: часткові виконання сумуються,
+    звідси реальна середня ціна, обсяг і комісія для TP/ping-pong без знімків балансу.
+    Агрегати відстежуваних ордерів зберігаються поруч із курсором: угод до курсора після рестарту
+    вже не перечитати, а частково виконаний ордер має зберегти свою реальну ціну й обсяг.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.cursor = 0
+        self.by_order: "OrderedDict[str, dict]" = OrderedDict()
+        self.fetched_at = 0.0
+        self.ok = False
+        self._lock = asyncio.Lock()
+
+    def load(self):
+        try:
+            with open(DEALS_FILE, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+            self.cursor = int(raw.get("cursor") or 0)
+            for oid, agg in (raw.get("orders") or {}).items():
+                self.by_order[str(oid)] = {
+                    "market": str(agg["market"]), "side": agg.get("side"), "amount": Decimal(agg["amount"]),
+                    "money": Decimal(agg["money"]), "fee": Decimal(agg.get("fee") or 0), "deals": int(agg.get("deals") or 0),
+                }
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"[DEALS] пошкоджений {DEALS_FILE}: {e}")
+
+    def fresh(self) -> bool:
+        return self.ok and (time.monotonic() - self.fetched_at) < self.ttl
+
+    @staticmethod
+    def _flatten(data) -> Optional[list]:
+        # без фільтра по ринку біржа повертає {market: [угоди, новіші першими]}
+        if isinstance(data, dict) and data.get("success") is False:
+            return None
+        if isinstance(data, dict):
+            return [dict(d, market=d.get("market") or m) for m, lst in data.items()
+                    if isinstance(lst, list) for d in lst if isinstance(d, dict)]
+        if isinstance(data, list):
+            return [d for d in data if isinstance(d, dict)]
+        return None
+
+    async def _fetch_new(self) -> Optional[list]:
+        out: list = []
+        for page in range(DEALS_MAX_PAGES):
+            body = {"limit": DEALS_PAGE, "offset": page * DEALS_PAGE}
+            lst = self._flatten(await private_post("/api/v4/trade-account/executed-history", body))
+            if lst is None:
+                return None  # без повної пачки курсор не рухаємо — інакше пропустимо угоди
+            new = [d for d in lst if _safe_int(d.get("id")) > self.cursor]
+            out.extend(new)
+            # дійшли до курсора або до кінця історії — далі лише вже враховані угоди
+            if len(new) < len(lst) or len(lst) < DEALS_PAGE or not self.cursor:
+                return out
+        logging.warning(f"[DEALS] понад {len(out)} нових угод за тік — старіші за них не враховано")
+        return out
+
+    def _apply(self, d: dict):
+        oid = str(d.get("orderId") or d.get("order_id") or "")
+        if not oid:
+            return
+        market = str(d.get("market") or "").upper()
+        agg = self.by_order.get(oid)
+        if agg is None:
+            agg = self.by_order[oid] = {"market": market, "side": d.get("side"),
+                                        "amount": Decimal(0), "money": Decimal(0), "fee": Decimal(0), "deals": 0}
+            while len(self.by_order) > DEALS_KEEP:
+                self.by_order.popitem(last=False)
+        agg["amount"] += _dec(d.get("amount") or 0)
+        agg["money"] += _dec(d.get("deal") or 0)
+        if str(d.get("feeAsset") or "").upper() == base_symbol_from_market(market):
+            agg["fee"] += _dec(d.get("fee") or 0)  # лише комісія в BASE зменшує отримане; без feeAsset — вона в QUOTE
+        agg["deals"] += 1
+
+    async def refresh(self, force: bool = False) -> bool:
+        if not force and self.fresh():
+            return True
+        async with self._lock:
+            if not force and self.fresh():
+                return True
+            started = time.monotonic()
+            new = await self._fetch_new()
+            if new is None:
+                logging.warning("[DEALS] не вдалося отримати історію угод")
+                self.ok = False
+                return False
+            for d in sorted(new, key=lambda x: _safe_int(x.get("id"))):
+                self._apply(d)
+            if new:
+                self.cursor = max(self.cursor, max(_safe_int(d.get("id")) for d in new))
+                await asyncio.to_thread(_write_file_atomic, DEALS_FILE, self._dump())
+            self.fetched_at = started
+            self.ok = True
+            return True
+
+    def _dump(self) -> str:
+        # зберігаємо лише ордери, які бот ще відстежує: решту вже враховано і більше не питатимуть
+        tracked = {oid for cfg in markets.values() for oid in cfg.orders.ids()}
+        orders = {oid: {"market": a["market"], "side": a["side"], "amount": str(a["amount"]),
+                        "money": str(a["money"]), "fee": str(a["fee"]), "deals": a["deals"]}
+                  for oid, a in self.by_order.items() if oid in tracked}
+        return json.dumps({"cursor": self.cursor, "orders": orders})
+
+    def fill(self, order_id) -> Optional[dict]:
+        agg = self.by_order.get(str(order_id))
+        if agg is None:
+            return None
+        # agg["fee"] містить лише комісію в BASE
+        return _deal_fill(agg["amount"], agg["money"], agg["fee"], agg["side"],
+                          base_symbol_from_market(agg["market"]), agg["market"])
+
+deals = DealsLedger(DEALS_TTL)
+
+_BUY_TYPES = ("scalp_buy", "rebuy")
+
+async def executed_fills(market: str, finished: list, events: Optional[Dict[str, dict]] = None,
+                         refreshed: bool = False) -> Dict[str, dict]:
+    """
+    Реальне виконання завершених ордерів: orderId -> _deal_fill(...).
+    Подія WS (deal_stock/deal_money) вже його містить; для решти — одне інкрементальне читання історії угод
+    (refreshed=True — історію вже щойно перечитано цим тіком).
+    """
+    out: Dict[str, dict] = {}
+    need = []
+    for e in finished:
+        side = "buy" if e.get("type") in _BUY_TYPES else "sell"
+        ev = (events or {}).get(e["id"])
+        f = None
+        if ev and ev.get("kind") == "fill":
+            f = _deal_fill(ev["deal_stock"], ev["deal_money"], ev["deal_fee"], side, None, market)
+        if f is None:
+            need.append(e)
+        else:
+            out[e["id"]] = f
+    if need and (refreshed or await deals.refresh(force=True)):
+        for e in need:
+            f = deals.fill(e["id"])
+            if f is not None:
+                out[e["id"]] = f
+    return out
+
+# ---------------- PUBLIC TICKER (надійний) ----------------
+# Один bulk-запит /public/ticker на тік обслуговує всі get_last_price по всіх ринках
+TICKER_TTL = float(os.getenv("TICKER_TTL", "1.5"))  # сек, скільки живе знімок тікера
+
+def _parse_last_price(item) -> Optional[float]:
+    if not isinstance(item, dict):
+        return None
+    lp = item.get("last_price")
+    try:
+        return float(lp) if lp is not None else None
+    except Exception:
+        return None
+
+class TickerSnapshot:
+    """
+    Кеш повного тікера: last_price по всіх ринках одним запитом, з TTL.
+    Конкурентні виклики під час оновлення чекають на той самий запит.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.raw: Dict[str, Any] = {}
+        self.fetched_at = 0.0           # time.monotonic() останнього успішного знімка
+        self._lock = asyncio.Lock()
+
+    def fresh(self) -> bool:
+        return bool(self.raw) and (time.monotonic() - self.fetched_at) < self.ttl
+
+    async def refresh(self, force: bool = False) -> bool:
+        if not force and self.fresh():
+            return True
+        async with self._lock:
+            # поки чекали на lock, знімок міг оновити інший виклик
+            if not force and self.fresh():
+                return True
+            t = await public_get("/api/v4/public/ticker")
+            if isinstance(t, list):
+                t = {item.get("market"): item for item in t if isinstance(item, dict) and item.get("market")}
+            if isinstance(t, dict) and t and "error" not in t:
+                self.raw = t
+                self.fetched_at = time.monotonic()
+                now = time.time()
+                for m in list(markets):
+                    lp = self.price(m)
+                    if lp:
+                        on_price_update(m, lp, now)
+                return True
+            logging.warning(f"[TICKER] bulk snapshot failed: {str(t)[:200]}")
+            return False
+
+    def price(self, market: str) -> Optional[float]:
+        return _parse_last_price(self.raw.get(market))
+
+tickers = TickerSnapshot(TICKER_TTL)
+
+# ---------------- TRIGGER INDEX ----------------
+# Захисні рівні кожного ринку (SL від входу, трейлінг-підлога від піку, auto-dd) і рівень активації
+# трейлінг-TP лежать у відсортованих масивах. Кожна ціна перевіряється бінарним пошуком прямо в
+# on_price_update, і спрацювання одразу запускає дію під локом ринку: реакція залежить від того,
+# як швидко приходять ціни, а не від періоду монітора. Монітор після кожного тіку викликає sync().
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class LatencyHistogram:
+    """Гістограма «ціна отримана -> захисний ордер відправлено» з фіксованими кошиками (мс), по джерелах."""
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts: Dict[str, list] = {}
+
+    def observe(self, source: str, t0: Optional[float]):
+        if t0 is None:
+            return
+        ms = (time.monotonic() - t0) * 1000
+        row = self.counts.setdefault(source, [0] * (len(self.buckets) + 1))
+        row[bisect_left(self.buckets, ms)] += 1
+
+    def quantile(self, source: str, q: float) -> Optional[float]:
+        """Верхня межа кошика, в який потрапляє q-квантиль (None — немає даних, inf — понад останній)."""
+        row = self.counts.get(source)
+        total = sum(row) if row else 0
+        if not total:
+            return None
+        need, acc = q * total, 0
+        for i, c in enumerate(row):
+            acc += c
+            if acc >= need:
+                return float(self.buckets[i]) if i < len(self.buckets) else math.inf
+        return math.inf
+
+    def lines(self) -> list:
+        out = []
+        for source, row in sorted(self.counts.items()):
+            qs = ", ".join(f"p{int(q * 100)}≤{self.quantile(source, q):g}мс" for q in (0.5, 0.9, 0.99))
+            out.append(f" {source}: n={sum(row)}, {qs}")
+        return out
+
+sl_latency = LatencyHistogram()
+
+class TriggerIndex:
+    """
+    market -> рівні «нижче» (ціна ≤ рівня => захисний вихід) і «вище» (ціна ≥ рівня => позачерговий тік).
+    Масиви відсортовані за ціною: пробиті рівні — це хвіст (bisect), O(log n) на тік.
+    Трейлінг-підлога рухається разом із піком прямо на тіку.
+    """
+    def __init__(self):
+        self.below: Dict[str, tuple] = {}   # market -> ([ціни за зростанням], [kind])
+        self.above: Dict[str, tuple] = {}
+        self.trail: Dict[str, float] = {}   # market -> частка SL від піку (лише sl_mode=trailing)
+        self.firing: set = set()            # ринки, по яких захисна дія вже в роботі
+        self.backoff: Dict[str, float] = {} # market -> monotonic, до якого вихід не повторюємо (біржа не зняла стоп)
+        self.tasks: set = set()             # запущені fire_sl — тримаємо посилання, щоб GC не зібрав їх посеред виходу
+
+    def sync(self, market: str, cfg: Optional["MarketConfig"]):
+        """Перебудувати рівні з конфігу (після кожного тіку монітора і зміни позиції)."""
+        self.below.pop(market, None)
+        self.above.pop(market, None)
+        self.trail.pop(market, None)
+        if cfg is None or not cfg.entry_price:
+            return
+        lo, hi = [], []
+        sl = cfg.sl or 0.0
+        if sl > 0 and native_sl_leg(cfg) is None:
+            if cfg.sl_mode == "trigger":
+                lo.append((cfg.entry_price * (1 - sl / 100), "sl"))
+            elif cfg.peak:
+                lo.append((cfg.peak * (1 - sl / 100), "trailing"))
+        if cfg.sl_mode == "trailing" and sl > 0:
+            self.trail[market] = sl / 100   # пік ведемо і для нативного стопа — його підтягує монітор
+        if cfg.dd_pct() > 0:
+            lo.append((cfg.entry_price * (1 - cfg.dd_pct() / 100), "auto_dd"))
+        if cfg.profit_floor and native_sl_leg(cfg) is None:
+            lo.append((cfg.profit_floor, "lock"))
+        if cfg.tp and not cfg.scalp and safety.cfg.auto_profit_fix_enabled:
+            hi.append((cfg.entry_price * (1 + float(safety.cfg.min_pnl_lock_pct) / 100), "tp_trail"))
+        if lo:
+            lo.sort()
+            self.below[market] = ([p for p, _ in lo], [k for _, k in lo])
+        if hi:
+            hi.sort()
+            self.above[market] = ([p for p, _ in hi], [k for _, k in hi])
+
+    def on_tick(self, market: str, price: float, t0: float):
+        frac = self.trail.get(market)
+        if frac is not None:
+            cfg = markets.get(market)
+            if cfg is not None and price > (cfg.peak or 0):
+                cfg.peak = price
+                save_markets()
+                self.sync(market, cfg)
+        lo = self.below.get(market)
+        if lo and market not in self.firing and t0 >= self.backoff.get(market, 0.0):
+            prices, kinds = lo
+            i = bisect_left(prices, price)   # рівні ≥ price — пробиті
+            if i < len(prices):
+                self.firing.add(market)
+                logging.info(f"[TRIGGER] {market}: ціна {price} пробила {list(zip(prices[i:], kinds[i:]))}")
+                task = asyncio.create_task(fire_sl(market, price, t0))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+                return
+        hi = self.above.get(market)
+        if hi:
+            prices, kinds = hi
+            j = bisect_right(prices, price)  # рівні ≤ price — досягнуті
+            if j:
+                # трейлінг-TP переставляє монітор (з троттлінгом) — будимо його, рівень знімаємо до sync()
+                del self.above[market]
+                supervisor.wake(market)
+
+triggers = TriggerIndex()
+
+def on_price_update(market: str, price: float, ts: float):
+    """Єдина точка входу для кожної нової ціни налаштованого ринку."""
+    t0 = time.monotonic()
+    candles.on_tick(market, price, ts)
+    safety.note_price(market, price, ts)
+    triggers.on_tick(market, price, t0)
+    cfg = markets.get(market)
+    if trends.update(market, price, ts) and cfg is not None and cfg.mode == "auto":
+        supervisor.wake(market)  # підтверджена зміна режиму — профіль застосуємо одразу, не чекаючи тіку
+
+# ---------------- CANDLES ----------------
+# OHLCV-бари 1s/1m/5m з потоку цін у кільцевих array('d'); на старті 1m/5m добираємо з /api/v1/public/kline,
+# щоб SafetyManager і TrendEngine були «прогріті» ще до першого тіку монітора.
+CANDLE_TFS = {"1s": 1, "1m": 60, "5m": 300}
+CANDLE_CAPACITY = int(os.getenv("CANDLE_CAPACITY", "300"))          # барів на таймфрейм
+CANDLE_BACKFILL = int(os.getenv("CANDLE_BACKFILL", "60"))           # скільки барів добирати на старті
+CANDLE_BACKFILL_TIMEOUT = float(os.getenv("CANDLE_BACKFILL_TIMEOUT", "10"))
+
+class CandleSeries:
+    """Кільце з cap барів одного таймфрейму; останній бар — поточний (ще не закритий)."""
+    __slots__ = ("tf", "cap", "t", "o", "h", "l", "c", "v", "head", "n")
+
+    def __init__(self, tf: int, cap: int = CANDLE_CAPACITY):
+        self.tf = tf
+        self.cap = cap
+        self.t, self.o, self.h, self.l, self.c, self.v = (array("d", bytes(8 * cap)) for _ in range(6))
+        self.head = 0
+        self.n = 0
+
+    def __len__(self) -> int:
+        return self.n
+
+    def _idx(self, k: int) -> int:
+        # k-й бар від найстаршого; від'ємні — з кінця
+        if k < 0:
+            k += self.n
+        return (self.head + k) % self.cap
+
+    def last_open(self) -> Optional[float]:
+        return self.t[self._idx(-1)] if self.n else None
+
+    def _open_bar(self, bucket: float, o: float, h: float, l: float, c: float, v: float):
+        if self.n == self.cap:
+            self.head = (self.head + 1) % self.cap
+            self.n -= 1
+        i = (self.head + self.n) % self.cap
+        self.t[i], self.o[i], self.h[i], self.l[i], self.c[i], self.v[i] = bucket, o, h, l, c, v
+        self.n += 1
+
+    def add_tick(self, price: float, ts: float, volume: float = 0.0):
+        bucket = ts - ts % self.tf
+        if self.n:
+            i = self._idx(-1)
+            last = self.t[i]
+            if bucket == last:
+                if price > self.h[i]:
+                    self.h[i] = price
+                if price < self.l[i]:
+                    self.l[i] = price
+                self.c[i] = price
+                self.v[i] += volume
+                return
+            if bucket < last:
+                return  # запізнілий тік — бар уже закрито
+        self._open_bar(bucket, price, price, price, price, volume)
+
+    def add_bar(self, t: float, o: float, h: float, l: float, c: float, v: float):
+        """
+        Готовий бар (бекфіл). Новіший за останній — додається, той самий — перезаписується,
+        старший — вставляється на своє місце за живою «головою» (якщо влазить у кільце).
+        """
+        if not self.n or t > self.t[self._idx(-1)]:
+            self._open_bar(t, o, h, l, c, v)
+            return
+        k = self.n - 1
+        while k >= 0 and self.t[self._idx(k)] > t:
+            k -= 1
+        if k >= 0 and self.t[self._idx(k)] == t:
+            i = self._idx(k)
+            self.o[i], self.h[i], self.l[i], self.c[i], self.v[i] = o, h, l, c, v
+            return
+        if self.n == self.cap:
+            if k < 0:
+                return  # старший за все кільце
+            self.head = (self.head + 1) % self.cap
+            self.n -= 1
+            k -= 1
+        # зсуваємо новіші бари на одну позицію і ставимо цей після k-го
+        cols = (self.t, self.o, self.h, self.l, self.c, self.v)
+        for j in range(self.n, k + 1, -1):
+            dst, src = self._idx(j), self._idx(j - 1)
+            for a in cols:
+                a[dst] = a[src]
+        i = self._idx(k + 1)
+        self.t[i], self.o[i], self.h[i], self.l[i], self.c[i], self.v[i] = t, o, h, l, c, v
+        self.n += 1
+
+    def bar(self, k: int) -> tuple:
+        """(t, open, high, low, close, volume) для k-го бару (0 — найстаріший, -1 — поточний)."""
+        i = self._idx(k)
+        return self.t[i], self.o[i], self.h[i], self.l[i], self.c[i], self.v[i]
+
+class CandleAggregator:
+    def __init__(self):
+        self.by_pair: dict[str, dict[str, CandleSeries]] = {}
+
+    def series(self, pair: str, tf: str) -> CandleSeries:
+        s = self.by_pair.get(pair)
+        if s is None:
+            s = self.by_pair[pair] = {name: CandleSeries(sec) for name, sec in CANDLE_TFS.items()}
+        return s[tf]
+
+    def on_tick(self, pair: str, price: float, ts: float):
+        s = self.by_pair.get(pair)
+        if s is None:
+            self.series(pair, "1s")
+            s = self.by_pair[pair]
+        for ser in s.values():
+            ser.add_tick(price, ts)
+
+    async def _fetch(self, pair: str, tf: str) -> list:
+        # /api/v1/public/kline: [[ts, open, close, high, low, volume_stock, volume_money], ...]
+        data = await public_get(f"/api/v1/public/kline?market={pair}&interval={tf}&limit={CANDLE_BACKFILL}",
+                                priority=PRIO_BULK)
+        rows = data.get("result") if isinstance(data, dict) else data
+        if not isinstance(rows, list):
+            logging.warning(f"[CANDLES] {pair} {tf}: неочікувана відповідь kline: {str(data)[:200]}")
+            return []
+        bars = []
+        for row in rows:
+            try:
+                t, o, c, h, l, v = (float(x) for x in row[:6])
+            except (TypeError, ValueError, IndexError):
+                continue
+            bars.append((t, o, h, l, c, v))
+        bars.sort()
+        return bars
+
+    async def backfill(self, pair: str, cfg: Optional["MarketConfig"] = None):
+        """
+        Добирає 1m/5m бари з біржі і проганяє закриття 1m через safety/trend, як живі тіки.
+        cfg — конфіг пари, якої ще немає в markets (нову пару додаємо лише після бекфілу).
+        """
+        try:
+            m1, m5 = await asyncio.gather(self._fetch(pair, "1m"), self._fetch(pair, "5m"))
+        except Exception as e:
+            logging.error(f"[CANDLES] backfill {pair} error: {e}")
+            return
+        for tf, bars in (("1m", m1), ("5m", m5)):
+            ser = self.series(pair, tf)
+            for b in bars:
+                ser.add_bar(*b)
+        now = time.time()
+        for t, _o, _h, _l, c, _v in m1:
+            # час закриття бару; поточний бар — «зараз»
+            safety.note_price(pair, c, min(t + 60, now))
+            trends.update(pair, c, min(t + 60, now), cfg)
+        if m1:
+            logging.info(f"[CANDLES] {pair}: бекфіл 1m={len(m1)} 5m={len(m5)}")
+
+    async def backfill_all(self, pairs):
+        pairs = list(pairs)
+        if not pairs:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(self.backfill(p) for p in pairs)), CANDLE_BACKFILL_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(f"[CANDLES] бекфіл не вклався в {CANDLE_BACKFILL_TIMEOUT}s — стартую з тим, що є")
+
+candles = CandleAggregator()
+
+# ---------------- WEBSOCKET FEEDS ----------------
+# Публічний WS (lastprice) — основне джерело цін; приватний WS (ордери/баланс) — основне джерело заповнень.
+# REST лишається фолбеком, коли сокет відвалився або давно мовчить.
+WS_URL = os.getenv("WS_URL", "wss://api.whitebit.com/ws")
+WS_ENABLED = os.getenv("WS", "1").lower() not in ("0", "false", "off")
+WS_PRIVATE_ENABLED = os.getenv("WS_PRIVATE", "1").lower() not in ("0", "false", "off")
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "10"))  # сервер рве зʼєднання після ~60с тиші
+WS_STALE_AFTER = float(os.getenv("WS_STALE_AFTER", "25"))      # стільки секунд без жодного повідомлення — фолбек на REST
+WS_MAX_BACKOFF = 30.0
+
+class WSClient(ABC):
+    """
+    Спільний каркас WS-клієнта: підключення, ping, перепідключення з експоненційною паузою,
+    повторна підписка після reconnect і при зміні списку ринків.
+    Нащадки визначають _subscribe(), _handle(data) і за потреби _on_connect()/_on_disconnect().
+    """
+    name = "WS"
+
+    def __init__(self, url: str):
+        self.url = url
+        self.subscribed: frozenset = frozenset()
+        self.connected = False
+        self.last_msg = 0.0          # time.monotonic() останнього повідомлення (включно з pong)
+        self.reconnects = 0
+        self.updates = 0
+        self.running = False
+        self._ws = None
+        self._ids = itertools.count(1)
+
+    def alive(self) -> bool:
+        return self.connected and (time.monotonic() - self.last_msg) < WS_STALE_AFTER
+
+    def _wanted(self) -> frozenset:
+        return frozenset(markets)
+
+    async def _send(self, method: str, params: list):
+        await self._ws.send_str(json.dumps({"id": next(self._ids), "method": method, "params": params}))
+
+    @abstractmethod
+    async def _subscribe(self):
+        """Привести підписки до _wanted() і оновити self.subscribed."""
+
+    @abstractmethod
+    def _handle(self, data: dict):
+        """Одне розібране повідомлення сервера (відповідь на запит або подія)."""
+
+    async def _on_connect(self):
+        await self._subscribe()
+
+    def _on_disconnect(self):
+        pass
+
+    def resubscribe(self):
+        """Викликається після /market, /removemarket, /stop."""
+        if self.connected:
+            asyncio.create_task(self._subscribe())
+
+    def _on_message(self, raw: str):
+        self.last_msg = time.monotonic()
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            return
+        if isinstance(data, dict):
+            self._handle(data)
+
+    async def _ping_loop(self, ws):
+        """
+        Ping і нагляд за зʼєднанням. Напіввідкритий сокет (мовчить довше WS_STALE_AFTER, хоча на ping
+        сервер мав би відповісти) закриваємо самі — run() перепідключиться, перепідпишеться і звірить стан.
+        Будь-яка помилка тут теж закриває сокет: без ping сервер однаково розірве зʼєднання.
+        """
+        try:
+            while not ws.closed:
+                await asyncio.sleep(WS_PING_INTERVAL)
+                silent = time.monotonic() - self.last_msg
+                if silent > WS_STALE_AFTER:
+                    logging.warning(f"[{self.name}] тиша {silent:.0f}s — закриваю зʼєднання")
+                    break
+                await self._send("ping", [])
+                # страхуємося від пропущеного resubscribe()
+                if self._wanted() != self.subscribed:
+                    await self._subscribe()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"[{self.name}] ping: {e} — закриваю зʼєднання")
+        await ws.close()
+
+    async def run(self):
+        self.running = True
+        backoff = 1.0
+        while self.running:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.ws_connect(self.url, heartbeat=None, autoping=True) as ws:
+                        self._ws = ws
+                        self.connected = True
+                        self.last_msg = time.monotonic()
+                        logging.info(f"[{self.name}] connected {self.url}")
+                        await self._on_connect()
+                        backoff = 1.0
+                        pinger = asyncio.create_task(self._ping_loop(ws))
+                        try:
+                            async for msg in ws:
+                                if msg.type == aiohttp.WSMsgType.TEXT:
+                                    self._on_message(msg.data)
+                                elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                                    break
+                        finally:
+                            pinger.cancel()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"[{self.name}] {self.url}: {e}")
+            finally:
+                self.connected = False
+                self._ws = None
+                self.subscribed = frozenset()
+                self._on_disconnect()
+            if not self.running:
+                break
+            self.reconnects += 1
+            logging.info(f"[{self.name}] reconnect через {backoff:.0f}s (REST-фолбек активний)")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, WS_MAX_BACKOFF)
+
+    async def stop(self):
+        self.running = False
+        ws = self._ws
+        if ws is not None and not ws.closed:
+            await ws.close()
+
+class PriceFeed(WSClient):
+    """
+    lastprice_subscribe на всі налаштовані ринки; кожне lastprice_update -> кеш + on_price_update.
+    lastprice_update приходить лише при зміні ціни, тож «свіжість» — це живий сокет, а не вік ціни.
+    """
+    name = "WS"
+
+    def __init__(self, url: str):
+        super().__init__(url)
+        self.prices: Dict[str, float] = {}
 
-    return await private_post("/api/v4/order/new", body)
+    def live(self, market: str) -> bool:
+        return self.alive() and market in self.subscribed and market in self.prices
 
-async def active_orders(market: Optional[str] = None) -> dict:
-    body = {}
-    if market:
-        body["market"] = market
-
-    data = await private_post("/api/v4/orders", body)
-
-    def _normalize(d):
-        if isinstance(d, list):
-            return {"orders": d}
-        if isinstance(d, dict):
-            lst = d.get("orders")
-            if isinstance(lst, list):
-                return {"orders": lst}
-            # інші поширені форми
-            rec = d.get("records")
-            if isinstance(rec, list):
-                return {"orders": rec}
-            for k in ("result", "data"):
-                v = d.get(k)
-                if isinstance(v, list):
-                    return {"orders": v}
-                if isinstance(v, dict):
-                    vv = v.get("data") or v.get("orders") or v.get("records")
-                    if isinstance(vv, list):
-                        return {"orders": vv}
-        return None
+    def price(self, market: str) -> Optional[float]:
+        return self.prices.get(market) if self.live(market) else None
 
-    norm = _normalize(data)
-    if norm is not None:
-        return norm
+    async def _subscribe(self):
+        ws = self._ws
+        if ws is None or ws.closed:
+            return
+        wanted = self._wanted()
+        # повторний *_subscribe замінює попередній список ринків каналу
+        if wanted:
+            await self._send("lastprice_subscribe", sorted(wanted))
+        elif self.subscribed:
+            await self._send("lastprice_unsubscribe", [])
+        # ціни ринків, яких більше немає у підписці, не віддаємо як живі
+        for m in self.subscribed - wanted:
+            self.prices.pop(m, None)
+        self.subscribed = wanted
+
+    def _handle(self, data: dict):
+        if data.get("method") == "lastprice_update":
+            params = data.get("params") or []
+            if len(params) < 2:
+                return
+            market = params[0]
+            try:
+                p = float(params[1])
+            except (TypeError, ValueError):
+                return
+            if p <= 0:
+                return
+            self.prices[market] = p
+            self.updates += 1
+            if market in markets:
+                on_price_update(market, p, time.time())
+        elif data.get("error"):
+            logging.warning(f"[{self.name}] {data.get('error')}")
 
-    # Фолбек: альтернативний ендпоінт активних ордерів
-    alt = await private_post("/api/v4/order/active", body)
-    norm_alt = _normalize(alt)
-    if norm_alt is not None:
-        return norm_alt
+price_feed = PriceFeed(WS_URL)
 
-    logging.warning(f"[active_orders] unexpected payloads: /orders={type(data)}, /order/active={type(alt)}")
-    return {"orders": []}
+class PrivateFeed(WSClient):
+    """
+    Авторизований WS: ordersPending (індекс відкритих ордерів), ordersExecuted (виконання), balanceSpot (баланс).
+    Завершені ордери складаються в чергу подій по ринку (orderId -> подія), монітор забирає її drain()-ом.
+    Після кожного (пере)підключення — одна REST-звірка: знімок ордерів і балансу, а відстежувані ордери,
+    яких уже немає серед відкритих, ідуть у чергу як kind="unknown" (поведінка як у REST-детекту).
+    """
+    name = "WS-PRIVATE"
+
+    def __init__(self, url: str):
+        super().__init__(url)
+        self.synced = False
+        self.events: Dict[str, Dict[str, dict]] = {}
+
+    def live(self) -> bool:
+        return self.synced and self.alive()
+
+    def drain(self, market: str) -> Dict[str, dict]:
+        return self.events.pop(market, {})
+
+    def _push(self, ev: dict):
+        q = self.events.setdefault(ev["market"], {})
+        prev = q.get(ev["id"])
+        # fill — найточніша подія для ордера; cancel/unknown її не перетирають
+        if prev is None or prev["kind"] != "fill":
+            q[ev["id"]] = ev
+        supervisor.wake(ev["market"])
+
+    @staticmethod
+    def _event(kind: str, order: dict) -> dict:
+        return {
+            "kind": kind,
+            "id": _order_id_of(order),
+            "market": str(order.get("market") or "").upper(),
+            "side": order.get("side"),
+            "deal_stock": order.get("deal_stock") or order.get("dealStock") or "0",
+            "deal_money": order.get("deal_money") or order.get("dealMoney") or "0",
+            "deal_fee": order.get("deal_fee") or order.get("dealFee") or "0",
+        }
 
-async def cancel_order(market: str, order_id: Optional[str] = None, client_order_id: Optional[str] = None) -> dict:
-    body = {"market": market}
-    if client_order_id:
-        body["clientOrderId"] = str(client_order_id)
-    elif order_id is not None:
-        body["orderId"] = str(order_id)
-    else:
-        return {"success": False, "message": "Потрібно вказати order_id або client_order_id"}
-    return await private_post("/api/v4/order/cancel", body)
+    async def _subscribe(self):
+        ws = self._ws
+        if ws is None or ws.closed:
+            return
+        wanted = self._wanted()
+        assets = sorted({a for m in wanted for a in m.split("_")})
+        if wanted:
+            await self._send("ordersPending_subscribe", sorted(wanted))
+            await self._send("ordersExecuted_subscribe", [sorted(wanted), 0])
+            await self._send("balanceSpot_subscribe", assets)
+        elif self.subscribed:
+            for ch in ("ordersPending", "ordersExecuted", "balanceSpot"):
+                await self._send(f"{ch}_unsubscribe", [])
+        self.subscribed = wanted
+
+    async def _on_connect(self):
+        self.synced = False
+        tok = await private_post("/api/v4/profile/websocket_token", priority=PRIO_CRITICAL)
+        token = tok.get("websocket_token") if isinstance(tok, dict) else None
+        if not token:
+            raise RuntimeError(f"websocket_token: {str(tok)[:200]}")
+        await self._send("authorize", [token, "public"])
+        await self._subscribe()
+        await self._reconcile()
+        balances.streaming = open_orders.streaming = True
+        self.synced = True
+
+    def _on_disconnect(self):
+        self.synced = False
+        balances.streaming = open_orders.streaming = False
+        open_orders.invalidate()  # під час розриву ордери могли змінитися
+
+    async def _reconcile(self):
+        """REST-звірка після (пере)підключення: подій, пропущених під час розриву, WS не повторить."""
+        await balances.get(force=True, priority=PRIO_CRITICAL)
+        if not await open_orders.refresh(force=True):
+            raise RuntimeError("reconcile: не вдалося отримати відкриті ордери")
+        for market, cfg in list(markets.items()):
+            active = open_orders.ids(market)
+            for e in cfg.orders:
+                oid = str(e.get("id") or "")
+                if oid and oid not in active:
+                    self._push({"kind": "unknown", "id": oid, "market": market})
+
+    def _handle(self, data: dict):
+        method = data.get("method")
+        params = data.get("params") or []
+        if method == "ordersPending_update" and len(params) >= 2 and isinstance(params[1], dict):
+            event, order = params[0], params[1]
+            self.updates += 1
+            if event == 3:  # ордер завершено: виконано (повністю/частково) або скасовано
+                open_orders.discard(str(order.get("market") or "").upper(), _order_id_of(order))
+                capital.close(_order_id_of(order), _dec(order.get("deal_money") or 0))
+                filled = _dec(order.get("deal_stock") or 0) > 0
+                self._push(self._event("fill" if filled else "cancel", order))
+            else:           # 1 — новий, 2 — оновлення (часткове виконання)
+                open_orders.upsert(order)
+        elif method == "ordersExecuted_update" and params and isinstance(params[0], dict):
+            self.updates += 1
+            self._push(self._event("fill", params[0]))
+        elif method == "balanceSpot_update" and params and isinstance(params[0], dict):
+            self.updates += 1
+            balances.apply_update(params[0])
+        elif data.get("error"):
+            logging.warning(f"[{self.name}] {data.get('error')}")
+
+private_feed = PrivateFeed(WS_URL)
 
-# ---------------- PUBLIC TICKER (надійний) ----------------
 async def get_last_price(market: str) -> Optional[float]:
     """
     Стабільно дістає last_price незалежно від формату відповіді.
-    Спочатку точковий запит, далі фолбек на загальний.
+    Спочатку живий WS-кеш, далі спільний знімок тікера (один запит на всі ринки), далі точковий запит.
     """
+    lp = price_feed.price(market)
+    if lp is not None:
+        return lp
     try:
-        # 1) точково
+        # 1) зі знімка (оновлюється не частіше ніж раз на TICKER_TTL)
+        await tickers.refresh()
+        lp = tickers.price(market)
+        if lp is not None:
+            return lp
+
+        # 2) фолбек — точковий запит (ринку немає у знімку або знімок недоступний)
         data = await public_get(f"/api/v4/public/ticker?market={market}")
         if isinstance(data, dict) and market in data:
-            lp = data[market].get("last_price")
-            try:
-                return float(lp) if lp is not None else None
-            except Exception:
-                return None
+            return _parse_last_price(data[market])
         if isinstance(data, list):
             for item in data:
                 if isinstance(item, dict) and item.get("market") == market:
-                    lp = item.get("last_price")
-                    try:
-                        return float(lp) if lp is not None else None
-                    except Exception:
-                        return None
-
-        # 2) фолбек — загальний тікер
-        t = await public_get("/api/v4/public/ticker")
-        if isinstance(t, dict):
-            lp = (t.get(market) or {}).get("last_price")
-            try:
-                return float(lp) if lp is not None else None
-            except Exception:
-                return None
-        if isinstance(t, list):
-            for item in t:
-                if isinstance(item, dict) and item.get("market") == market:
-                    lp = item.get("last_price")
-                    try:
-                        return float(lp) if lp is not None else None
-                    except Exception:
-                        return None
+                    return _parse_last_price(item)
     except Exception as e:
         logging.exception(f"Не вдалося взяти last_price для {market}: {e}")
     return None
@@ -660,19 +2745,13 @@ def base_symbol_from_market(market: str) -> str:
     return market.split("_")[0].upper()
 
 async def get_usdt_available() -> Decimal:
-    b = await get_balance()
-    try:
-        return Decimal(str((b.get("USDT") or {}).get("available", "0")))
-    except Exception:
-        return Decimal("0")
+    """Вільні USDT з урахуванням резервів усіх ринків (CapitalLedger) — без запиту, поки облік свіжий."""
+    await capital.ensure()
+    return capital.free()
 
-async def get_base_available(market: str) -> Decimal:
-    b = await get_balance()
-    base = base_symbol_from_market(market)
-    try:
-        return Decimal(str((b.get(base) or {}).get("available", "0")))
-    except Exception:
-        return Decimal("0")
+async def get_base_available(market: str, priority: int = PRIO_NORMAL) -> Decimal:
+    await get_balance(priority=priority)
+    return balances.available(base_symbol_from_market(market))
 
 # ---------------- BOT COMMANDS ----------------
 @dp.message(Command("start"))
@@ -713,15 +2792,17 @@ async def help_cmd(message: types.Message):
 
         "<b>SL режими</b>\n"
         "/slmode BTC/USDT trigger|trailing — тип SL\n"
-        "/autodd BTC/USDT 3.0 — авто-стоп при падінні від entry на N%\n\n"
+        "/slnative BTC/USDT on|off — SL стоп-ордером на біржі (OCO з TP)\n"
+        "/autodd BTC/USDT 3.0|off — авто-стоп при падінні від entry на N% (за замовчуванням вимкнено)\n\n"
 
         "<b>Безпека / ризик-менеджмент</b>\n"
         "/safemode on|off — глобальний safe-mode\n"
         "/setautostop 3 — денний ліміт втрат у %\n"
-        "/autopf on|off — авто-підтягування TP\n"
+        "/autopf on|off — авто-підтягування TP і підлога прибутку\n"
         "/setminpnl 0.8 — мін. рух (у %) для блокування прибутку\n\n"
 
         "<b>Службові</b>\n"
+        "/netstats — статистика запитів до біржі\n"
         "/restart — перезапуск логіки\n"
         "/stop — зупинити торгівлю (очистити ринки)\n"
         "/version — версія бота"
@@ -768,7 +2849,7 @@ async def cmd_setminpnl(msg: types.Message):
 
 @dp.message(Command("balance"))
 async def balance_cmd(message: types.Message):
-    data = await get_balance()
+    data = await get_balance(fresh=True)
     if not data or not isinstance(data, dict):
         await message.answer("❌ Помилка: не вдалося отримати баланс.")
         return
@@ -784,6 +2865,8 @@ async def balance_cmd(message: types.Message):
             lines.append(f"{asset}: {available} (freeze {freeze})")
 
     text = "💰 <b>Баланс</b>:\n" + ("\n".join(lines) if lines else "0 на всіх гаманцях")
+    if capital.holds:
+        text += f"\n🔒 Під BUY-ордерами бота: {capital.reserved()} {CAPITAL_ASSET}, вільно: {capital.free()}"
     await message.answer(text)
 
 @dp.message(Command("market"))
@@ -792,35 +2875,25 @@ async def market_cmd(message: types.Message):
         _, market = message.text.split(maxsplit=1)
         market = market.upper().replace("/", "_")  # BTC/USDT -> BTC_USDT
 
-        markets[market] = {
-            "tp": None,
-            "sl": None,
-            "orders": [],
-            "autotrade": False,
-            "buy_usdt": 10,
-            "chat_id": message.chat.id,
-            "rebuy_pct": 0.0,
-            "last_tp_price": None,
-            "scalp": False,
-            "tick_pct": 0.25,
-            "levels": 3,
-            "maker_only": True,
-            "sl_mode": "trigger",
-            "entry_price": None,
-            "peak": None,
-            "auto_dd_pct": 3.0,
-            "mode": "manual",
-            "trend_window_s": 300,
-            "trend_ref_price": None,
-            "trend_ref_ts": 0,
-            "auto_down_pct": -1.5,
-            "auto_up_pct": 1.0,
-            "profile_down": {"tp": 0.45, "sl": 2.5, "rebuy_pct": 0.0, "scalp": True, "tick_pct": 0.30, "levels": 3},
-            "profile_up": {"tp": 0.80, "sl": 1.2, "rebuy_pct": 0.5, "scalp": True, "tick_pct": 0.25, "levels": 3},
-        }
+        # історію цін добираємо до того, як пара стане видимою WS і тікеру:
+        # інакше перший живий тік випередить бекфіл і свічки/safety/тренд відкинуть старші бари
+        # значення за замовчуванням — у MarketConfig
+        cfg = MarketConfig(chat_id=message.chat.id)
+        if market not in markets:
+            try:
+                await asyncio.wait_for(candles.backfill(market, cfg), CANDLE_BACKFILL_TIMEOUT)
+            except asyncio.TimeoutError:
+                logging.warning(f"[CANDLES] {market}: бекфіл не вклався в {CANDLE_BACKFILL_TIMEOUT}s")
+
+        markets[market] = cfg
 
         save_markets()
+        supervisor.sync()
+        price_feed.resubscribe()
+        private_feed.resubscribe()
         await message.answer(f"✅ Додано ринок {market} (за замовчуванням 10 USDT)")
+        if not await ensure_market_rules(market):
+            await message.answer(f"⚠️ Не вдалося отримати правила біржі для {market} — торгівля стартує, щойно вони будуть.")
     except Exception:
         await message.answer("⚠️ Використання: /market BTC/USDT")
 
@@ -832,7 +2905,7 @@ async def settp_cmd(message: types.Message):
         if market not in markets:
             await message.answer("❌ Спочатку додай ринок через /market.")
             return
-        markets[market]["tp"] = float(percent)
+        markets[market].tp = float(percent)
         save_markets()
         await message.answer(f"📈 TP для {market}: {percent}%")
     except Exception:
@@ -846,7 +2919,7 @@ async def setsl_cmd(message: types.Message):
         if market not in markets:
             await message.answer("❌ Спочатку додай ринок через /market.")
             return
-        markets[market]["sl"] = float(percent)
+        markets[market].sl = float(percent)
         save_markets()
         await message.answer(f"📉 SL для {market}: {percent}%")
     except Exception:
@@ -861,7 +2934,7 @@ async def setbuy_cmd(message: types.Message):
         if usdt <= 0:
             await message.answer("⚠️ Сума повинна бути більшою за 0.")
             return
-        markets[market]["buy_usdt"] = usdt
+        markets[market].buy_usdt = Decimal(str(usdt))
         save_markets()
         await message.answer(f"📊 Для {market} встановлено {usdt} USDT на кожну купівлю.")
     except Exception:
@@ -879,7 +2952,7 @@ async def setrebuy_cmd(message: types.Message):
         if pct < 0:
             await message.answer("⚠️ Вкажи відсоток ≥ 0. (0 вимикає відкуп нижче TP)")
             return
-        markets[market]["rebuy_pct"] = pct
+        markets[market].rebuy_pct = pct
         save_markets()
         await message.answer(
             f"🔁 Re-buy для {market}: {pct}% нижче TP " + ("(вимкнено)" if pct == 0 else "")
@@ -894,7 +2967,7 @@ async def scalp_cmd(message: types.Message):
         market = market.upper().replace("/", "_")
         if market not in markets:
             return await message.answer("❌ Спочатку додай ринок через /market.")
-        markets[market]["scalp"] = (state.lower() == "on")
+        markets[market].scalp = (state.lower() == "on")
         save_markets()
         await message.answer(f"⚙️ SCALP для {market}: {state.upper()}")
     except Exception:
@@ -907,12 +2980,19 @@ async def autodd_cmd(message: types.Message):
         market = market.upper().replace("/", "_")
         if market not in markets:
             return await message.answer("❌ Спочатку додай ринок через /market.")
-        v = float(pct)
+        cfg = markets[market]
+        v = 0.0 if pct.lower() == "off" else float(pct)
         if v < 0:
-            return await message.answer("⚠️ Вкажи відсоток ≥ 0 (0 = вимкнено).")
-        markets[market]["auto_dd_pct"] = v
+            return await message.answer("⚠️ Вкажи відсоток ≥ 0 (0 або off = вимкнено).")
+        cfg.auto_dd = v > 0
+        if v > 0:
+            cfg.auto_dd_pct = v
+        triggers.sync(market, cfg)
         save_markets()
-        await message.answer(f"🛡️ AUTO-DD для {market}: {v}% від ціни входу")
+        if v > 0:
+            await message.answer(f"🛡️ AUTO-DD для {market}: {v}% від ціни входу")
+        else:
+            await message.answer(f"🛡️ AUTO-DD для {market}: вимкнено")
     except Exception:
         await message.answer("⚠️ Використання: /autodd BTC/USDT 3.0")
 
@@ -923,7 +3003,10 @@ async def settick_cmd(message: types.Message):
         market = market.upper().replace("/", "_")
         if market not in markets:
             return await message.answer("❌ Спочатку додай ринок через /market.")
-        markets[market]["tick_pct"] = float(pct)
+        try:
+            markets[market].tick_pct = _pos_float(pct)
+        except ValueError:
+            return await message.answer("❌ Tick має бути додатнім відсотком, напр. 0.25.")
         save_markets()
         await message.answer(f"📏 Tick для {market}: {pct}%")
     except Exception:
@@ -936,7 +3019,7 @@ async def setlevels_cmd(message: types.Message):
         market = market.upper().replace("/", "_")
         if market not in markets:
             return await message.answer("❌ Спочатку додай ринок через /market.")
-        markets[market]["levels"] = max(1, int(n))
+        markets[market].levels = max(1, int(n))
         save_markets()
         await message.answer(f"🪜 Levels для {market}: {n}")
     except Exception:
@@ -952,12 +3035,29 @@ async def slmode_cmd(message: types.Message):
         mode = mode.lower()
         if mode not in ("trigger", "trailing"):
             return await message.answer("⚠️ slmode: trigger|trailing")
-        markets[market]["sl_mode"] = mode
+        markets[market].sl_mode = mode
         save_markets()
         await message.answer(f"🛡️ SL mode для {market}: {mode}")
     except Exception:
         await message.answer("⚠️ Використання: /slmode BTC/USDT trigger|trailing")
 
+@dp.message(Command("slnative"))
+async def slnative_cmd(message: types.Message):
+    try:
+        _, market, state = message.text.split()
+        market = market.upper().replace("/", "_")
+        if market not in markets:
+            return await message.answer("❌ Спочатку додай ринок через /market.")
+        state = state.lower()
+        if state not in ("on", "off"):
+            return await message.answer("⚠️ slnative: on|off")
+        markets[market].sl_native = (state == "on")
+        save_markets()
+        supervisor.wake(market)  # стоп поставить/зніме монітор на найближчому тіку
+        await message.answer(f"🛡️ Нативний SL для {market}: {state.upper()}")
+    except Exception:
+        await message.answer("⚠️ Використання: /slnative BTC/USDT on|off")
+
 @dp.message(Command("holdsl"))
 async def holdsl_cmd(message: types.Message):
     try:
@@ -965,7 +3065,7 @@ async def holdsl_cmd(message: types.Message):
         market = market.upper().replace("/", "_")
         if market not in markets:
             return await message.answer("❌ Спочатку додай ринок через /market.")
-        markets[market]["hold_on_sl"] = (state.lower() == "on")
+        markets[market].hold_on_sl = (state.lower() == "on")
         save_markets()
         await message.answer(f"🛡️ HOLD-on-SL для {market}: {state.upper()}")
     except Exception:
@@ -983,10 +3083,10 @@ async def autotrade_cmd(message: types.Message):
         if state not in ("on", "off"):
             await message.answer("⚠️ Використання: /autotrade BTC/USDT on|off")
             return
-        markets[market]["autotrade"] = (state == "on")
+        markets[market].autotrade = (state == "on")
         save_markets()
         await message.answer(
-            f"{'✅' if markets[market]['autotrade'] else '⏹️'} Autotrade для {market}: {state.upper()}"
+            f"{'✅' if markets[market].autotrade else '⏹️'} Autotrade для {market}: {state.upper()}"
         )
     except Exception:
         await message.answer("⚠️ Використання: /autotrade BTC/USDT on|off")
@@ -1001,7 +3101,7 @@ async def mode_cmd(message: types.Message):
             return await message.answer("❌ Спочатку додай ринок через /market.")
         if state not in ("manual", "auto"):
             return await message.answer("⚠️ Використання: /mode BTC/USDT manual|auto")
-        markets[market]["mode"] = state
+        markets[market].mode = state
         save_markets()
         await message.answer(f"🧠 Режим для {market}: {state.upper()}")
     except Exception:
@@ -1014,18 +3114,18 @@ async def status_cmd(message: types.Message):
 
     text = "📊 <b>Статус</b>:\n"
     for m, cfg in markets.items():
-        tp = f"{cfg['tp']}%" if cfg.get("tp") is not None else "—"
-        sl = f"{cfg['sl']}%" if cfg.get("sl") is not None else "—"
+        tp = f"{cfg.tp}%" if cfg.tp is not None else "—"
+        sl = f"{cfg.sl}%" if cfg.sl is not None else "—"
         text += (
             f"\n{m}:\n"
             f" TP: {tp}\n"
             f" SL: {sl}\n"
-            f" Buy: {cfg['buy_usdt']} USDT\n"
-            f" Автотрейд: {cfg['autotrade']}\n"
-            f" Rebuy: {cfg.get('rebuy_pct', 0)}%\n"
-            f" Mode: {cfg.get('mode', 'manual')}\n"
-            f" Scalp: {cfg.get('scalp', False)} | Tick: {cfg.get('tick_pct', 0.25)}% | Levels: {cfg.get('levels', 3)}\n"
-            f" Ордерів: {len(cfg.get('orders', []))}\n"
+            f" Buy: {cfg.buy_usdt} USDT\n"
+            f" Автотрейд: {cfg.autotrade}\n"
+            f" Rebuy: {cfg.rebuy_pct}%\n"
+            f" Mode: {cfg.mode}\n"
+            f" Scalp: {cfg.scalp} | Tick: {cfg.tick_pct}% | Levels: {cfg.levels}\n"
+            f" Ордерів: {len(cfg.orders)}\n"
         )
 
     await message.answer(text)
@@ -1068,17 +3168,17 @@ async def cancel_cmd(message: types.Message):
     target = parts[2].lower() if len(parts) >= 3 else None
 
     if target == "all":
-        data = await active_orders(market)
-        lst = data.get("orders", []) if isinstance(data, dict) else []
-        cnt = 0
-        for o in lst:
-            oid = o.get("orderId") or o.get("id")
-            if oid:
-                res = await cancel_order(market, order_id=str(oid))
-                if isinstance(res, dict) and res.get("success") is not False:
-                    cnt += 1
-                await asyncio.sleep(0.15)  # легкий throttling
-        await message.answer(f"🧹 Скасовано {cnt} ордер(и/ів) на {market}.")
+        await open_orders.refresh()
+        cnt = len(open_orders.ids(market))
+        ok = await cancel_all_orders(market)
+        if market in markets:
+            # скасовано вручну — не приймаємо їх зникнення за виконання
+            markets[market].orders.clear()
+            save_markets()
+        if ok:
+            await message.answer(f"🧹 Скасовано {cnt} ордер(и/ів) на {market}.")
+        else:
+            await message.answer(f"⚠️ {market}: скасовано не все — перевір /orders.")
         return
 
     if target:
@@ -1088,6 +3188,25 @@ async def cancel_cmd(message: types.Message):
     else:
         await message.answer("⚠️ Використання: /cancel BTC/USDT 123456 або /cancel BTC/USDT all")
 
+@dp.message(Command("netstats"))
+async def netstats_cmd(message: types.Message):
+    lines = ["📡 <b>Мережа</b>:", "Singleflight (hit/miss):"]
+    for path, st in sorted(singleflight_stats.items()):
+        total = st["hit"] + st["miss"]
+        saved = (100.0 * st["hit"] / total) if total else 0.0
+        lines.append(f" {path}: {st['hit']}/{st['miss']} (зекономлено {saved:.0f}%)")
+    for feed, is_live in ((price_feed, price_feed.alive()), (private_feed, private_feed.live())):
+        ws_state = "живий" if is_live else "немає (REST-фолбек)"
+        lines.append(f"{feed.name}: {ws_state}, оновлень {feed.updates}, reconnect×{feed.reconnects}, "
+                     f"ринків {len(feed.subscribed)}")
+    lines.append("Rate limiter:")
+    for name, b in scheduler.buckets.items():
+        lines.append(f" {name}: {b.rate:.1f}/{b.base_rate:.1f} rps, 429×{b.throttled}, черга {len(b._waiters)}")
+    lat = sl_latency.lines()
+    lines.append("SL: ціна -> захисний ордер:" if lat else "SL: спрацювань ще не було")
+    lines.extend(lat)
+    await message.answer("\n".join(lines))
+
 VERSION = "v4.1.2-hardened"
 @dp.message(Command("version"))
 async def version_cmd(message: types.Message):
@@ -1110,122 +3229,643 @@ def _extract_order_id(resp: dict) -> Optional[str]:
     return None
 
 # >>> REBUY FEATURE: допоміжна функція виставити лімітний BUY на знижці від довідкової ціни
-async def place_limit_buy_at_discount(market: str, cfg: dict, ref_price: float) -> Optional[str]:
-    try:
-        pct = float(cfg.get("rebuy_pct", 0) or 0)
-    except Exception:
-        pct = 0.0
+async def place_limit_buy_at_discount(market: str, cfg: MarketConfig, ref_price: float) -> Optional[str]:
+    pct = cfg.rebuy_pct
     if pct <= 0 or not ref_price or ref_price <= 0:
         return None
+    reason = safety.block_entry_reason(market)
+    if reason:
+        logging.info(f"[SAFETY] {market}: відкуп відкладено — {reason}")
+        return None
 
-    target_price = float(quantize_price(market, ref_price * (1 - pct / 100.0)))
-    spend = Decimal(str(cfg.get("buy_usdt", 10)))
+    rules = get_rules(market)
+    target_price = rules.q_price(_dec(ref_price) * (1 - _dec(pct) / 100))
+    if target_price <= 0:
+        return None
+    spend = cfg.buy_usdt
     spend_adj = (spend * Decimal("0.998")).quantize(Decimal("0.01"), rounding=ROUND_DOWN)
-    if float(spend_adj) <= 0:
+    if spend_adj <= 0:
+        return None
+    usdt = await get_usdt_available()
+    if usdt < spend_adj:
+        logging.info(f"{market}: відкуп відкладено — вільно {usdt} USDT (з урахуванням резервів), треба {spend_adj}")
         return None
 
     # amount у BASE = USDT / price
-    base_amount = quantize_amount(market, float(spend_adj) / target_price)
+    base_amount = rules.q_amount(spend_adj / target_price)
     if base_amount <= 0:
-        base_amount = step_from_precision(get_rules(market)["amount_precision"])
+        base_amount = rules.amount_step
 
     # Доводимо до мінімумів біржі (ceil!)
     base_amount, _ = ensure_minima_for_order(
-        market, side="buy", price=float(target_price),
+        market, side="buy", price=target_price,
         amount_base=base_amount, amount_quote=None
     )
 
     cid = f"wb-{market}-rebuy-{now_ms()}"
     res = await place_limit_order(
-        market, "buy", target_price, float(base_amount),
+        market, "buy", target_price, base_amount,
         client_order_id=cid, post_only=True
     )
     oid = _extract_order_id(res)
     if oid:
-        cfg.setdefault("orders", []).append({"id": oid, "cid": cid, "type": "rebuy", "market": market})
+        cfg.orders.add({"id": oid, "cid": cid, "type": "rebuy", "market": market})
         save_markets()
     return oid
 
-def _pp(market: str, cfg: dict) -> tuple[float, int]:
-    return float(cfg.get("tick_pct", 0.25)), int(cfg.get("levels", 3))
+def _pp(market: str, cfg: MarketConfig) -> tuple[float, int]:
+    return cfg.tick_pct, cfg.levels
 
-async def _place_maker_limit(market, side, price, amount, tag):
-    oid = _extract_order_id(
-        await place_limit_order(market, side, price, amount, client_order_id=tag, post_only=True)
-    )
-    return oid
+# ---------------- SCALP GRID ENGINE ----------------
+# Рівні сітки лежать на незмінній решітці anchor·(1+tick)^k (grid_anchor зберігається у markets.json),
+# тож після зсуву ціни більшість ордерів уже стоїть на «правильних» рівнях і чіпати треба лише різницю.
+GRID_RECENTER_SEC = float(os.getenv("GRID_RECENTER_SEC", "20"))  # не частіше одного перецентрування на ринок
+_grid_next: Dict[str, float] = {}
+
+def grid_tick_ok(market: str, cfg: MarketConfig) -> bool:
+    """Решітка має сенс лише з додатнім кроком (0 — ділення на нуль, мінус — перевернуті рівні)."""
+    if cfg.tick_pct > 0:
+        return True
+    logging.warning(f"[GRID] {market}: tick_pct={cfg.tick_pct} — сітку не веду, задай /settick {market} 0.25")
+    return False
+
+def grid_level(cfg: MarketConfig, price: float) -> float:
+    if not cfg.tick_pct > 0:
+        raise ValueError(f"tick_pct={cfg.tick_pct}: крок решітки має бути > 0")
+    return math.log(float(price) / cfg.grid_anchor) / math.log1p(cfg.tick_pct / 100)
 
-async def seed_scalp_grid(market: str, cfg: dict, ref_price: float):
+def grid_center(cfg: MarketConfig, last: float) -> int:
+    """Індекс рівня решітки, що лежить на ціні або під нею; BUY-драбина — нижче за нього."""
+    return math.floor(grid_level(cfg, last) + 1e-9)
+
+def grid_price(market: str, cfg: MarketConfig, k: int) -> Decimal:
+    return get_rules(market).q_price(_dec(cfg.grid_anchor) * (1 + _dec(cfg.tick_pct) / 100) ** k)
+
+async def recenter_scalp_grid(market: str, cfg: MarketConfig, last: float):
+    """
+    Тримає BUY-драбину з cfg.levels рівнів під ціною (c-levels … c-1) і на кожному тіку
+    порівнює її з живими scalp_buy: зайві (далекі або дублікати рівня) переставляються amend-ом
+    на відсутні рівні — один запит на рівень, — залишок скасовується, нестача добирається bulk-ом.
+    Кількість запитів пропорційна зсуву ціни в рівнях, а не розміру сітки.
+    SELL-и — інвентар із заповнених купівель — не чіпаємо: їх веде ping-pong (on_fill_pingpong).
+    """
+    if not grid_tick_ok(market, cfg):
+        return
+    if not cfg.grid_anchor:
+        cfg.grid_anchor = float(last)
+        save_markets()
+    now = time.monotonic()
+    if now < _grid_next.get(market, 0.0):
+        return
+    c = grid_center(cfg, last)
+    want = set(range(c - cfg.levels, c))
+    held: Dict[int, dict] = {}
+    extra: list = []
+    for e in cfg.orders:
+        if e.get("type") != "scalp_buy" or not e.get("price"):
+            continue
+        k = round(grid_level(cfg, e["price"]))
+        if k >= c:
+            continue  # ціна щойно зайшла на рівень — ордер от-от виконається, не чіпаємо
+        if k in want and k not in held:
+            held[k] = e
+        else:
+            extra.append(e)
+    missing = sorted(want - held.keys(), reverse=True)  # ближчі до ціни — першими
+    if not missing and not extra:
+        return
+    reason = safety.block_entry_reason(market)
+    if reason and missing:
+        logging.info(f"[GRID] {market}: перецентрування відкладено — {reason}")
+        return
+    _grid_next[market] = now + GRID_RECENTER_SEC
+    extra.sort(key=lambda e: e["price"])  # найдальші від ціни — першими на переставляння
+    moves = list(zip(extra, missing))
+    drop = extra[len(moves):]
+    add = missing[len(moves):]
+    sem = asyncio.Semaphore(GRID_PARALLEL)
+
+    async def _move(e: dict, k: int):
+        async with sem:
+            p = grid_price(market, cfg, k)
+            res = await amend_order(market, "buy", e["id"], p, client_order_id=f"wb-{market}-grid-{k}-{now_ms()}")
+        if isinstance(res, dict) and res.get("cancelled"):
+            cfg.orders.pop(e["id"])
+            return
+        new_id = None if _api_failed(res) else _order_id_of(res)
+        if new_id is None:
+            return
+        cfg.orders.pop(e["id"])
+        e.update(id=new_id, price=float(p), level=k)
+        if res.get("clientOrderId"):
+            e["cid"] = str(res["clientOrderId"])
+        else:
+            e.pop("cid", None)
+        cfg.orders.add(e)
+
+    async def _drop(e: dict):
+        async with sem:
+            res = await cancel_order(market, order_id=str(e["id"]))
+        if not _api_failed(res):
+            cfg.orders.pop(e["id"])
+
+    await asyncio.gather(*(_move(e, k) for e, k in moves), *(_drop(e) for e in drop))
+
+    added = 0
+    if add:
+        rules = get_rules(market)
+        spend = cfg.buy_usdt
+        usdt = await get_usdt_available()
+        ts = now_ms()
+        plan = []
+        for k in add:
+            p = grid_price(market, cfg, k)
+            amt = rules.q_amount(spend / p) if p > 0 else Decimal(0)
+            if amt <= 0 or usdt < p * amt:
+                break  # бюджет вичерпано — ближчі рівні вже в плані
+            usdt -= p * amt
+            plan.append({"market": market, "side": "buy", "price": p, "amount": amt, "post_only": True,
+                         "client_order_id": f"wb-{market}-grid-{k}-{ts}", "type": "scalp_buy", "level": k})
+        if plan:
+            results = await place_limit_orders_bulk(plan, priority=PRIO_BULK)
+            for sp, res in zip(plan, results):
+                oid = _extract_order_id(res)
+                if oid:
+                    added += 1
+                    cfg.orders.add({"id": oid, "cid": sp["client_order_id"], "type": "scalp_buy", "market": market,
+                                    "price": float(sp["price"]), "amount": float(sp["amount"]), "level": sp["level"]})
+                else:
+                    logging.warning(f"[GRID] {market} buy@{sp['price']} не виставлено: {res}")
+    save_markets()
+    logging.info(f"[GRID] {market}: центр {c}, переставлено {len(moves)}, знято {len(drop)}, додано {added}")
+
+async def seed_scalp_grid(market: str, cfg: MarketConfig, ref_price: float) -> bool:
+    if not grid_tick_ok(market, cfg):
+        return False
+    reason = safety.block_entry_reason(market)
+    if reason:
+        logging.info(f"[SAFETY] {market}: сітку не виставляю — {reason}")
+        return False
     tick, levels = _pp(market, cfg)
-    spend = Decimal(str(cfg.get("buy_usdt", 5)))
+    spend = cfg.buy_usdt
     base_av = await get_base_available(market)
-    ap = step_from_precision(get_rules(market)["amount_precision"])
-    # BUY-сітка
+    rules = get_rules(market)
+    if cfg.grid_anchor is None:
+        cfg.grid_anchor = float(ref_price)
+    c = grid_center(cfg, ref_price)
+    ts = now_ms()
+    plan = []
+    usdt = await get_usdt_available()
+    # BUY-сітка: рівні решітки під ціною (від ближчих, поки вистачає вільних USDT)
     for i in range(1, levels + 1):
-        p = float(quantize_price(market, ref_price * (1 - (tick * i) / 100)))
-        amt = quantize_amount(market, float((spend / Decimal(str(p)))))
+        p = grid_price(market, cfg, c - i)
+        if p <= 0:
+            continue
+        amt = rules.q_amount(spend / p)
         if amt <= 0:
-            amt = ap
-        tag = f"wb-{market}-scalp-buy-{i}-{now_ms()}"
-        oid = await _place_maker_limit(market, "buy", p, float(amt), tag)
-        if oid:
-            cfg.setdefault("orders", []).append({"id": oid, "type": "scalp_buy", "market": market, "price": p, "amount": float(amt)})
+            amt = rules.amount_step
+        if usdt < p * amt:
+            logging.info(f"[GRID] {market}: USDT вистачило на {i - 1} з {levels} BUY-рівнів")
+            break
+        usdt -= p * amt
+        plan.append({"market": market, "side": "buy", "price": p, "amount": amt, "post_only": True,
+                     "client_order_id": f"wb-{market}-scalp-buy-{i}-{ts}", "type": "scalp_buy", "level": c - i})
     # SELL-сітка (якщо є холдинги)
     if base_av > 0:
-        portion = (base_av / Decimal(max(1, levels))).quantize(Decimal("0.00000001"), rounding=ROUND_DOWN)
-        portion = quantize_amount(market, float(portion))
-        rules = get_rules(market)
-        min_amount = rules.get("min_amount")
-        if min_amount and portion < min_amount:
-             portion = min_amount
+        portion = rules.q_amount(base_av / max(1, levels))
+        if rules.min_amount and portion < rules.min_amount:
+             portion = rules.min_amount
         if portion > 0:
             for i in range(1, levels + 1):
-                p = float(quantize_price(market, ref_price * (1 + (tick * i) / 100)))
-                tag = f"wb-{market}-scalp-sell-{i}-{now_ms()}"
-                oid = await _place_maker_limit(market, "sell", p, float(portion), tag)
-                if oid:
-                    cfg["orders"].append({"id": oid, "type": "scalp_sell", "market": market, "price": p, "amount": float(portion)})
+                p = grid_price(market, cfg, c + i)
+                plan.append({"market": market, "side": "sell", "price": p, "amount": portion, "post_only": True,
+                             "client_order_id": f"wb-{market}-scalp-sell-{i}-{ts}", "type": "scalp_sell",
+                             "level": c + i})
+
+    # вся сітка одним bulk-запитом; результати мапимо назад по рівнях
+    results = await place_limit_orders_bulk(plan, priority=PRIO_BULK)
+    for sp, res in zip(plan, results):
+        oid = _extract_order_id(res)
+        if oid:
+            cfg.orders.add({"id": oid, "cid": sp["client_order_id"], "type": sp["type"], "market": market,
+                            "price": float(sp["price"]), "amount": float(sp["amount"]), "level": sp["level"]})
+        else:
+            logging.warning(f"[GRID] {market} {sp['type']}#{sp['level']} не виставлено: {res}")
     save_markets()
+    return True
 
-async def on_fill_pingpong(market: str, cfg: dict, filled: dict):
-    tick, _ = _pp(market, cfg)
-    typ = filled.get("type")
-    try:
-        price = float(filled.get("price") or 0)
-        amt = float(filled.get("amount") or 0)
-    except Exception:
+async def on_fill_pingpong(market: str, cfg: MarketConfig, fills: list, executed: Optional[Dict[str, dict]] = None):
+    """
+    Контр-ордери на всі заповнення скальп-сітки за тік: scalp_buy -> sell на tick% вище,
+    scalp_sell -> buy на tick% нижче (з grid_anchor — рівно на сусідній рівень решітки).
+    Уся пачка йде одним place_limit_orders_bulk.
+    executed — реальні виконання (executed_fills): ціна/обсяг контр-ордера від фактичної угоди,
+    з урахуванням часткового заповнення; без них — від виставлених price/amount.
+    """
+    if not grid_tick_ok(market, cfg):
         return
-    if price <= 0 or amt <= 0:
+    tick, _ = _pp(market, cfg)
+    rules = get_rules(market)
+    step = _dec(tick) / 100
+    spend = cfg.buy_usdt
+    usdt = None
+    ts = now_ms()
+    plan = []
+    for k, filled in enumerate(fills):
+        typ = filled.get("type")
+        ex = (executed or {}).get(filled.get("id"))
+        try:
+            if ex is not None:
+                price, amt = ex["price"], rules.q_amount(ex["net"])
+            else:
+                price = _dec(filled.get("price") or 0)
+                amt = _dec(filled.get("amount") or 0)
+        except Exception:
+            continue
+        if price <= 0 or amt <= 0:
+            continue
+        if cfg.grid_anchor:
+            # контр-ордер — на сусідній рівень решітки (щоб перецентрування бачило його «своїм»)
+            lvl = round(grid_level(cfg, price))
+            p_up, lvl_up = grid_price(market, cfg, lvl + 1), lvl + 1
+            p_dn, lvl_dn = grid_price(market, cfg, lvl - 1), lvl - 1
+        else:
+            p_up, lvl_up = rules.q_price(price * (1 + step)), filled.get("level")
+            p_dn, lvl_dn = rules.q_price(price * (1 - step)), filled.get("level")
+        if typ == "scalp_buy":
+            cfg.entry_price = float(price)
+            plan.append({"market": market, "side": "sell", "price": p_up,
+                         "amount": amt, "post_only": True, "client_order_id": f"wb-{market}-pp-sell-{ts}-{k}",
+                         "type": "scalp_sell", "level": lvl_up})
+        elif typ == "scalp_sell":
+            p_in = p_dn
+            if p_in <= 0:
+                continue
+            if usdt is None:
+                usdt = await get_usdt_available()
+            amt_in = amt if usdt * Decimal("0.999") >= spend else rules.q_amount(spend / p_in)
+            usdt -= p_in * amt_in  # бюджет на решту покупок цієї ж пачки
+            plan.append({"market": market, "side": "buy", "price": p_in,
+                         "amount": amt_in, "post_only": True, "client_order_id": f"wb-{market}-pp-buy-{ts}-{k}",
+                         "type": "scalp_buy", "level": lvl_dn})
+    if not plan:
         return
-    if typ == "scalp_buy":
-        cfg["entry_price"] = price
-        p_out = float(quantize_price(market, price * (1 + tick / 100)))
-        tag = f"wb-{market}-pp-sell-{now_ms()}"
-        oid = await _place_maker_limit(market, "sell", p_out, amt, tag)
-        if oid:
-            cfg["orders"].append({"id": oid, "type": "scalp_sell", "market": market, "price": p_out, "amount": amt})
-    elif typ == "scalp_sell":
-        p_in = float(quantize_price(market, price * (1 - tick / 100)))
-        spend = Decimal(str(cfg.get("buy_usdt", 5)))
-        usdt = await get_usdt_available()
-        amt_in = amt if usdt * Decimal("0.999") >= spend else quantize_amount(market, float(spend / Decimal(str(p_in))))
-        tag = f"wb-{market}-pp-buy-{now_ms()}"
-        oid = await _place_maker_limit(market, "buy", p_in, float(amt_in), tag)
+    results = await place_limit_orders_bulk(plan, priority=PRIO_TRADE)
+    for sp, res in zip(plan, results):
+        oid = _extract_order_id(res)
         if oid:
-            cfg["orders"].append({"id": oid, "type": "scalp_buy", "market": market, "price": p_in, "amount": float(amt_in)})
+            entry = {"id": oid, "cid": sp["client_order_id"], "type": sp["type"], "market": market,
+                     "price": float(sp["price"]), "amount": float(sp["amount"])}
+            if sp["level"] is not None:
+                entry["level"] = sp["level"]
+            cfg.orders.add(entry)
+        else:
+            logging.warning(f"[PINGPONG] {market} {sp['type']} @ {sp['price']} не виставлено: {res}")
+    save_markets()
+
+# ---------------- NATIVE SL (стоп на біржі) ----------------
+# SL виконує сама біржа (stop-limit або OCO разом з TP) — спрацьовує без нашого циклу і навіть під час рестарту.
+# Монітор лише звіряє стан: ставить стоп, якщо його немає, і підтягує його за піком у режимі trailing.
+SL_NATIVE_SLIP_PCT = float(os.getenv("SL_NATIVE_SLIP_PCT", "0.5"))  # ліміт стопа нижче активації — щоб точно виконався
+SL_TRAIL_MIN_SEC = float(os.getenv("SL_TRAIL_MIN_SEC", "15"))       # переставляти трейлінг-стоп не частіше
+SL_TRAIL_STEP_PCT = float(os.getenv("SL_TRAIL_STEP_PCT", "0.2"))    # і лише коли він піднявся хоча б на стільки
+SL_NATIVE_RETRY = 30.0                                              # повтор після відмови біржі
+_sl_native_next: Dict[str, float] = {}                              # market -> monotonic, раніше якого стоп не чіпаємо
+
+def native_sl_wanted(cfg: MarketConfig) -> bool:
+    # hold_on_sl не продає на SL, а скальп-сітка не має однієї позиції — там SL лишається за монітором
+    return cfg.sl_native and bool(cfg.sl) and not cfg.hold_on_sl and not cfg.scalp
+
+def native_sl_leg(cfg: MarketConfig) -> Optional[dict]:
+    for e in cfg.orders:
+        if e.get("type") == "sl":
+            return e
+    return None
+
+def _sl_activation(cfg: MarketConfig) -> Optional[Decimal]:
+    ref = cfg.peak if cfg.sl_mode == "trailing" and cfg.peak else cfg.entry_price
+    if not ref or not cfg.sl:
+        return None
+    act = _dec(ref) * (1 - _dec(cfg.sl) / 100)
+    # після фіксації прибутку біржовий стоп стоїть не нижче підлоги
+    return max(act, _dec(cfg.profit_floor)) if cfg.profit_floor else act
+
+async def _place_tp(market: str, cfg: MarketConfig, tp_price: Decimal, amount: Decimal) -> Optional[str]:
+    cid = f"wb-{market}-tp-{now_ms()}"
+    res = await place_limit_order(market, "sell", tp_price, amount, client_order_id=cid)
+    oid = _extract_order_id(res)
+    if oid:
+        cfg.orders.add({"id": oid, "cid": cid, "type": "tp", "market": market,
+                        "price": float(tp_price), "amount": float(amount)})
+    return oid
+
+async def arm_native_sl(market: str, cfg: MarketConfig, amount: Decimal, tp_price: Optional[Decimal]) -> bool:
+    """
+    Ставить SL на біржі: з TP — одним OCO (TP-ліміт + stop-limit), без TP — окремим stop-limit.
+    False — біржа відхилила (або нема від чого рахувати стоп); тоді SL лишається за монітором.
+    """
+    rules = get_rules(market)
+    act = _sl_activation(cfg)
+    amount = rules.q_amount(amount)
+    if act is None or amount <= 0:
+        return False
+    act = rules.q_price(act)
+    stop = rules.q_price(act * (1 - _dec(SL_NATIVE_SLIP_PCT) / 100))
+    ts = now_ms()
+    if tp_price:
+        cid = f"wb-{market}-oco-{ts}"
+        res = await place_oco_order(market, "sell", amount, tp_price, act, stop,
+                                    client_order_id=cid, priority=PRIO_CRITICAL)
+        res = res if isinstance(res, dict) else {}
+        oco_id = res.get("id")
+        tp_id = _order_id_of(res.get("take_profit") or {})
+        sl_id = _order_id_of(res.get("stop_loss") or {})
+        if not (oco_id and tp_id and sl_id):
+            logging.warning(f"[SL-NATIVE] {market}: OCO не виставлено: {str(res)[:200]}")
+            return False
+        cfg.orders.add({"id": tp_id, "cid": cid, "type": "tp", "market": market, "price": float(tp_price),
+                        "amount": float(amount), "oco": str(oco_id)})
+        cfg.orders.add({"id": sl_id, "type": "sl", "market": market, "activation": float(act),
+                        "amount": float(amount), "oco": str(oco_id)})
+    else:
+        cid = f"wb-{market}-sl-{ts}"
+        res = await place_stop_limit_order(market, "sell", amount, act, stop,
+                                           client_order_id=cid, priority=PRIO_CRITICAL)
+        oid = _extract_order_id(res)
+        if not oid:
+            logging.warning(f"[SL-NATIVE] {market}: stop-limit не виставлено: {str(res)[:200]}")
+            return False
+        cfg.orders.add({"id": oid, "cid": cid, "type": "sl", "market": market, "activation": float(act),
+                        "amount": float(amount)})
+    logging.info(f"[SL-NATIVE] {market}: стоп {act} (ліміт {stop}) на {amount}" + (f", TP {tp_price}" if tp_price else ""))
+    save_markets()
+    return True
+
+async def disarm_native_sl(market: str, cfg: MarketConfig, restore_tp: bool = False) -> Optional[dict]:
+    """
+    Знімає стоп з біржі (OCO — разом з його TP-ногою). Повертає зняту ногу SL або None,
+    якщо стопа не було чи біржа не скасувала (ймовірно, він уже виконується — це побачить детект).
+    restore_tp=True — TP з OCO повертаємо звичайним лімітом.
+    """
+    leg = native_sl_leg(cfg)
+    if leg is None:
+        return None
+    oco = leg.get("oco")
+    if oco:
+        res = await cancel_oco_order(market, oco, priority=PRIO_CRITICAL)
+    else:
+        res = await cancel_order(market, order_id=leg["id"], priority=PRIO_CRITICAL)
+    if _api_failed(res):
+        logging.warning(f"[SL-NATIVE] {market}: не вдалося зняти стоп {leg['id']}: {str(res)[:200]}")
+        return None
+    legs = [e for e in cfg.orders if oco and e.get("oco") == oco] or [leg]
+    for e in legs:
+        cfg.orders.pop(e["id"])
+        open_orders.discard(market, e["id"])
+    tp = next((e for e in legs if e.get("type") == "tp"), None)
+    if restore_tp and tp is not None and tp.get("price"):
+        await _place_tp(market, cfg, _dec(tp["price"]), _dec(tp["amount"]))
+    save_markets()
+    return leg
+
+async def trail_native_sl(market: str, cfg: MarketConfig):
+    """Трейлінг: переставляємо стоп за піком — не частіше SL_TRAIL_MIN_SEC і з кроком ≥ SL_TRAIL_STEP_PCT."""
+    leg = native_sl_leg(cfg)
+    act = _sl_activation(cfg)
+    if leg is None or act is None:
+        return
+    cur = _dec(leg.get("activation") or 0)
+    now = time.monotonic()
+    if act <= cur * (1 + _dec(SL_TRAIL_STEP_PCT) / 100) or now < _sl_native_next.get(market, 0.0):
+        return
+    _sl_native_next[market] = now + SL_TRAIL_MIN_SEC
+    tp = next((e for e in cfg.orders if leg.get("oco") and e.get("oco") == leg["oco"] and e.get("type") == "tp"), None)
+    tp_price = _dec(tp["price"]) if tp is not None and tp.get("price") else None
+    if await disarm_native_sl(market, cfg) is None:
+        return
+    if not await arm_native_sl(market, cfg, _dec(leg["amount"]), tp_price):
+        # стоп не повернувся — SL знову за монітором, а TP ставимо звичайним лімітом
+        logging.warning(f"[SL-NATIVE] {market}: трейлінг-стоп не переставлено, SL повертається під монітор")
+        if tp_price:
+            await _place_tp(market, cfg, tp_price, _dec(leg["amount"]))
+        save_markets()
+
+async def ensure_native_sl(market: str, cfg: MarketConfig):
+    """
+    Позиція відкрита, а стопа на біржі немає (/slnative увімкнули посеред угоди, або біржа відхилила):
+    звичайний TP перетворюємо на OCO, без TP — ставимо stop-limit на холдинг. Повтор не частіше SL_NATIVE_RETRY.
+    """
+    if native_sl_leg(cfg) is not None or not cfg.entry_price:
+        return
+    now = time.monotonic()
+    if now < _sl_native_next.get(market, 0.0):
+        return
+    _sl_native_next[market] = now + SL_NATIVE_RETRY
+    tp = next((e for e in cfg.orders if e.get("type") == "tp"), None)
+    if tp is None and len(cfg.orders):
+        return  # чекаємо на інший ордер (напр. rebuy) — позиції під стоп ще немає
+    if tp is not None:
+        amount = _dec(tp.get("amount") or 0)
+        tp_price = _dec(tp.get("price") or cfg.last_tp_price or 0)
+        if amount <= 0 or tp_price <= 0:
+            return
+        res = await cancel_order(market, order_id=tp["id"], priority=PRIO_CRITICAL)
+        if _api_failed(res):
+            return
+        cfg.orders.pop(tp["id"])
+        if not await arm_native_sl(market, cfg, amount, tp_price):
+            await _place_tp(market, cfg, tp_price, amount)
+        save_markets()
+    else:
+        rules = get_rules(market)
+        amount = rules.q_amount(await get_base_available(market) * Decimal("0.995"))
+        if amount > 0 and amount >= (rules.min_amount or 0):
+            await arm_native_sl(market, cfg, amount, None)
+
+# ---------------- TRAILING TP ----------------
+# Коли ціна біжить угору, TP переставляється вище (SafetyManager.should_lock_profit) одним amend-запитом.
+TP_TRAIL_MIN_SEC = float(os.getenv("TP_TRAIL_MIN_SEC", "10"))     # не частіше одного amend на ринок
+TP_TRAIL_STEP_PCT = float(os.getenv("TP_TRAIL_STEP_PCT", "0.15"))  # і лише якщо TP піднімається хоча б на стільки
+_tp_trail_next: Dict[str, float] = {}
+
+async def raise_profit_floor(market: str, cfg: MarketConfig, last: Decimal):
+    """
+    Фіксація прибутку: TP лише відсувається вгору, тож при розвороті без підлоги позиція повернулась би до SL.
+    Підлогу тримає TriggerIndex (вихід ринком на тіку); біржовий стоп OCO до неї підтягує переставлення
+    OCO нижче або наступний тік монітора (trail_native_sl) — будимо його одразу.
+    """
+    floor = safety.profit_floor(market, last)
+    if floor is None:
+        return
+    floor = get_rules(market).q_price(floor)
+    if cfg.profit_floor and floor <= _dec(cfg.profit_floor):
+        return
+    cfg.profit_floor = float(floor)
+    save_markets()
+    triggers.sync(market, cfg)
+    logging.info(f"[TP-TRAIL] {market}: підлога прибутку {floor} (ціна {last})")
+    if native_sl_leg(cfg) is not None:
+        supervisor.wake(market)
+
+async def trail_tp(market: str, cfg: MarketConfig, last: Decimal):
+    tp = next((e for e in cfg.orders if e.get("type") == "tp"), None)
+    if tp is None or not tp.get("price"):
+        return
+    st = safety.by_pair.get(market)
+    if cfg.entry_price and (st is None or st.position_qty <= 0):
+        # після рестарту позиції в SafetyManager немає — відновлюємо з конфігу
+        safety.update_position(market, _dec(cfg.entry_price), _dec(tp.get("amount") or 0))
+    await raise_profit_floor(market, cfg, last)
+    want = safety.should_lock_profit(market, last)
+    if want is None:
+        return
+    want = get_rules(market).q_price(want)
+    cur = _dec(tp["price"])
+    now = time.monotonic()
+    if want <= cur * (1 + _dec(TP_TRAIL_STEP_PCT) / 100) or now < _tp_trail_next.get(market, 0.0):
+        return
+    _tp_trail_next[market] = now + TP_TRAIL_MIN_SEC
+
+    if tp.get("oco"):
+        # ногу OCO окремо не змінити — переставляємо OCO цілком (стоп перерахується від поточного піку)
+        leg = await disarm_native_sl(market, cfg)
+        if leg is None:
+            return
+        if not await arm_native_sl(market, cfg, _dec(leg["amount"]), want):
+            await _place_tp(market, cfg, want, _dec(leg["amount"]))
+    else:
+        res = await amend_order(market, "sell", tp["id"], want,
+                                client_order_id=f"wb-{market}-tp-{now_ms()}", priority=PRIO_TRADE)
+        new_id = None if _api_failed(res) else _order_id_of(res)
+        if new_id is None:
+            if isinstance(res, dict) and res.get("cancelled"):
+                # cancel-replace не завершився — повертаємо TP на стару ціну
+                cfg.orders.pop(tp["id"])
+                await _place_tp(market, cfg, cur, _dec(tp.get("amount") or 0))
+                save_markets()
+            return
+        if new_id != tp["id"]:
+            cfg.orders.pop(tp["id"])
+            tp["id"] = new_id
+            if res.get("clientOrderId"):
+                tp["cid"] = str(res["clientOrderId"])
+            else:
+                tp.pop("cid", None)
+            cfg.orders.add(tp)
+        tp["price"] = float(want)
+    cfg.last_tp_price = float(want)
+    save_markets()
+    logging.info(f"[TP-TRAIL] {market}: TP {cur} -> {want} (ціна {last})")
+
+# ---------------- SL EXECUTION ----------------
+def sl_breach(cfg: MarketConfig, price: float) -> Optional[str]:
+    """Причина захисного виходу при ціні price ("lock" | "sl" | "trailing" | "auto_dd") або None."""
+    if cfg.profit_floor and cfg.entry_price and native_sl_leg(cfg) is None and price <= cfg.profit_floor:
+        return "lock"
+    sl = cfg.sl or 0.0
+    if sl > 0 and native_sl_leg(cfg) is None:
+        if cfg.sl_mode == "trigger" and cfg.entry_price and price <= cfg.entry_price * (1 - sl / 100):
+            return "sl"
+        if cfg.sl_mode == "trailing" and cfg.peak and price <= cfg.peak * (1 - sl / 100):
+            return "trailing"
+    dd = cfg.dd_pct()
+    if dd > 0 and cfg.entry_price and price <= cfg.entry_price * (1 - dd / 100):
+        return "auto_dd"
+    return None
+
+async def execute_sl(market: str, cfg: MarketConfig, reason: str, t0: Optional[float] = None,
+                     source: str = "monitor"):
+    """
+    Захисний вихід: усі ордери ринку знімаються одним cancel-all, одразу після нього — ринковий sell
+    (або «заморозка» при hold_on_sl). Викликати під supervisor.exit_lock(market).
+    t0 — time.monotonic() отримання ціни, що спрацювала; source — хто помітив ("tick" | "monitor").
+    """
+    if time.monotonic() < triggers.backoff.get(market, 0.0):
+        return
+    logging.warning(f"[SL] {market}: {reason} — захисний вихід")
+    if native_sl_leg(cfg) is not None and await disarm_native_sl(market, cfg) is None:
+        # біржовий стоп уже виконується (або біржа недоступна) — результат побачить детект;
+        # не повторюємо oco-cancel на кожному тіку
+        triggers.backoff[market] = time.monotonic() + SL_NATIVE_RETRY
+        return
+    triggers.backoff.pop(market, None)
+    # скільки монет звільниться — зі знімка ДО скасування (available + freeze під нашими sell)
+    await get_balance(priority=PRIO_CRITICAL)
+    base = base_symbol_from_market(market)
+    base_total = balances.total(base)
+    # скасовуємо всі ліміти одним запитом
+    await cancel_all_orders(market, priority=PRIO_CRITICAL)
+    cfg.orders.clear()
     save_markets()
 
+    if cfg.hold_on_sl and reason != "lock":
+        # ✅ Мʼякий SL: НЕ продаємо ринком, «заморожуємо» холдинг до ап-тренду
+        cfg.holdings_lock = True
+        save_markets()
+        if cfg.chat_id:
+            await bot.send_message(
+                cfg.chat_id,
+                f"🟡 {market}: SL-тригер. Монети залишено (hold_on_sl=ON). Чекаю ап-тренду."
+            )
+    else:
+        # звичайна поведінка: продати ринком усе — одразу після підтвердження скасування
+        sold = None
+        if base_total > 0:
+            sl_latency.observe(source, t0)
+            sold = await place_market_order(market, "sell", base_total, priority=PRIO_CRITICAL)
+        if sold is None or _api_failed(sold):
+            # знімок був застарілий (напр. частина sell уже виконалась) — продаємо фактичний залишок
+            await balances.get(force=True, priority=PRIO_CRITICAL)
+            base_av = balances.available(base)
+            if base_av > 0:
+                sold = await place_market_order(market, "sell", base_av, priority=PRIO_CRITICAL)
+        if sold is not None and not _api_failed(sold) and cfg.chat_id:
+            text = (f"💰 {market}: фіксація прибутку (≤ {cfg.profit_floor}), продано ринком." if reason == "lock"
+                    else f"🛑 {market}: SL спрацював, продано ринком.")
+            await bot.send_message(cfg.chat_id, text)
+
+    # скинути референси
+    cfg.entry_price = None
+    cfg.peak = None
+    cfg.profit_floor = None
+    safety.update_position(market, Decimal(0), Decimal(0))
+    triggers.sync(market, cfg)
+    save_markets()
 
-async def start_new_trade(market: str, cfg: dict):
-    # 1) Баланс до
-    balances_before = await get_balance()
-    usdt_av = (balances_before.get("USDT") or {}).get("available", 0)
+async def fire_sl(market: str, price: float, t0: float):
+    """
+    Спрацювання з TriggerIndex: та сама дія, що й у моніторі, але одразу на тіку ціни.
+    Тік воркера не чекаємо (він може висіти на HTTP-ретраях) — обриваємо його і виходимо під exit_lock.
+    """
     try:
-        usdt = float(usdt_av)
-    except Exception:
-        usdt = 0.0
+        cfg = markets.get(market)
+        if cfg is None or not sl_breach(cfg, price):
+            if cfg is not None:
+                triggers.sync(market, cfg)
+            return
+        supervisor.preempt(market)
+        async with supervisor.exit_lock(market):
+            cfg = markets.get(market)
+            # поки чекали лок, монітор міг уже закрити позицію — перевіряємо заново
+            reason = sl_breach(cfg, price) if cfg is not None else None
+            if reason:
+                await execute_sl(market, cfg, reason, t0, source="tick")
+            elif cfg is not None:
+                triggers.sync(market, cfg)
+    except Exception as e:
+        logging.exception(f"[TRIGGER] {market}: помилка SL: {e}")
+    finally:
+        triggers.firing.discard(market)
+
+async def start_new_trade(market: str, cfg: MarketConfig):
+    reason = safety.block_entry_reason(market)
+    if reason:
+        logging.info(f"[SAFETY] {market}: вхід заблоковано — {reason}")
+        return
+    # 1) Вільні USDT (зі спільного кешу балансу)
+    usdt = float(await get_usdt_available())
 
-    spend = float(cfg.get("buy_usdt", 10.0))
+    spend = float(cfg.buy_usdt)
 
     # >>> Перевіряємо мінімальну суму для ринку (min_total)
     _, spend_dec = ensure_minima_for_order(market, "buy", price=None,
@@ -1242,22 +3882,12 @@ async def start_new_trade(market: str, cfg: dict):
         logging.error(f"Не вдалося отримати last_price для {market}.")
         return
 
-    # --- SAFETY ГЕЙТ ПЕРЕД ВХОДОМ (ВСТАВИТИ САМЕ ТУТ) ---
-    # Якщо останнє «вікно» тренду ще активне і падіння >= auto_down_pct — пропускаємо вхід
-    try:
-        ref_p = cfg.get("trend_ref_price")
-        ref_ts = int(cfg.get("trend_ref_ts") or 0)
-        window_ms = int(cfg.get("trend_window_s", 300)) * 1000
-        now = now_ms()
-        if ref_p and (now - ref_ts) < window_ms:
-            chg_pct = (float(last_price) / float(ref_p) - 1.0) * 100.0
-            down_thr = float(cfg.get("auto_down_pct", -1.5))
-            if chg_pct <= down_thr:
-                logging.info(f"[SAFETY] Skip entry {market}: drop {chg_pct:.2f}% ≤ {down_thr}% (window active)")
-                return
-    except Exception as e:
-        logging.warning(f"[SAFETY] check error for {market}: {e}")
-    # --- КІНЕЦЬ SAFETY ГЕЙТУ ---
+    # --- SAFETY ГЕЙТ ПЕРЕД ВХОДОМ ---
+    # Якщо за вікно тренду ринок падає сильніше за auto_down_pct — пропускаємо вхід
+    chg_pct = trends.change_pct(market)
+    if chg_pct is not None and chg_pct <= cfg.auto_down_pct:
+        logging.info(f"[SAFETY] Skip entry {market}: trend {chg_pct:.2f}% ≤ {cfg.auto_down_pct}%")
+        return
 
     # 3) Маркет-купівля
     buy_res = await place_market_order(market, "buy", spend)
@@ -1266,93 +3896,89 @@ async def start_new_trade(market: str, cfg: dict):
         return
     logging.info(f"BUY placed: {buy_res}")
 
-    # 4) Баланс після — фактично куплена базова кількість
-    balances_after = await get_balance()
-
-    def _f(v):
-        try:
-            return float(v)
-        except:
-            return 0.0
-
-    base_symbol = base_symbol_from_market(market)
-    base_before = _f((balances_before.get(base_symbol) or {}).get("available", 0))
-    base_after  = _f((balances_after.get(base_symbol)  or {}).get("available", 0))
-    base_amount = round(max(base_after - base_before, 0.0), 8)
-
-    if base_amount <= 0:
-        base_amount = round(spend / last_price, 8)
+    # 4) Фактичне виконання: dealStock/dealMoney з відповіді, інакше — угоди цього ордера з історії
+    fill = _deal_fill(buy_res.get("dealStock") or 0, buy_res.get("dealMoney") or 0,
+                      buy_res.get("dealFee") or 0, "buy", None, market)
+    oid = _extract_order_id(buy_res)
+    if fill is None and oid and await deals.refresh(force=True):
+        fill = deals.fill(oid)
+    if fill is not None:
+        entry = fill["price"]
+        base_amount = get_rules(market).q_amount(fill["net"])
+    else:
+        # останній фолбек — оцінка за last_price
+        entry = _dec(last_price)
+        base_amount = get_rules(market).q_amount(_dec(spend) / entry)
     if base_amount <= 0:
-        logging.error(f"Нульовий обсяг базової монети після купівлі: spend={spend}, price={last_price}")
+        logging.error(f"Нульовий обсяг базової монети після купівлі: spend={spend}, fill={fill}")
         return
 
     # 5) Створення TP/SL як окремих лімітів
-    # >>> NEW: референт для SL (trigger/trailing)
-    cfg["entry_price"] = float(last_price)
-    cfg["peak"] = float(last_price)
-
-    # 5) Створення лише TP (SL як ліміт не ставимо — SL зробить монітор ринковим)
-    cfg["orders"] = []
-    ts = now_ms()
-
-    if cfg.get("tp"):
-        tp_price = float(quantize_price(market, last_price * (1 + float(cfg["tp"]) / 100)))
-        cfg["last_tp_price"] = tp_price
-        cid = f"wb-{market}-tp-{ts}"
-        tp_order = await place_limit_order(market, "sell", tp_price, base_amount, client_order_id=cid)
-        oid = _extract_order_id(tp_order)
-        if oid:
-            cfg["orders"].append({"id": oid, "cid": cid, "type": "tp", "market": market})
-
+    # >>> NEW: референт для SL (trigger/trailing) — реальна середня ціна входу
+    cfg.entry_price = float(entry)
+    cfg.peak = float(entry)
+    cfg.profit_floor = None
+    safety.update_position(market, entry, base_amount)
+
+    # 5) TP; SL — або стоп-ордером на біржі (sl_native), або монітором ринковим продажем
+    cfg.orders.clear()
+
+    tp_price = None
+    if cfg.tp:
+        tp_price = quantize_price(market, entry * (1 + _dec(cfg.tp) / 100))
+        cfg.last_tp_price = float(tp_price)
+    # нативний SL: TP і стоп одним OCO (або окремий stop-limit); відмова біржі — звичайний TP, SL за монітором
+    if not (native_sl_wanted(cfg) and await arm_native_sl(market, cfg, base_amount, tp_price)) and tp_price:
+        await _place_tp(market, cfg, tp_price, base_amount)
+
+    triggers.sync(market, cfg)  # рівні SL/auto-dd від нового входу — одразу, не чекаючи тіку монітора
     save_markets()
 
 # --- NEW: старт TP/SL від уже наявних монет (без купівлі) ---
-async def place_tp_sl_from_holdings(market: str, cfg: dict) -> bool:
+async def place_tp_sl_from_holdings(market: str, cfg: MarketConfig) -> bool:
     last_price = await get_last_price(market)
     if not last_price or last_price <= 0:
         logging.error(f"[HOLDINGS] Не вдалося отримати last_price для {market}.")
         return False
 
     # референти для SL trigger/trailing
-    cfg["entry_price"] = float(last_price)
-    cfg["peak"] = float(last_price)
+    cfg.entry_price = float(last_price)
+    cfg.peak = float(last_price)
+    cfg.profit_floor = None
 
     base_av = await get_base_available(market)
     # буфер 0.5% від холдингів + квантизація до кроку
-    safe_amount = (base_av * Decimal("0.995")).quantize(Decimal("0.00000001"), rounding=ROUND_DOWN)
-    safe_amount = quantize_amount(market, float(safe_amount))
+    rules = get_rules(market)
+    safe_amount = rules.q_amount(base_av * Decimal("0.995"))
 
     if safe_amount <= 0:
         logging.info(f"[HOLDINGS] Немає базового балансу для {market}. base_av={base_av}")
         return False
+    safety.update_position(market, _dec(last_price), safe_amount)
 
-    cfg["orders"] = []
-    ts = now_ms()
+    cfg.orders.clear()
 
     # --- TP тільки якщо проходить мінімалки
-    if cfg.get("tp"):
-        tp_price = float(quantize_price(market, float(last_price) * (1 + float(cfg["tp"]) / 100)))
-        cfg["last_tp_price"] = tp_price
-        rules = get_rules(market)
-        min_total = rules.get("min_total")
+    if cfg.tp:
+        tp_price = rules.q_price(_dec(last_price) * (1 + _dec(cfg.tp) / 100))
+        cfg.last_tp_price = float(tp_price)
+        min_total = rules.min_total
         can_place_tp = True
         if min_total:
-            est_total = Decimal(str(tp_price)) * Decimal(str(safe_amount))
+            est_total = tp_price * safe_amount
             if est_total < min_total:
                 can_place_tp = False
                 logging.warning(f"[HOLDINGS-TP] {market}: safe_amount*TP({tp_price}) < min_total ({min_total}). Пропускаю TP.")
         if can_place_tp:
-            cid = f"wb-{market}-tp-{ts}"
-            tp_order = await place_limit_order(market, "sell", tp_price, float(safe_amount), client_order_id=cid)
-            oid = _extract_order_id(tp_order)
-            if oid:
-                cfg["orders"].append({"id": oid, "cid": cid, "type": "tp", "market": market})
+            if not (native_sl_wanted(cfg) and await arm_native_sl(market, cfg, safe_amount, tp_price)):
+                await _place_tp(market, cfg, tp_price, safe_amount)
 
-    # SL-ліміт НЕ ставимо — зробить монітор ринком при тригері
+    # без sl_native SL-ліміт НЕ ставимо — зробить монітор/тригер ринком
+    triggers.sync(market, cfg)
     save_markets()
-    created = len(cfg.get("orders", [])) > 0
+    created = len(cfg.orders) > 0
     if created:
-        logging.info(f"[HOLDINGS] Для {market} створений TP від холдингів: {cfg['orders']}")
+        logging.info(f"[HOLDINGS] Для {market} створений TP від холдингів: {cfg.orders}")
     else:
         logging.warning(f"[HOLDINGS] Не вдалося створити TP для {market}.")
     return created
@@ -1365,8 +3991,12 @@ async def buy_cmd(message: types.Message):
         if market not in markets:
             await message.answer("❌ Спочатку додай ринок через /market.")
             return
-        await start_new_trade(market, markets[market])
-        await message.answer(f"✅ Купівля {market} виконана на {markets[market]['buy_usdt']} USDT.")
+        if not await ensure_market_rules(market):
+            await message.answer(f"❌ Немає правил біржі для {market}, спробуй пізніше.")
+            return
+        async with supervisor.lock(market):
+            await start_new_trade(market, markets[market])
+        await message.answer(f"✅ Купівля {market} виконана на {markets[market].buy_usdt} USDT.")
     except Exception:
         await message.answer("⚠️ Використання: /buy BTC/USDT")
 
@@ -1378,6 +4008,9 @@ async def removemarket_cmd(message: types.Message):
         if market in markets:
             del markets[market]
             save_markets()
+            supervisor.sync()
+            price_feed.resubscribe()
+            private_feed.resubscribe()
             await message.answer(f"🗑️ Видалено {market}")
         else:
             await message.answer("❌ Ринок не знайдено.")
@@ -1388,283 +4021,426 @@ async def removemarket_cmd(message: types.Message):
 async def stop_cmd(message: types.Message):
     markets.clear()
     save_markets()
+    supervisor.sync()
+    price_feed.resubscribe()
+    private_feed.resubscribe()
     await message.answer("⏹️ Торгівлю зупинено. Всі ринки очищено.")
 
 @dp.message(Command("restart"))
 async def restart_cmd(message: types.Message):
     for m in markets:
-        markets[m]["orders"] = []
+        markets[m].orders.clear()
     save_markets()
     await message.answer("🔄 Логіку перезапущено.")
 
 # ---------------- MONITOR ----------------
-async def monitor_orders():
+MONITOR_INTERVAL = float(os.getenv("MONITOR_INTERVAL", "2"))     # сек між тіками одного ринку
+MONITOR_MAX_BACKOFF = float(os.getenv("MONITOR_MAX_BACKOFF", "30"))
+
+_deferred_pingpong: Dict[str, list] = {}  # market -> [(scalp-заповнення, executed)], поки немає правил ринку
+
+async def monitor_market(market: str):
     """
-    Частий монітор: ~2с.
+    Один тік монітора для одного ринку (~2с, кожен ринок у власному воркері).
     Логіка:
-      - AUTO MODE: оновлення референсу, визначення тренду, підміна профілю.
+      - AUTO MODE: підміна профілю на підтверджену зміну режиму TrendEngine.
       - HOLD-on-SL: «розмороження» лише на ап-тренді.
       - Trigger/Trailing SL: при тригері — скасувати ліміти, далі sell market або hold.
       - Детект завершених ордерів: порівнюємо відстежувані vs активні.
       - Autostart: якщо немає активних і відстежуваних — старт від холдингів або купівля; для scalp — посів сітки.
     """
-    while True:
-        try:
-            for market, cfg in list(markets.items()):
-                cfg = _normalize_market_cfg(cfg)  # захист від «дірявих» конфігів
+    cfg = markets.get(market)
+    if cfg is None:
+        return
+    # без точності/мінімалок біржі нові ордери відхилять — їх ставимо лише з правилами;
+    # SL і звірку ордерів ведемо завжди (ринковий вихід — з дефолтною точністю)
+    rules_ok = await ensure_market_rules(market)
+    # спільні знімки з TTL: один bulk-тікер (лише коли WS не дає живої ціни) і один список ордерів на всі воркери
+    if not price_feed.live(market):
+        await tickers.refresh()
+    if not private_feed.live():
+        await open_orders.refresh()
+
+    # --- AUTO MODE: профіль перемикається лише на підтверджену зміну режиму (TrendEngine)
+    if cfg.mode == "auto":
+        switched = trends.pop_switch(market)
+        if switched:
+            cfg.apply_profile(cfg.profile_up if switched == "up" else cfg.profile_down)
+            save_markets()
+            logging.info(f"[AUTO] {market}: режим {switched} — профіль застосовано")
+
+        # 🟢 якщо монети були «заморожені» після SL — відновлюємо тільки на ап-тренді
+        if trends.regime(market) == "up" and cfg.holdings_lock:
+            ok = await place_tp_sl_from_holdings(market, cfg)
+            if ok and cfg.chat_id:
+                await bot.send_message(cfg.chat_id, f"🟢 {market}: ап-тренд. Виставлено TP від холдингів.")
+            cfg.holdings_lock = False
+            save_markets()
 
-                # --- AUTO MODE: визначення тренду і підміна профілю
-                if cfg.get("mode") == "auto":
-                    lp = await get_last_price(market)
-                    if lp:
-                        safety.note_price(market, Decimal(str(lp)), time.time())
-                        now = now_ms()
-                        ref_p = cfg.get("trend_ref_price")
-                        ref_ts = int(cfg.get("trend_ref_ts") or 0)
-                        window_ms = int(cfg.get("trend_window_s", 300)) * 1000
-
-                        # ініціалізація референсу
-                        if not ref_p or (now - ref_ts) > window_ms:
-                            cfg["trend_ref_price"] = float(lp)
-                            cfg["trend_ref_ts"] = now
-                            save_markets()
-                            want = None
-                        else:
-                            # відносна зміна за вікно
-                            chg_pct = (float(lp) / float(ref_p) - 1.0) * 100.0
-                            down_thr = float(cfg.get("auto_down_pct", -1.5))
-                            up_thr   = float(cfg.get("auto_up_pct", 1.0))
-
-                            want = None
-                            if chg_pct <= down_thr:
-                                want = "down"
-                            elif chg_pct >= up_thr:
-                                want = "up"
-
-                            if want:
-                                prof = cfg.get(f"profile_{want}") or {}
-                                for k in ("tp", "sl", "rebuy_pct", "scalp", "tick_pct", "levels"):
-                                    if k in prof:
-                                        cfg[k] = prof[k]
-                                save_markets()
-                    else:
-                        want = None
-                else:
-                    want = None  # у manual режимі не перемикаємо профілі
-
-                # 🟢 якщо монети були «заморожені» після SL — відновлюємо тільки на ап-тренді
-                if cfg.get("mode") == "auto":
-                    if want == "up" and cfg.get("holdings_lock"):
-                        ok = await place_tp_sl_from_holdings(market, cfg)
-                        if ok and cfg.get("chat_id"):
-                            await bot.send_message(cfg["chat_id"], f"🟢 {market}: ап-тренд. Виставлено TP від холдингів.")
-                        cfg["holdings_lock"] = False
-                        save_markets()
-
-                # --- HARD/TRAILING SL ---
-                try:
-                    sl_pct = float(cfg.get("sl") or 0)
-                except Exception:
-                    sl_pct = 0.0
+    # --- HARD/TRAILING SL / AUTO-DD ---
+    # на кожній ціні їх уже перевіряє triggers (on_price_update); тут — страховка і обслуговування стану
+    if not native_sl_wanted(cfg) and native_sl_leg(cfg) is not None and rules_ok:
+        # /slnative off, /holdsl on або sl=0 — знімаємо стоп з біржі, TP лишаємо звичайним лімітом
+        await disarm_native_sl(market, cfg, restore_tp=True)
+
+    if (cfg.sl or 0) > 0 or cfg.dd_pct() > 0 or cfg.profit_floor:
+        t0 = time.monotonic()
+        lp = await get_last_price(market)
+        if lp:
+            if cfg.sl_mode == "trailing" and cfg.entry_price and lp > (cfg.peak or 0):
+                cfg.peak = lp
+                save_markets()
+
+            reason = sl_breach(cfg, lp)
+            if reason:
+                async with supervisor.exit_lock(market):
+                    # тік-тригер міг закрити позицію, поки чекали лок
+                    if sl_breach(cfg, lp):
+                        await execute_sl(market, cfg, reason, t0)
+                return  # до наступної пари
+            if native_sl_leg(cfg) is not None:
+                # стоп уже стоїть на біржі: тут лише підтягуємо його за піком / до підлоги прибутку, продасть сама біржа
+                if (cfg.sl_mode == "trailing" or cfg.profit_floor) and rules_ok:
+                    await trail_native_sl(market, cfg)
+            elif native_sl_wanted(cfg) and rules_ok:
+                await ensure_native_sl(market, cfg)
+    triggers.sync(market, cfg)
+
+    # --- TRAILING TP (не для скальп-сітки) ---
+    if cfg.tp and not cfg.scalp and safety.cfg.auto_profit_fix_enabled and rules_ok:
+        lp = await get_last_price(market)
+        if lp:
+            await trail_tp(market, cfg, _dec(lp))
+
+    # --- ДЕТЕКТ ЗАКРИТИХ ОРДЕРІВ ---
+    if rules_ok and market in _deferred_pingpong:
+        for fills, executed in _deferred_pingpong.pop(market):
+            await on_fill_pingpong(market, cfg, fills, executed)
+    if not open_orders.ok:
+        # без валідного знімка не можемо відрізнити «закритий» від «невідомо»
+        return
+    active_ids = open_orders.ids(market)
+    events: Dict[str, dict] = {}
+    refreshed = False
+    if private_feed.live():
+        # події приватного WS: знаємо, що саме сталося (виконання чи скасування), без запиту на тік
+        finished = []
+        events = private_feed.drain(market)
+        for oid, ev in events.items():
+            entry = cfg.orders.get(oid)
+            if entry is None:
+                continue
+            if ev["kind"] == "cancel":
+                logging.info(f"[ORDERS] {market}: ордер {oid} скасовано поза ботом — прибираю з відстеження")
+                cfg.orders.pop(oid)
+                save_markets()
+            else:
+                finished.append(entry)
+    else:
+        finished = [e for e in cfg.orders if e["id"] not in active_ids]
+        refreshed = bool(finished) and await deals.refresh(force=True)
+    executed: Dict[str, dict] = {}
+    if finished:
+        balances.invalidate()  # заповнення змінило баланс
+        executed = await executed_fills(market, finished, events, refreshed)
+        for e in finished:
+            f = executed.get(e["id"])
+            capital.close(e["id"], f["money"] if f else None)
+    chat_id = cfg.chat_id
+
+    # 🔧 Скальп: обробляємо ВСІ заповнення тіку разом, сітку не чистимо і інші ордери не скасовуємо
+    scalp_fills, other_fills = [], []
+    for e in finished:
+        (scalp_fills if cfg.scalp and str(e.get("type", "")).startswith("scalp") else other_fills).append(e)
+    if scalp_fills:
+        for e in scalp_fills:
+            cfg.orders.pop(e["id"])
+        save_markets()
+        if chat_id:
+            ids = ", ".join(f"{e['id']} ({e['type']})" for e in scalp_fills)
+            await bot.send_message(chat_id=chat_id, text=f"✅ {market}: закрито {ids}!")
+        if rules_ok:
+            await on_fill_pingpong(market, cfg, scalp_fills, executed)
+        else:
+            # контр-ордери поставимо, щойно будуть правила ринку
+            _deferred_pingpong.setdefault(market, []).append((scalp_fills, executed))
+        if not other_fills:
+            return  # ідемо далі — без автотрейду нижче
+    # з двох ніг OCO, що зникли разом, справжня — та, що має виконання
+    finished_any = next((e for e in other_fills if e["id"] in executed), other_fills[0]) if other_fills else None
+
+    if finished_any:
+        # 🧹 Звичайна логіка (НЕ скальп)
+        if chat_id:
+            await bot.send_message(
+                chat_id=chat_id,
+                text=f"✅ Ордер {finished_any['id']} ({market}, {finished_any['type']}) закрито!"
+            )
 
-                if sl_pct > 0:
-                    lp = await get_last_price(market)
-                    if lp:
-                        mode = (cfg.get("sl_mode") or "trigger").lower()
-
-                        if mode == "trailing":
-                            peak = float(cfg.get("peak") or 0)
-                            if lp > (peak or 0):
-                                cfg["peak"] = lp
-                                save_markets()
-
-                        threshold = None
-                        if mode == "trigger" and cfg.get("entry_price"):
-                            threshold = float(cfg["entry_price"]) * (1 - sl_pct / 100)
-                        elif mode == "trailing" and cfg.get("peak"):
-                            threshold = float(cfg["peak"]) * (1 - sl_pct / 100)
-
-                        if threshold and lp <= threshold:
-                            # скасовуємо всі ліміти
-                            acts = await active_orders(market)
-                            for o in acts.get("orders", []):
-                                oid = o.get("orderId") or o.get("id")
-                                if oid:
-                                    await cancel_order(market, order_id=str(oid))
-                            cfg["orders"].clear()
-                            save_markets()
-
-                            base_av = await get_base_available(market)
-                            if cfg.get("hold_on_sl"):
-                                # ✅ Мʼякий SL: НЕ продаємо ринком, «заморожуємо» холдинг до ап-тренду
-                                cfg["holdings_lock"] = True
-                                save_markets()
-                                if cfg.get("chat_id"):
-                                    await bot.send_message(
-                                        cfg["chat_id"],
-                                        f"🟡 {market}: SL-тригер. Монети залишено (hold_on_sl=ON). Чекаю ап-тренду."
-                                    )
-                            else:
-                                # звичайна поведінка: продати ринком усе
-                                if base_av > 0:
-                                    await place_market_order(market, "sell", float(base_av))
-                                    if cfg.get("chat_id"):
-                                        await bot.send_message(cfg["chat_id"], f"🛑 {market}: SL спрацював, продано ринком.")
-
-                            # скинути референси і перейти до наступної пари
-                            cfg["entry_price"] = None
-                            cfg["peak"] = None
-                            save_markets()
-                            continue  # до наступної пари
-
-                # --- ДЕТЕКТ ЗАКРИТИХ ОРДЕРІВ (порівняння відстежуваних з активними) ---
-                acts = await active_orders(market)
-                active_ids = {
-                    str(o.get("orderId") or o.get("id"))
-                    for o in acts.get("orders", []) if isinstance(o, dict)
-                }
-                tracked = list(cfg.get("orders", []))
-                tracked_ids = {str(e.get("id")) for e in tracked if isinstance(e, dict) and e.get("id")}
-                finished = [e for e in tracked if str(e.get("id")) not in active_ids]
-                finished_any = finished[0] if finished else None
-                chat_id = cfg.get("chat_id")
-
-                if finished_any:
-                    # 🔧 Якщо скальп: НЕ чистимо всю сітку і НЕ скасовуємо інші ордери
-                    is_scalp = cfg.get("scalp") and str(finished_any.get("type", "")).startswith("scalp")
-                    if is_scalp:
-                        if chat_id:
-                            await bot.send_message(
-                                chat_id=chat_id,
-                                text=f"✅ Ордер {finished_any['id']} ({market}, {finished_any['type']}) закрито!"
-                            )
-                        # прибираємо тільки заповнений ордер
-                        cfg["orders"] = [
-                            e for e in cfg.get("orders", [])
-                            if str(e.get("id")) != str(finished_any["id"])
-                        ]
-                        save_markets()
-                        # запускаємо ping-pong тільки для цього ордера
-                        await on_fill_pingpong(market, cfg, finished_any)
-                        # ідемо далі — без автотрейду нижче
-                        continue
-
-                    # 🧹 Звичайна логіка (НЕ скальп)
+        # скасувати інші ордери з цієї пари
+        oco = finished_any.get("oco")
+        for entry in list(cfg.orders):
+            if str(entry.get("id")) != str(finished_any.get("id")) and not (oco and entry.get("oco") == oco):
+                await cancel_order(market, order_id=str(entry.get("id")))  # другу ногу OCO біржа зняла сама
+
+        cfg.orders.clear()
+        save_markets()
+
+        if finished_any.get("type") in ("tp", "sl"):
+            safety.update_position(market, Decimal(0), Decimal(0))  # позицію закрито
+            if cfg.profit_floor:
+                cfg.profit_floor = None   # підлога була для цієї позиції — без неї тригер продав би чужі монети
+                triggers.sync(market, cfg)
+        if finished_any.get("type") == "sl":
+            # нативний стоп виконала біржа — як і після SL монітора, новий вхід вирішить автостарт
+            cfg.entry_price = None
+            cfg.peak = None
+            triggers.sync(market, cfg)
+            save_markets()
+            if chat_id:
+                await bot.send_message(chat_id, f"🛑 {market}: SL спрацював на біржі (stop-limit).")
+            return
+
+        # REBUY/рестарт логіка (без правил ринку — пізніше через автостарт)
+        handled = False
+        if cfg.autotrade and rules_ok:
+            if finished_any.get("type") == "tp" and cfg.rebuy_pct > 0:
+                ref = cfg.last_tp_price or (await get_last_price(market))
+                oid = await place_limit_buy_at_discount(market, cfg, float(ref or 0))
+                if oid:
                     if chat_id:
                         await bot.send_message(
                             chat_id=chat_id,
-                            text=f"✅ Ордер {finished_any['id']} ({market}, {finished_any['type']}) закрито!"
+                            text=f"🔻 {market}: лімітний відкуп на {cfg.rebuy_pct}% нижче TP виставлено (order {oid})"
+                        )
+                    handled = True
+            elif finished_any.get("type") == "rebuy":
+                ok = await place_tp_sl_from_holdings(market, cfg)
+                if ok:
+                    if chat_id:
+                        await bot.send_message(
+                            chat_id=chat_id,
+                            text=f"🎯 {market}: після відкупу виставлено TP від холдингів"
+                        )
+                    handled = True
+
+            if not handled:
+                if chat_id:
+                    await bot.send_message(
+                        chat_id=chat_id,
+                        text=f"♻️ Автотрейд {market}: нова угода на {cfg.buy_usdt} USDT"
+                    )
+                await start_new_trade(market, cfg)
+
+    # --- АВТОСТАРТ / FALLBACK / SCALП GRID ---
+    if cfg.autotrade and rules_ok:
+        # якщо після SL ми «тримали» монети — не стартуємо нові покупки, поки не буде ап-тренд
+        if cfg.holdings_lock:
+            logging.info(f"[AUTOSTART HOLD] {market}: holdings_lock=True — чекаю ап-тренду.")
+            return
+
+        no_tracked = len(cfg.orders) == 0
+        no_active = (len(active_ids) == 0)
+        if no_tracked and no_active:
+            # якщо увімкнено скальп — спочатку сформуємо сітку (не частіше ніж раз на 60с)
+            if cfg.scalp:
+                lp = await get_last_price(market)
+                now = now_ms()
+                if lp and (now - cfg.scalp_seeded_at > 60_000):
+                    cfg.scalp_seeded_at = now
+                    seeded = await seed_scalp_grid(market, cfg, lp)  # зберігає конфіг один раз на всю сітку
+                    if seeded and cfg.chat_id:
+                        await bot.send_message(
+                            cfg.chat_id, f"▶️ {market}: запущено мікро-скальп сітку"
                         )
+                    return  # не стартуємо одразу угоду, бо вже сіданули сітку
+
+            # 1) старт від холдингів
+            started_from_holdings = await place_tp_sl_from_holdings(market, cfg)
+            if started_from_holdings:
+                if cfg.chat_id:
+                    await bot.send_message(
+                        cfg.chat_id, f"▶️ {market}: старт від наявних монет (TP виставлено)"
+                    )
+            else:
+                # 2) fallback: купівля за USDT
+                usdt = await get_usdt_available()
+                spend = cfg.buy_usdt
+                spend_adj = (spend * Decimal("0.998")).quantize(Decimal("0.01"), rounding=ROUND_DOWN)
+                reason = safety.block_entry_reason(market)
+                if reason:
+                    logging.info(f"[AUTOSTART SKIP] {market}: {reason}")
+                elif usdt >= spend_adj and float(spend_adj) > 0:
+                    if cfg.chat_id:
+                        await bot.send_message(
+                            cfg.chat_id,
+                            text=f"▶️ {market}: автостарт купівлі на {spend_adj} USDT (бо холдингів немає)"
+                        )
+                    await start_new_trade(market, cfg)
+                else:
+                    logging.info(f"[AUTOSTART SKIP] {market}: ні холдингів, ні достатньо USDT (USDT={usdt}, need≈{spend_adj})")
+        elif cfg.scalp:
+            # сітка вже працює — тримаємо BUY-драбину біля ціни (лише різниця рівнів)
+            lp = await get_last_price(market)
+            if lp:
+                await recenter_scalp_grid(market, cfg, lp)
+
+class MonitorSupervisor:
+    """
+    Тримає по одному воркеру на ринок: повільна пара (таймаути, ретраї) не блокує SL інших пар.
+    Воркер падає ізольовано і перезапускається; /market, /removemarket, /stop викликають sync().
+    """
+    RESYNC_INTERVAL = 1.0
+
+    def __init__(self):
+        self.workers: Dict[str, asyncio.Task] = {}
+        self.stops: Dict[str, asyncio.Event] = {}
+        self.kicks: Dict[str, asyncio.Event] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.exit_locks: Dict[str, asyncio.Lock] = {}
+        self.ticks: Dict[str, asyncio.Task] = {}    # поточний тік monitor_market по ринку
+        self.running = False
+
+    def wake(self, market: str):
+        # позачерговий тік (напр. прийшла подія заповнення з приватного WS)
+        kick = self.kicks.get(market)
+        if kick is not None:
+            kick.set()
+
+    def lock(self, market: str) -> asyncio.Lock:
+        # тік воркера і ручні команди по тому ж ринку не виконуються одночасно
+        if market not in self.locks:
+            self.locks[market] = asyncio.Lock()
+        return self.locks[market]
+
+    def exit_lock(self, market: str) -> asyncio.Lock:
+        # захисний вихід (execute_sl) — один на ринок, хоч із тіку ціни, хоч із монітора
+        if market not in self.exit_locks:
+            self.exit_locks[market] = asyncio.Lock()
+        return self.exit_locks[market]
+
+    def preempt(self, market: str) -> bool:
+        """
+        Обриває поточний тік воркера, щоб SL із тіку ціни не чекав його HTTP-ретраїв.
+        Тік, що вже сам виконує execute_sl (тримає exit_lock), не чіпаємо. Недовиставлені ним ордери
+        прибере cancel-all у execute_sl; наступний тік починається як звичайно.
+        """
+        tick = self.ticks.get(market)
+        if tick is None or tick.done() or self.exit_lock(market).locked():
+            return False
+        tick.cancel()
+        logging.info(f"[MONITOR] {market}: тік перервано заради SL")
+        return True
 
-                    # скасувати інші ордери з цієї пари
-                    for entry in list(cfg.get("orders", [])):
-                        if str(entry.get("id")) != str(finished_any.get("id")):
-                            await cancel_order(market, order_id=str(entry.get("id")))
-                            await asyncio.sleep(0.1)
-
-                    cfg["orders"].clear()
-                    save_markets()
-
-                    # REBUY/рестарт логіка
-                    handled = False
-                    if cfg.get("autotrade"):
-                        if finished_any.get("type") == "tp" and float(cfg.get("rebuy_pct", 0) or 0) > 0:
-                            ref = cfg.get("last_tp_price") or (await get_last_price(market))
-                            oid = await place_limit_buy_at_discount(market, cfg, float(ref or 0))
-                            if oid:
-                                if chat_id:
-                                    await bot.send_message(
-                                        chat_id=chat_id,
-                                        text=f"🔻 {market}: лімітний відкуп на {cfg['rebuy_pct']}% нижче TP виставлено (order {oid})"
-                                    )
-                                handled = True
-                        elif finished_any.get("type") == "rebuy":
-                            ok = await place_tp_sl_from_holdings(market, cfg)
-                            if ok:
-                                if chat_id:
-                                    await bot.send_message(
-                                        chat_id=chat_id,
-                                        text=f"🎯 {market}: після відкупу виставлено TP від холдингів"
-                                    )
-                                handled = True
-
-                        # >>> ping-pong для скальпу (на випадок, якщо сюди потрапили)
-                        if cfg.get("scalp") and str(finished_any.get("type", "")).startswith("scalp"):
-                            await on_fill_pingpong(market, cfg, finished_any)
-                            handled = True
-
-                        if not handled:
-                            if chat_id:
-                                await bot.send_message(
-                                    chat_id=chat_id,
-                                    text=f"♻️ Автотрейд {market}: нова угода на {cfg['buy_usdt']} USDT"
-                                )
-                            await start_new_trade(market, cfg)
-
-                # --- АВТОСТАРТ / FALLBACK / SCALП GRID ---
-                if cfg.get("autotrade"):
-                    # якщо після SL ми «тримали» монети — не стартуємо нові покупки, поки не буде ап-тренд
-                    if cfg.get("holdings_lock"):
-                        logging.info(f"[AUTOSTART HOLD] {market}: holdings_lock=True — чекаю ап-тренду.")
-                        continue
-
-                    no_tracked = len(cfg.get("orders", [])) == 0
-                    no_active = (len(active_ids) == 0)
-                    if no_tracked and no_active:
-                        # якщо увімкнено скальп — спочатку сформуємо сітку (не частіше ніж раз на 60с)
-                        if cfg.get("scalp"):
-                            lp = await get_last_price(market)
-                            now = now_ms()
-                            if lp and (now - int(cfg.get("scalp_seeded_at", 0)) > 60_000):
-                                await seed_scalp_grid(market, cfg, lp)
-                                cfg["scalp_seeded_at"] = now
-                                save_markets()
-                                if cfg.get("chat_id"):
-                                    await bot.send_message(
-                                        cfg["chat_id"], f"▶️ {market}: запущено мікро-скальп сітку"
-                                    )
-                                continue  # не стартуємо одразу угоду, бо вже сіданули сітку
-
-                        # 1) старт від холдингів
-                        started_from_holdings = await place_tp_sl_from_holdings(market, cfg)
-                        if started_from_holdings:
-                            if cfg.get("chat_id"):
-                                await bot.send_message(
-                                    cfg["chat_id"], f"▶️ {market}: старт від наявних монет (TP виставлено)"
-                                )
-                        else:
-                            # 2) fallback: купівля за USDT
-                            usdt = await get_usdt_available()
-                            spend = Decimal(str(cfg.get("buy_usdt", 10)))
-                            spend_adj = (spend * Decimal("0.998")).quantize(Decimal("0.01"), rounding=ROUND_DOWN)
-                            if usdt >= spend_adj and float(spend_adj) > 0:
-                                if cfg.get("chat_id"):
-                                    await bot.send_message(
-                                        cfg["chat_id"],
-                                        text=f"▶️ {market}: автостарт купівлі на {spend_adj} USDT (бо холдингів немає)"
-                                    )
-                                await start_new_trade(market, cfg)
-                            else:
-                                logging.info(f"[AUTOSTART SKIP] {market}: ні холдингів, ні достатньо USDT (USDT={usdt}, need≈{spend_adj})")
+    async def _tick(self, market: str):
+        async with self.lock(market):
+            await monitor_market(market)
 
-        except Exception as e:
-            logging.error(f"Monitor error: {e}")
+    def sync(self):
+        if not self.running:
+            return
+        for market in list(markets.keys()):
+            task = self.workers.get(market)
+            if task is None or task.done():
+                if task is not None and not task.cancelled() and task.exception():
+                    logging.error(f"[MONITOR] воркер {market} впав: {task.exception()!r} — перезапуск")
+                stop = asyncio.Event()
+                self.stops[market] = stop
+                self.kicks[market] = asyncio.Event()
+                self.workers[market] = asyncio.create_task(self._worker(market, stop), name=f"monitor:{market}")
+                logging.info(f"[MONITOR] воркер {market} запущено")
+        for market in list(self.workers.keys()):
+            if market not in markets:
+                # мʼяка зупинка: поточний тік доходить до кінця (не обриваємо виставлення ордерів)
+                self.stops.pop(market).set()
+                self.kicks.pop(market).set()
+                self.workers.pop(market)
+                logging.info(f"[MONITOR] воркер {market} зупиняється")
+
+    async def _worker(self, market: str, stop: asyncio.Event):
+        errors = 0
+        kick = self.kicks[market]
+        while not stop.is_set() and market in markets:
+            tick = self.ticks[market] = asyncio.create_task(self._tick(market), name=f"tick:{market}")
+            try:
+                try:
+                    await asyncio.wait({tick})   # на відміну від await tick, скасування тіку (preempt) не рве воркер
+                except asyncio.CancelledError:
+                    tick.cancel()
+                    raise
+                finally:
+                    self.ticks.pop(market, None)
+                if not tick.cancelled():
+                    tick.result()
+                errors = 0
+                delay = MONITOR_INTERVAL
+            except Exception as e:
+                errors += 1
+                delay = min(MONITOR_MAX_BACKOFF, MONITOR_INTERVAL * (2 ** min(errors, 5)))
+                logging.error(f"Monitor error ({market}): {e}")
+            try:
+                await asyncio.wait_for(kick.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            kick.clear()
+
+    async def run(self):
+        self.running = True
+        while self.running:
+            self.sync()
+            await asyncio.sleep(self.RESYNC_INTERVAL)
+
+    async def shutdown(self, timeout: float = 10.0):
+        self.running = False
+        for stop in self.stops.values():
+            stop.set()
+        for kick in self.kicks.values():
+            kick.set()
+        tasks = list(self.workers.values())
+        self.workers.clear()
+        self.stops.clear()
+        self.kicks.clear()
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+supervisor = MonitorSupervisor()
 
-        await asyncio.sleep(2)
+async def monitor_orders():
+    await supervisor.run()
 # ---------------- RUN ----------------
 async def main():
     load_markets()
-    await load_market_rules()  # <- завантажуємо правила ринків на старті
-    logging.info("🚀 Bot is running and waiting for commands...")
-
+    deals.load()       # курсор історії угод — читаємо лише нове від нього
+    get_http_client()  # <- один пул зʼєднань на весь процес
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
-        logging.info("✅ Webhook очищено успішно")
-    except Exception as e:
-        logging.error(f"❌ Помилка очищення webhook: {e}")
+        # правила ринків — одразу з дискового кешу; біржу питаємо у фоні (одразу, якщо кеш старий/неповний)
+        rules_age = load_rules_cache()
+        if _rules_wanted() - market_rules.keys():
+            rules_age = float("inf")
+        asyncio.create_task(rules_refresh_loop(rules_age))
+        # історія цін з kline — щоб dump/trend не стартували «наосліп» після рестарту
+        await candles.backfill_all(markets)
+        logging.info("🚀 Bot is running and waiting for commands...")
 
-    asyncio.create_task(monitor_orders())
-    await dp.start_polling(bot, skip_updates=True)
+        try:
+            await bot.delete_webhook(drop_pending_updates=True)
+            logging.info("✅ Webhook очищено успішно")
+        except Exception as e:
+            logging.error(f"❌ Помилка очищення webhook: {e}")
+
+        asyncio.create_task(persistence_loop())
+        if WS_ENABLED:
+            asyncio.create_task(price_feed.run())
+            if WS_PRIVATE_ENABLED:
+                asyncio.create_task(private_feed.run())
+        asyncio.create_task(monitor_orders())
+        await dp.start_polling(bot, skip_updates=True)
+    finally:
+        await price_feed.stop()
+        await private_feed.stop()
+        await supervisor.shutdown()
+        await flush_markets()  # завжди зливаємо незбережені зміни при зупинці
+        await close_http_client()
 
 if __name__ == "__main__":
     try:
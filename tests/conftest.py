@@ -0,0 +1,69 @@
+"""
+Спільне для тестів: main.py читає ключі з оточення вже на імпорті,
+тож тестові значення ставимо до першого `import main`.
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-TOKEN-TEST-TOKEN-TEST-TOKEN-TEST")
+os.environ.setdefault("API_KEY", "test-key")
+os.environ.setdefault("API_SECRET", "test-secret")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run(coro):
+    """pytest-asyncio не в залежностях — асинхронні сценарії ганяємо в окремому циклі."""
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    """
+    main з чистим станом: свіжі синглтони (кеші, індекси, фіди — їхні asyncio-примітиви
+    привʼязуються до циклу тесту) і файли стану в tmp_path.
+    """
+    import main
+
+    fresh = {
+        "markets": {}, "market_rules": {}, "_deferred_pingpong": {}, "_http_client": None,
+        "safety": main.SafetyManager(main.SafetyConfig()), "trends": main.TrendEngine(),
+        "scheduler": main.RequestScheduler(), "balances": main.BalanceLedger(main.BALANCE_TTL),
+        "capital": main.CapitalLedger(main.CAPITAL_ASSET), "open_orders": main.ActiveOrdersIndex(main.ACTIVE_ORDERS_TTL),
+        "deals": main.DealsLedger(main.DEALS_TTL), "tickers": main.TickerSnapshot(main.TICKER_TTL),
+        "triggers": main.TriggerIndex(), "candles": main.CandleAggregator(),
+        "price_feed": main.PriceFeed(main.WS_URL), "private_feed": main.PrivateFeed(main.WS_URL),
+        "supervisor": main.MonitorSupervisor(),
+    }
+    for name, value in fresh.items():
+        monkeypatch.setattr(main, name, value)
+    monkeypatch.setattr(main, "save_markets", lambda: None)
+    monkeypatch.setattr(main, "RULES_FILE", str(tmp_path / "market_rules.json"))
+    monkeypatch.setattr(main, "DEALS_FILE", str(tmp_path / "deals_cursor.json"))
+    monkeypatch.setattr(main, "_modify_supported", main.ORDER_MODIFY)
+    yield main
+
+
+@pytest.fixture
+def telegram(bot, monkeypatch):
+    """Повідомлення, які бот надіслав би в Telegram."""
+    sent: list = []
+
+    async def send_message(chat_id=None, text=None, **kw):
+        sent.append(text)
+
+    monkeypatch.setattr(bot.bot, "send_message", send_message)
+    return sent
+
+
+async def wait_for(cond, timeout: float = 3.0, step: float = 0.02):
+    """Чекає, поки cond() стане істинним (події WS приходять асинхронно)."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not cond():
+        if loop.time() > deadline:
+            raise AssertionError("умова не виконалась за відведений час")
+        await asyncio.sleep(step)
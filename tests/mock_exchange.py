@@ -0,0 +1,158 @@
+"""
+Локальний двійник WhiteBIT для тестів: REST v4 (підписані POST — тіло з X-TXC-PAYLOAD) і WS на /ws.
+Стан (ордери, баланс, угоди) тримаємо в памʼяті; push() шле події всім WS-клієнтам,
+як біржа шле ordersPending_update / balanceSpot_update; replay() програє записані кадри lastprice_update.
+"""
+import asyncio
+import base64
+import itertools
+import json
+
+from aiohttp import web
+
+
+class MockExchange:
+    def __init__(self):
+        self.calls: list = []                # шляхи REST-запитів у порядку надходження
+        self.orders: dict = {}               # orderId -> ордер на книзі
+        self.deals: list = []                # історія угод (executed-history), старі спочатку
+        self.prices = {"BTC_USDT": "100", "ETH_USDT": "10"}
+        self.balance = {"USDT": {"available": "1000", "freeze": "0"},
+                        "BTC": {"available": "0", "freeze": "0"},
+                        "ETH": {"available": "0", "freeze": "0"}}
+        self.sockets: list = []              # відкриті WS-зʼєднання
+        self.ws_log: list = []               # [(method, params)] від клієнтів, по зʼєднанню
+        self.silent = False                  # True — сокет «напіввідкритий»: приймає, але не відповідає
+        self._ids = itertools.count(1000)
+        self._deal_ids = itertools.count(1)
+        self._runner = None
+
+    # ---------------- сервер ----------------
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_get("/ws", self._ws)
+        app.router.add_route("*", "/{tail:.*}", self._rest)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        for ws in self.sockets:
+            await ws.close()
+        await self._runner.cleanup()
+
+    # ---------------- REST ----------------
+    async def _rest(self, request: web.Request) -> web.Response:
+        body = {}
+        if "X-TXC-PAYLOAD" in request.headers:
+            body = json.loads(base64.b64decode(request.headers["X-TXC-PAYLOAD"]))
+        path = request.path
+        self.calls.append(path)
+        if path == "/api/v4/public/ticker":
+            return web.json_response({m: {"last_price": p} for m, p in self.prices.items()})
+        if path == "/api/v4/public/markets":
+            return web.json_response([{"name": m, "stockPrec": "4", "moneyPrec": "2",
+                                       "minAmount": "0.001", "minTotal": "5"} for m in self.prices])
+        if path == "/api/v1/public/kline":
+            return web.json_response({"success": True, "message": "", "result": []})
+        if path == "/api/v4/profile/websocket_token":
+            return web.json_response({"websocket_token": "test-token"})
+        if path == "/api/v4/trade-account/balance":
+            return web.json_response(self.balance)
+        if path in ("/api/v4/orders", "/api/v4/oco-orders"):
+            lst = list(self.orders.values()) if path == "/api/v4/orders" else []
+            off, lim = body.get("offset", 0), body.get("limit", 100)
+            return web.json_response(lst[off:off + lim])
+        if path == "/api/v4/order/new":
+            return web.json_response(self._book(body))
+        if path == "/api/v4/order/bulk":
+            return web.json_response([{"result": self._book(o), "error": None} for o in body["orders"]])
+        if path == "/api/v4/order/market":
+            return web.json_response(self._market(body))
+        if path == "/api/v4/order/cancel":
+            self.orders.pop(int(body.get("orderId", 0)), None)
+            return web.json_response({"orderId": body.get("orderId")})
+        if path == "/api/v4/order/cancel/all":
+            for oid in [k for k, o in self.orders.items() if o["market"] == body.get("market")]:
+                self.orders.pop(oid)
+            return web.json_response([])
+        if path == "/api/v4/trade-account/executed-history":
+            off, lim = body.get("offset", 0), body.get("limit", 100)
+            out: dict = {}
+            for d in list(reversed(self.deals))[off:off + lim]:
+                out.setdefault(d["market"], []).append({k: v for k, v in d.items() if k != "market"})
+            return web.json_response(out)
+        return web.json_response({"success": False, "message": f"unknown {path}"}, status=404)
+
+    def _book(self, body: dict) -> dict:
+        order = {k: v for k, v in body.items() if k not in ("request", "nonce")}
+        order["orderId"] = next(self._ids)
+        self.orders[order["orderId"]] = order
+        return order
+
+    def _market(self, body: dict) -> dict:
+        order = {k: v for k, v in body.items() if k not in ("request", "nonce")}
+        order["orderId"] = next(self._ids)
+        price = float(self.prices[order["market"]])
+        stock = float(order["amount"]) / price if order["side"] == "buy" else float(order["amount"])
+        order.update(dealStock=f"{stock:.8f}", dealMoney=f"{stock * price:.8f}", dealFee="0")
+        self.deal(order["orderId"], order["market"], order["side"], price, stock)
+        return order
+
+    def deal(self, order_id, market: str, side: str, price: float, amount: float):
+        self.deals.append({"id": next(self._deal_ids), "orderId": order_id, "market": market, "side": side,
+                           "price": str(price), "amount": f"{amount:.8f}", "deal": f"{price * amount:.8f}",
+                           "fee": "0"})
+
+    # ---------------- WS ----------------
+    async def _ws(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.append(ws)
+        log: list = []
+        self.ws_log.append(log)
+        async for msg in ws:
+            data = json.loads(msg.data)
+            log.append((data["method"], data["params"]))
+            if self.silent:
+                continue
+            result = "pong" if data["method"] == "ping" else {"status": "success"}
+            await ws.send_json({"id": data["id"], "result": result, "error": None})
+        return ws
+
+    async def push(self, method: str, params: list):
+        for ws in self.sockets:
+            if not ws.closed:
+                await ws.send_json({"id": None, "method": method, "params": params})
+
+    async def replay(self, path: str, speed: float = 1.0) -> int:
+        """
+        Програє запис кадрів WS (jsonl: {"t": секунди від початку, "msg": кадр}) з оригінальними паузами,
+        поділеними на speed. Ціни також оновлюють REST-тікер. Повертає кількість надісланих кадрів.
+        """
+        sent, prev = 0, 0.0
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                rec = json.loads(line)
+                await asyncio.sleep(max(0.0, rec["t"] - prev) / speed)
+                prev = rec["t"]
+                msg = rec["msg"]
+                if msg.get("method") == "lastprice_update":
+                    market, price = msg["params"][:2]
+                    self.prices[market] = price
+                for ws in self.sockets:
+                    if not ws.closed:
+                        await ws.send_json(msg)
+                sent += 1
+        return sent
+
+    async def drop_connections(self):
+        """Розрив з боку біржі: клієнт має перепідключитися і звірити стан через REST."""
+        for ws in self.sockets:
+            await ws.close()
+        self.sockets.clear()
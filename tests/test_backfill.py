@@ -0,0 +1,42 @@
+"""Бекфіл нової пари з /market: свічки, safety і тренд мають бути «теплими» до першого живого тіку."""
+import time
+from types import SimpleNamespace
+
+from conftest import run
+
+
+class _Message:
+    def __init__(self, text):
+        self.text = text
+        self.chat = SimpleNamespace(id=1)
+        self.answers: list = []
+
+    async def answer(self, text, **kw):
+        self.answers.append(text)
+
+
+def test_market_cmd_backfill_warms_trend_before_pair_is_visible(bot, monkeypatch):
+    now = time.time()
+    # 60 закритих 1m-барів зі стабільним ростом
+    m1 = [(now - 60 * (60 - i) - 60, 100 + i, 100 + i, 100 + i, 100 + i, 1.0) for i in range(60)]
+    seen_markets: list = []
+
+    async def fetch(pair, tf):
+        seen_markets.append(set(bot.markets))
+        return m1 if tf == "1m" else []
+
+    async def rules_ok(market):
+        return True
+
+    monkeypatch.setattr(bot.candles, "_fetch", fetch)
+    monkeypatch.setattr(bot, "ensure_market_rules", rules_ok)
+
+    msg = _Message("/market BTC/USDT")
+    run(bot.market_cmd(msg))
+
+    assert msg.answers and msg.answers[0].startswith("✅")
+    assert all("BTC_USDT" not in s for s in seen_markets)  # під час бекфілу пара ще невидима WS/тікеру
+    st = bot.trends.by_pair["BTC_USDT"]
+    assert st.window == bot.markets["BTC_USDT"].trend_window_s
+    assert st.warm() and st.n >= 6
+    assert bot.safety.by_pair["BTC_USDT"].last_ts > 0
@@ -0,0 +1,46 @@
+"""Історія угод: агрегати відстежуваних ордерів переживають рестарт разом із курсором."""
+from decimal import Decimal
+
+from conftest import run
+
+
+def _history(bot, monkeypatch, deals):
+    async def private_post(path, body, **kw):
+        assert path == "/api/v4/trade-account/executed-history"
+        newest_first = sorted(deals, key=lambda d: -d["id"])
+        out: dict = {}
+        for d in newest_first[body["offset"]:body["offset"] + body["limit"]]:
+            out.setdefault(d["market"], []).append({k: v for k, v in d.items() if k != "market"})
+        return out
+
+    monkeypatch.setattr(bot, "private_post", private_post)
+
+
+def _deal(i, oid, market, price, amount, side="buy", fee="0", fee_asset="USDT"):
+    return {"id": i, "orderId": oid, "market": market, "side": side, "price": str(price),
+            "amount": str(amount), "deal": str(price * amount), "fee": fee, "feeAsset": fee_asset}
+
+
+def test_partial_fill_survives_restart(bot, monkeypatch):
+    cfg = bot.MarketConfig()
+    cfg.orders.add({"id": "7", "type": "scalp_buy", "market": "BTC_USDT", "price": 101.0, "amount": 1.0})
+    bot.markets["BTC_USDT"] = cfg
+    deals = [_deal(1, 7, "BTC_USDT", 100, 0.25, fee="0.0005", fee_asset="BTC"),
+             _deal(2, 99, "ETH_USDT", 10, 1)]            # ордер не бота — на диск не потрапляє
+    _history(bot, monkeypatch, deals)
+    assert run(bot.deals.refresh(force=True))
+    before = bot.deals.fill("7")
+
+    # рестарт: свіжий реєстр з того ж файлу; угоди 1–2 вже за курсором і повторно не читаються
+    bot.deals = bot.DealsLedger(bot.DEALS_TTL)
+    bot.deals.load()
+    assert bot.deals.cursor == 2
+    assert set(bot.deals.by_order) == {"7"}
+    assert bot.deals.fill("7") == before
+
+    deals.append(_deal(3, 7, "BTC_USDT", 98, 0.75))
+    assert run(bot.deals.refresh(force=True))
+    f = bot.deals.fill("7")
+    assert f["amount"] == Decimal("1.00")
+    assert f["price"] == Decimal("98.5")                   # (25 + 73.5) / 1 — середня з обох частин
+    assert f["net"] == Decimal("0.9995")
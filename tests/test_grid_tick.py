@@ -0,0 +1,27 @@
+"""Крок решітки tick_pct: нуль чи мінус ламають grid_level — такі значення відкидаємо на вході."""
+import pytest
+
+from conftest import run
+
+
+@pytest.mark.parametrize("raw", [0, "0", -0.25, "nan", "inf"])
+def test_from_dict_rejects_non_positive_tick(bot, raw):
+    cfg = bot.MarketConfig.from_dict({"tick_pct": raw}, "BTC_USDT")
+    assert cfg.tick_pct == bot.MarketConfig().tick_pct
+
+
+def test_profile_with_zero_tick_keeps_current(bot):
+    cfg = bot.MarketConfig(tick_pct=0.3)
+    cfg.apply_profile({"tick_pct": 0, "levels": 5})
+    assert cfg.tick_pct == 0.3 and cfg.levels == 5
+
+
+def test_grid_entry_points_skip_zero_tick(bot, monkeypatch):
+    cfg = bot.MarketConfig(tick_pct=0.0, grid_anchor=100.0)
+    bot.markets["BTC_USDT"] = cfg
+    with pytest.raises(ValueError):
+        bot.grid_level(cfg, 101.0)
+    assert run(bot.seed_scalp_grid("BTC_USDT", cfg, 100.0)) is False
+    run(bot.recenter_scalp_grid("BTC_USDT", cfg, 100.0))
+    run(bot.on_fill_pingpong("BTC_USDT", cfg, [{"id": "1", "type": "scalp_buy", "price": 100, "amount": 1}]))
+    assert len(cfg.orders) == 0
@@ -0,0 +1,81 @@
+"""Публічний WS: реплей записаних тіків через двійник біржі і фолбек на REST, коли сокет замовк."""
+import json
+import os
+
+from conftest import run, wait_for
+from mock_exchange import MockExchange
+
+TICKS = os.path.join(os.path.dirname(__file__), "data", "lastprice_ticks.jsonl")
+
+
+def _recorded_last(market):
+    last = None
+    with open(TICKS, encoding="utf-8") as f:
+        for line in f:
+            params = json.loads(line)["msg"]["params"]
+            if params[0] == market:
+                last = float(params[1])
+    return last
+
+
+async def _start(bot, monkeypatch, markets=("BTC_USDT", "ETH_USDT")):
+    ex = MockExchange()
+    bot.BASE_URL = await ex.start()
+    for m in markets:
+        bot.markets[m] = bot.MarketConfig()
+    feed = bot.PriceFeed(bot.BASE_URL.replace("http", "ws") + "/ws")
+    bot.price_feed = feed
+    task = bot.asyncio.create_task(feed.run())
+    await wait_for(lambda: feed.connected and feed.subscribed)
+    return ex, feed, task
+
+
+async def _stop(bot, ex, feed, task):
+    await feed.stop()
+    task.cancel()
+    await bot.close_http_client()
+    await ex.stop()
+
+
+def test_replayed_ticks_drive_prices_candles_and_safety(bot, monkeypatch):
+    async def scenario():
+        ex, feed, task = await _start(bot, monkeypatch)
+        try:
+            assert ("lastprice_subscribe", ["BTC_USDT", "ETH_USDT"]) in ex.ws_log[0]
+            sent = await ex.replay(TICKS, speed=20)
+            await wait_for(lambda: feed.updates == sent)
+            for m in ("BTC_USDT", "ETH_USDT"):
+                assert feed.live(m)
+                assert await bot.get_last_price(m) == _recorded_last(m)
+                assert len(bot.candles.series(m, "1s")) >= 1
+                assert bot.safety.by_pair[m].window.last == _recorded_last(m)
+            # ціни живі з WS — REST-тікер не потрібен
+            assert "/api/v4/public/ticker" not in ex.calls
+        finally:
+            await _stop(bot, ex, feed, task)
+
+    run(scenario())
+
+
+def test_silent_socket_falls_back_to_rest_and_reconnects(bot, monkeypatch):
+    monkeypatch.setattr(bot, "WS_PING_INTERVAL", 0.1)
+    monkeypatch.setattr(bot, "WS_STALE_AFTER", 0.4)
+
+    async def scenario():
+        ex, feed, task = await _start(bot, monkeypatch, markets=("BTC_USDT",))
+        try:
+            await ex.replay(TICKS, speed=50)
+            await wait_for(lambda: feed.live("BTC_USDT"))
+            ex.silent = True                       # напіввідкрите зʼєднання: кадри йдуть у нікуди
+            ex.prices["BTC_USDT"] = "123.45"
+            await wait_for(lambda: not feed.live("BTC_USDT"))
+            assert await bot.get_last_price("BTC_USDT") == 123.45   # REST-фолбек
+            assert "/api/v4/public/ticker" in ex.calls
+            # мовчазний сокет клієнт закриває сам і підключається знову
+            await wait_for(lambda: feed.reconnects >= 1, timeout=5)
+            ex.silent = False
+            await wait_for(lambda: len(ex.ws_log) >= 2 and feed.connected, timeout=5)
+        finally:
+            await _stop(bot, ex, feed, task)
+
+    run(scenario())
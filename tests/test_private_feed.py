@@ -0,0 +1,86 @@
+"""Приватний WS проти локального двійника біржі: заповнення, скасування, баланс, reconnect зі звіркою."""
+from conftest import run, wait_for
+from mock_exchange import MockExchange
+
+MARKET = "BTC_USDT"
+
+
+async def _start(bot, monkeypatch):
+    ex = MockExchange()
+    bot.BASE_URL = await ex.start()
+    monkeypatch.setattr(bot, "WS_PING_INTERVAL", 0.2)
+    bot.markets[MARKET] = bot.MarketConfig.from_dict(
+        {"autotrade": True, "scalp": True, "levels": 3, "tp": 1, "chat_id": 1, "buy_usdt": 10})
+    feed = bot.PrivateFeed(bot.BASE_URL.replace("http", "ws") + "/ws")
+    bot.private_feed = feed
+    task = bot.asyncio.create_task(feed.run())
+    await wait_for(feed.live)
+    return ex, feed, task
+
+
+async def _stop(bot, ex, feed, task):
+    await feed.stop()
+    task.cancel()
+    await bot.close_http_client()
+    await ex.stop()
+
+
+def _tracked(bot):
+    return {e["id"]: e["type"] for e in bot.markets[MARKET].orders}
+
+
+def test_fill_cancel_and_balance_push_without_rest(bot, telegram, monkeypatch):
+    async def scenario():
+        ex, feed, task = await _start(bot, monkeypatch)
+        try:
+            assert ("authorize", ["test-token", "public"]) in ex.ws_log[0]
+            await bot.monitor_market(MARKET)               # посів скальп-сітки
+            buys = sorted(_tracked(bot))
+            assert len(buys) == 3
+
+            ex.calls.clear()
+            o1, o2, o3 = (ex.orders.pop(int(oid)) for oid in buys)
+            await ex.push("ordersPending_update", [3, {"id": o1["orderId"], "market": MARKET, "side": "buy",
+                                                       "deal_stock": o1["amount"], "deal_money": "10"}])
+            await ex.push("ordersExecuted_update", [{"id": o2["orderId"], "market": MARKET, "side": "buy",
+                                                     "deal_stock": o2["amount"], "deal_money": "10"}])
+            await ex.push("ordersPending_update", [3, {"id": o3["orderId"], "market": MARKET, "side": "buy",
+                                                       "deal_stock": "0", "deal_money": "0"}])
+            await ex.push("balanceSpot_update", [{"BTC": {"available": "0.2", "freeze": "0"}}])
+            await wait_for(lambda: bot.balances.available("BTC") == bot.Decimal("0.2"))
+            await wait_for(lambda: len(feed.events.get(MARKET, {})) == 3)
+
+            await bot.monitor_market(MARKET)
+            tracked = _tracked(bot)
+            assert not set(buys) & set(tracked)                        # заповнені й скасований прибрано
+            assert sorted(tracked.values()).count("scalp_sell") == 2   # контр-ордери на два заповнення
+            assert any("закрито" in (t or "") for t in telegram)
+            # стан ордерів і балансу прийшов з WS: жодного REST-опитування /orders чи /balance
+            assert "/api/v4/orders" not in ex.calls
+            assert "/api/v4/trade-account/balance" not in ex.calls
+        finally:
+            await _stop(bot, ex, feed, task)
+
+    run(scenario())
+
+
+def test_reconnect_reconciles_orders_missed_while_down(bot, telegram, monkeypatch):
+    async def scenario():
+        ex, feed, task = await _start(bot, monkeypatch)
+        try:
+            await bot.monitor_market(MARKET)
+            gone, kept = sorted(_tracked(bot))[:2]
+            await ex.drop_connections()
+            ex.orders.pop(int(gone))                       # зник, поки сокета не було — події не буде
+            await wait_for(lambda: feed.reconnects >= 1 and feed.live(), timeout=5)
+            assert ex.calls.count("/api/v4/trade-account/balance") >= 2   # REST-звірка після підключення
+            assert feed.events[MARKET][gone]["kind"] == "unknown"
+            assert kept not in feed.events.get(MARKET, {})
+
+            await bot.monitor_market(MARKET)
+            assert gone not in _tracked(bot)
+            assert kept in _tracked(bot)
+        finally:
+            await _stop(bot, ex, feed, task)
+
+    run(scenario())
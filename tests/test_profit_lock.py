@@ -0,0 +1,49 @@
+"""Фіксація прибутку: трейлінг TP підіймає підлогу виходу, а не лише відсуває TP від ціни."""
+from decimal import Decimal
+
+from conftest import run
+
+
+def _position(bot, monkeypatch):
+    cfg = bot.MarketConfig(tp=1.0, sl=2.0, sl_mode="trigger", entry_price=100.0, peak=100.0)
+    cfg.orders.add({"id": "1", "type": "tp", "market": "BTC_USDT", "price": 101.0, "amount": 1.0})
+    bot.markets["BTC_USDT"] = cfg
+
+    async def amend(market, side, order_id, price, **kw):
+        return {"orderId": order_id}
+
+    monkeypatch.setattr(bot, "amend_order", amend)
+    monkeypatch.setattr(bot, "_tp_trail_next", {})
+    return cfg
+
+
+def test_floor_ratchets_up_and_triggers_exit(bot, monkeypatch):
+    cfg = _position(bot, monkeypatch)
+    bot.triggers.sync("BTC_USDT", cfg)
+
+    run(bot.trail_tp("BTC_USDT", cfg, Decimal("101.0")))   # +1% < 0.8% + gap — ще рано
+    assert cfg.profit_floor is None
+
+    run(bot.trail_tp("BTC_USDT", cfg, Decimal("102.0")))
+    assert cfg.profit_floor == 101.592                      # 102 × (1 − 0.4%), не нижче 100.8
+    prices, kinds = bot.triggers.below["BTC_USDT"]
+    assert (101.592, "lock") in zip(prices, kinds)
+    assert bot.sl_breach(cfg, 101.7) is None
+    assert bot.sl_breach(cfg, 101.5) == "lock"              # розворот — вихід у плюсі, а не на SL 98
+
+    run(bot.trail_tp("BTC_USDT", cfg, Decimal("101.2")))   # підлога не опускається
+    assert cfg.profit_floor == 101.592
+
+
+def test_floor_is_at_least_min_pnl(bot, monkeypatch):
+    cfg = _position(bot, monkeypatch)
+    bot.safety.cfg.trail_tp_gap_pct = Decimal("5")
+    run(bot.trail_tp("BTC_USDT", cfg, Decimal("106.0")))
+    assert cfg.profit_floor == 100.8
+
+
+def test_native_stop_activation_respects_floor(bot):
+    cfg = bot.MarketConfig(sl=2.0, sl_mode="trigger", entry_price=100.0)
+    assert bot._sl_activation(cfg) == Decimal("98.0")
+    cfg.profit_floor = 101.5
+    assert bot._sl_activation(cfg) == Decimal("101.5")
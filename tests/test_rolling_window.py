@@ -0,0 +1,70 @@
+"""Реплей тисяч тіків через RollingWindow/SafetyManager проти перебору «в лоб»."""
+import random
+from bisect import bisect_left
+from decimal import Decimal
+
+import main
+
+
+def _brute(ticks, times, k, window):
+    """max/min цін тіків 0..k, що потрапляють у вікно від часу k-го тіку."""
+    start = bisect_left(times, ticks[k][0] - window, 0, k + 1)
+    seen = [p for _, p in ticks[start:k + 1]]
+    return max(seen), min(seen)
+
+
+def _random_walk(n, seed, dt_max=3.0):
+    rnd = random.Random(seed)
+    t, p, out = 0.0, 100.0, []
+    for _ in range(n):
+        t += rnd.uniform(0.0, dt_max)          # бувають і тіки з тим самим часом
+        p = max(0.01, p * (1 + rnd.gauss(0, 0.004)))
+        out.append((t, p))
+    return out
+
+
+def test_window_high_low_match_brute_force():
+    for seed in range(5):
+        window = 60.0
+        w = main.RollingWindow(window)
+        ticks = _random_walk(5000, seed)
+        times = [t for t, _ in ticks]
+        for k, (t, p) in enumerate(ticks):
+            w.push(t, p)
+            hi, lo = _brute(ticks, times, k, window)
+            assert w.high() == hi
+            assert w.low() == lo
+
+
+def test_window_evicts_on_read_time():
+    w = main.RollingWindow(10)
+    w.push(0, 5.0)
+    w.push(1, 3.0)
+    assert w.high(now=5) == 5.0
+    assert w.high(now=10.5) == 3.0   # тік t=0 вже за межею вікна
+    assert w.low(now=11.5) is None
+
+
+def test_window_ignores_out_of_order_ticks():
+    w = main.RollingWindow(60)
+    w.push(10, 5.0)
+    w.push(5, 100.0)                 # запізнілий тік не має стати максимумом
+    assert w.high() == 5.0
+    assert w.last_ts == 10
+
+
+def test_safety_dump_pause_matches_brute_force():
+    cfg = main.SafetyConfig(dump_window_sec=120, dump_pct=Decimal("1.2"), dump_pause_sec=60)
+    sm = main.SafetyManager(cfg)
+    ticks = _random_walk(4000, seed=42, dt_max=2.0)
+    times = [t for t, _ in ticks]
+    thr = 1 - float(cfg.dump_pct) / 100
+    paused_until = 0.0
+    for k, (t, p) in enumerate(ticks):
+        sm.note_price("BTC_USDT", p, t)
+        hi, _ = _brute(ticks, times, k, cfg.dump_window_sec)
+        if p <= hi * thr:
+            paused_until = t + cfg.dump_pause_sec
+        assert sm.by_pair["BTC_USDT"].paused_until == paused_until
+        assert (sm.block_entry_reason("BTC_USDT", now=t) is not None) == (t < paused_until)
+    assert paused_until > 0  # реплей справді містить дампи
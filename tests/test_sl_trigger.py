@@ -0,0 +1,43 @@
+"""SL із тіку ціни не чекає тіку монітора, що завис на HTTP-ретраях."""
+import asyncio
+
+from conftest import run, wait_for
+
+
+def test_tick_trigger_preempts_hung_monitor_tick(bot, monkeypatch):
+    cfg = bot.MarketConfig(entry_price=100.0, sl=1.0, sl_mode="trigger")
+    bot.markets["BTC_USDT"] = cfg
+    started, ticks, exits = asyncio.Event(), [], []
+
+    async def hung_monitor(market):
+        ticks.append(market)
+        started.set()
+        await asyncio.sleep(3600)   # як 3×30с ретраїв, тільки довше
+
+    async def execute_sl(market, c, reason, t0=None, source="monitor"):
+        exits.append((market, reason, source))
+        c.entry_price = None
+        bot.triggers.sync(market, c)
+
+    monkeypatch.setattr(bot, "monitor_market", hung_monitor)
+    monkeypatch.setattr(bot, "execute_sl", execute_sl)
+
+    async def scenario():
+        bot.supervisor.running = True
+        bot.supervisor.sync()
+        await asyncio.wait_for(started.wait(), 1)
+        bot.triggers.sync("BTC_USDT", cfg)
+        bot.triggers.on_tick("BTC_USDT", 98.5, bot.time.monotonic())
+        assert len(bot.triggers.tasks) == 1          # посилання на fire_sl тримаємо до кінця
+        await wait_for(lambda: exits, timeout=1.0)
+        await wait_for(lambda: not bot.triggers.tasks and "BTC_USDT" not in bot.triggers.firing)
+        worker = bot.supervisor.workers["BTC_USDT"]
+        assert not worker.done()                      # перерваний тік не вбив воркер
+        bot.supervisor.wake("BTC_USDT")
+        await wait_for(lambda: len(ticks) >= 2)       # і наступний тік пішов як звичайно
+        await bot.supervisor.shutdown(timeout=0.1)
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+
+    run(scenario())
+    assert exits == [("BTC_USDT", "sl", "tick")]
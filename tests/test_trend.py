@@ -0,0 +1,44 @@
+"""TrendState на частому фіді: кільце з проріджуванням має покривати вікно і давати ті ж суми, що й перебір."""
+import math
+import random
+
+import main
+
+
+def _samples(st):
+    idx = [(st.head + k) % st.cap for k in range(st.n)]
+    return [st.ts[i] for i in idx], [st.y[i] for i in idx], [st.r2[i] for i in idx]
+
+
+def _feed(st, rate, seconds, seed=0, drift=0.00002):
+    rnd = random.Random(seed)
+    t, p = 1_000.0, 100.0
+    for _ in range(int(rate * seconds)):
+        t += rnd.expovariate(rate)
+        p *= 1 + drift + rnd.gauss(0, 0.0002)
+        st.push(p, t)
+
+
+def test_fast_feed_keeps_window_warm():
+    for rate in (1, 10, 50):
+        st = main.TrendState(300, cap=1024)
+        _feed(st, rate, 400)
+        span = st.last_ts - st.ts[st.head]
+        assert st.warm(), rate
+        assert span >= 0.95 * 300, (rate, span)
+        assert st.change_pct() > 0
+
+
+def test_downsampled_sums_match_brute_force():
+    st = main.TrendState(120, cap=256)
+    _feed(st, 20, 300, seed=3)
+    ts, ys, r2 = _samples(st)
+    assert all(b > a for a, b in zip(ts, ts[1:]))
+    xs = [t - st.t0 for t in ts]
+    assert math.isclose(st.sx, sum(xs), rel_tol=1e-9, abs_tol=1e-6)
+    assert math.isclose(st.sy, sum(ys), rel_tol=1e-9)
+    assert math.isclose(st.sxx, sum(x * x for x in xs), rel_tol=1e-9)
+    assert math.isclose(st.sxy, sum(x * y for x, y in zip(xs, ys)), rel_tol=1e-9, abs_tol=1e-6)
+    # доходності — між сусідніми семплами, що лишились у кільці
+    assert all(math.isclose(r2[k], (ys[k] - ys[k - 1]) ** 2, rel_tol=1e-9, abs_tol=1e-18) for k in range(1, len(ys)))
+    assert math.isclose(st.sr2, sum(r2[1:]), rel_tol=1e-6, abs_tol=1e-15)